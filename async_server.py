@@ -0,0 +1,99 @@
+import asyncio
+import json
+from concurrent.futures import Future, ThreadPoolExecutor
+import protocol
+import workers
+
+IO_THREADS = 32    # threads running request handlers (storage I/O) off the event loop
+BACKLOG = 1024
+
+
+class AsyncServer:
+    """asyncio front end that serves both wire modes on one event loop.
+
+    Idle connections cost a coroutine rather than an OS thread. Each request
+    runs handle(request) in a small thread pool so blocking storage I/O never
+    stalls the loop; handlers push PBKDF2 and Paillier math to the workers
+    process pool themselves and may return a Future, which is awaited.
+    Framed requests on one connection are handled concurrently and answered
+    as they finish. With a scheduler, requests go through its lanes (keyed
+    by connection for its per-client limit) instead of the thread pool.
+    """
+
+    def __init__(self, handle, io_threads=IO_THREADS, scheduler=None):
+        self.handle = handle
+        self.scheduler = scheduler
+        self.io_pool = ThreadPoolExecutor(io_threads, thread_name_prefix="io")
+        self.connections = 0
+
+    async def _respond(self, writer, payload, framed):
+        request = None
+        try:
+            request = json.loads(payload.decode())
+        except (json.JSONDecodeError, UnicodeDecodeError):
+            response = {"status": "error", "message": "Invalid request format"}
+        else:
+            if self.scheduler is not None:
+                response = self.scheduler.submit(request, writer)
+            else:
+                loop = asyncio.get_running_loop()
+                response = await loop.run_in_executor(self.io_pool, self.handle, request)
+            if isinstance(response, Future):
+                try:
+                    response = await asyncio.wrap_future(response)
+                except Exception:
+                    response = {"status": "error", "message": "Internal server error"}
+        if isinstance(request, dict) and "id" in request:
+            response = dict(response, id=request["id"])
+        data = json.dumps(response).encode()
+        writer.write(protocol.HEADER.pack(len(data)) + data if framed else data)
+        await writer.drain()
+
+    async def _read_frame(self, reader, prefix=b""):
+        header = prefix + await reader.readexactly(protocol.HEADER.size - len(prefix))
+        (length,) = protocol.HEADER.unpack(header)
+        if length > protocol.MAX_FRAME:
+            raise ValueError(f"Frame of {length} bytes exceeds MAX_FRAME")
+        return await reader.readexactly(length)
+
+    async def _serve_connection(self, reader, writer):
+        self.connections += 1
+        tasks = set()
+        try:
+            first = await reader.read(1)
+            if first == b"\x00":
+                payload = await self._read_frame(reader, first)
+                while True:
+                    task = asyncio.create_task(self._respond(writer, payload, framed=True))
+                    tasks.add(task)
+                    task.add_done_callback(tasks.discard)
+                    payload = await self._read_frame(reader)
+            elif first:
+                data = first + await reader.read(protocol.LEGACY_BUFFER - 1)
+                while data and data != b"exit":
+                    await self._respond(writer, data, framed=False)
+                    data = await reader.read(protocol.LEGACY_BUFFER)
+        except (asyncio.IncompleteReadError, ConnectionError, ValueError):
+            pass
+        finally:
+            if tasks:
+                await asyncio.gather(*tasks, return_exceptions=True)
+            self.connections -= 1
+            writer.close()
+
+    async def serve(self, host, port):
+        server = await asyncio.start_server(self._serve_connection, host, port,
+                                            reuse_address=True, backlog=BACKLOG)
+        async with server:
+            await server.serve_forever()
+
+
+def run(handle, host, port, io_threads=IO_THREADS, cpu_workers=None, scheduler=None):
+    """Serves handle() on host:port until interrupted.
+
+    cpu_workers sizes the process pool for PBKDF2 and Paillier work; None
+    keeps whatever workers.configure() last set up.
+    """
+    if cpu_workers is not None:
+        workers.configure(cpu_workers)
+    asyncio.run(AsyncServer(handle, io_threads, scheduler).serve(host, port))
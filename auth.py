@@ -1,58 +1,54 @@
 import os
-import json
 import base64
+import hmac
 import hashlib
+import storage
+import workers
+import metrics
 
-CREDENTIALS_FILE = "credentials.json"
+# PBKDF2-HMAC-SHA256 of a password; runs in the worker process pool when one is configured.
+def derive_key(password: str, salt: bytes) -> bytes:
+    return hashlib.pbkdf2_hmac("sha256", password.encode(), salt, 100000)
+
+# Runs derive_key on the given executor (e.g. the auth pipeline's pool), or on the shared workers pool.
+def run_kdf(password: str, salt: bytes, executor=None) -> bytes:
+    with metrics.timed("pbkdf2"):
+        return (executor or workers).submit(derive_key, password, salt).result()
 
 # Hash password using SHA-256 with a salt.
-def hash_password(password: str, salt: bytes) -> str:
-    hashed_pw = hashlib.pbkdf2_hmac("sha256", password.encode(), salt, 100000)
+def hash_password(password: str, salt: bytes, executor=None) -> str:
+    hashed_pw = run_kdf(password, salt, executor)
     return base64.b64encode(salt + hashed_pw).decode() 
 
 # Store user credentials securely
-def store_credentials(userid: str, password: str, balance: int, public_key):
+def store_credentials(userid: str, password: str, balance: int, public_key, executor=None) -> bool:
     salt = os.urandom(16)
-    hashed_password = hash_password(password, salt)
-
-    # Load existing credentials or create new storage
-    data = {}
-    if os.path.exists(CREDENTIALS_FILE):
-        with open(CREDENTIALS_FILE, "r") as f:
-            data = json.load(f)
+    hashed_password = hash_password(password, salt, executor)
 
-    if userid not in data:
-        data[userid] = {"pwd": hashed_password, "balance" : balance, "public_key": public_key}  
-    else:
+    record = {"pwd": hashed_password, "balance" : balance, "public_key": public_key}
+    if not storage.get_store().create(userid, record):
         print("❌ User ID already exists.")
-        return
-
-    with open(CREDENTIALS_FILE, "w") as f:
-        json.dump(data, f, indent=4)
+        return False
 
     print("✅ Credentials stored securely!")
+    return True
 
 # Verifying if the provided user ID and password are correct
-def verify_credentials(userid: str, password: str) -> bool:
-    if not os.path.exists(CREDENTIALS_FILE):
-        print("❌ No credentials stored.")
-        return False
-
-    with open(CREDENTIALS_FILE, "r") as f:
-        data = json.load(f)
+def verify_credentials(userid: str, password: str, executor=None) -> bool:
+    account = storage.get_store().get(userid)
 
-    if userid not in data:
+    if account is None:
         print("❌ User ID not found.")
         return False
 
     # Retrieve stored salt and hash
-    stored_hash_bytes = base64.b64decode(data[userid]["pwd"])
+    stored_hash_bytes = base64.b64decode(account["pwd"])
     salt, stored_hashed_pw = stored_hash_bytes[:16], stored_hash_bytes[16:]
 
     # Re-hash input password with the stored salt
-    new_hashed_pw = hashlib.pbkdf2_hmac("sha256", password.encode(), salt, 100000)
+    new_hashed_pw = run_kdf(password, salt, executor)
 
-    if new_hashed_pw == stored_hashed_pw:
+    if hmac.compare_digest(new_hashed_pw, stored_hashed_pw):
         print("✅ Authentication successful!")
         return True
     else:
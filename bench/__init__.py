@@ -0,0 +1,62 @@
+"""Benchmarks for the wallet.
+
+bench.paillier times the Paillier primitives and bench.load drives local
+servers with simulated clients. Both print (or write) one JSON document so
+results can be stored and compared between runs.
+"""
+import json
+import os
+import platform
+import sys
+import time
+
+
+def percentile(sorted_samples, q):
+    """Returns the q-th percentile (0-100) of an already sorted list."""
+    if not sorted_samples:
+        return None
+    index = min(len(sorted_samples) - 1, max(0, round(q / 100 * (len(sorted_samples) - 1))))
+    return sorted_samples[index]
+
+
+def summarize(samples, scale=1e3):
+    """Returns count, mean, p50, p99 and max of durations in seconds, multiplied by scale."""
+    samples = sorted(samples)
+    if not samples:
+        return {"count": 0}
+    return {
+        "count": len(samples),
+        "mean": sum(samples) / len(samples) * scale,
+        "p50": percentile(samples, 50) * scale,
+        "p99": percentile(samples, 99) * scale,
+        "max": samples[-1] * scale,
+    }
+
+
+def environment():
+    """Describes the machine a run was made on."""
+    return {
+        "time": time.strftime("%Y-%m-%dT%H:%M:%S%z"),
+        "python": sys.version.split()[0],
+        "platform": platform.platform(),
+        "machine": platform.machine(),
+    }
+
+
+def write_results(results, path=None):
+    """Writes results as JSON to path, or to stdout when path is None or "-".
+
+    The process's real stdout is used, so results stay clean while sys.stdout
+    is redirected away from the servers' logging.
+    """
+    text = json.dumps(results, indent=2)
+    if path in (None, "-"):
+        try:
+            print(text, file=sys.__stdout__)
+            sys.__stdout__.flush()
+        except BrokenPipeError:
+            # The reader (e.g. head) went away; point stdout at devnull so exit does not fail again.
+            os.dup2(os.open(os.devnull, os.O_WRONLY), sys.__stdout__.fileno())
+    else:
+        with open(path, "w") as f:
+            f.write(text + "\n")
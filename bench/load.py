@@ -0,0 +1,214 @@
+"""Headless load generator for the wallet servers.
+
+    python -m bench.load --clients 16 --requests 200 --mix transfer=6,balance=3,history=1
+
+Starts server.start_server and third_party.start_server (or the asyncio
+variants with --async) in a scratch directory, signs up and logs in one
+simulated client per connection, then runs a random mix of requests and
+reports throughput and latency (milliseconds) per request type as JSON.
+"""
+import argparse
+import os
+import random
+import socket
+import sys
+import tempfile
+import threading
+import time
+from collections import defaultdict
+import homomorphic
+import protocol
+import utils
+from bench import environment, summarize, write_results
+
+PORT = 56432               # wallet server; the third-party server listens on PORT - 1
+CLIENTS = 8
+REQUESTS = 100             # requests per client after signup and login
+MIX = "transfer=6,balance=3,history=1"
+KEY_SIZE = 512
+START_BALANCE = 10 ** 6
+
+
+def parse_mix(text):
+    """Parses "type=weight,..." into ([types], [weights])."""
+    mix = {}
+    for part in text.split(","):
+        name, _, weight = part.partition("=")
+        mix[name.strip()] = float(weight or 1)
+    unknown = set(mix) - {"transfer", "balance", "history", "login"}
+    if unknown:
+        raise ValueError(f"Unknown request types in mix: {', '.join(sorted(unknown))}")
+    return list(mix), list(mix.values())
+
+
+def connect(port, timeout=10):
+    deadline = time.monotonic() + timeout
+    while True:
+        try:
+            return protocol.Client(socket.create_connection(("127.0.0.1", port)))
+        except ConnectionRefusedError:
+            if time.monotonic() > deadline:
+                raise
+            time.sleep(0.05)
+
+
+def start_servers(port, use_async, cpu_workers):
+    import server
+    import third_party
+    if use_async:
+        wallet = (server.start_async_server, {"port": port, "cpu_workers": cpu_workers})
+        vault = (third_party.start_async_server, {"port": port - 1, "cpu_workers": None})
+    else:
+        wallet = (server.start_server, {"port": port})
+        vault = (third_party.start_server, {"port": port - 1})
+    for target, kwargs in (vault, wallet):
+        threading.Thread(target=target, kwargs=kwargs, daemon=True).start()
+
+
+class Recorder:
+    """Collects latency samples and error counts per request type."""
+
+    def __init__(self):
+        self.samples = defaultdict(list)
+        self.errors = defaultdict(int)
+        self._lock = threading.Lock()
+
+    def call(self, conn, kind, request):
+        start = time.perf_counter()
+        try:
+            response = conn.call(request)
+        except (OSError, ConnectionError):
+            response = {"status": "error"}
+        elapsed = time.perf_counter() - start
+        with self._lock:
+            self.samples[kind].append(elapsed)
+            if response.get("status") != "success":
+                self.errors[kind] += 1
+        return response
+
+
+class SimulatedClient:
+    """One scripted user: signs up, logs in, then issues requests from the mix.
+
+    Setup calls are recorded as setup_<kind>, apart from the same kinds in the mix.
+    """
+
+    def __init__(self, username, keys, port, recorder):
+        self.username = username
+        self.keys = keys
+        self.port = port
+        self.recorder = recorder
+
+    def setup(self):
+        public_key, private_key = self.keys[self.username]
+        self.vault_conn = connect(self.port - 1)
+        self.conn = connect(self.port)
+        self.recorder.call(self.vault_conn, "setup_store_keys", {
+            "type": "store_keys", "username": self.username,
+            "private_key": utils.serialize_key(private_key), "public_key": utils.serialize_key(public_key)})
+        self.recorder.call(self.conn, "setup_signup", {
+            "request": "signup", "username": self.username, "password": "bench",
+            "balance": int(public_key.encrypt(START_BALANCE)), "public_key": utils.serialize_key(public_key)})
+        self.login("setup_login")
+
+    def login(self, kind="login"):
+        response = self.recorder.call(self.conn, kind,
+                                      {"request": "login", "username": self.username, "password": "bench"})
+        if "token" in response:
+            self.conn.defaults["token"] = response["token"]
+
+    def run(self, requests, kinds, weights, seed):
+        rng = random.Random(seed)
+        others = [u for u in self.keys if u != self.username]
+        for kind in rng.choices(kinds, weights, k=requests):
+            if kind == "login":
+                self.login()
+            elif kind == "balance":
+                self.recorder.call(self.conn, kind, {"request": "balance", "username": self.username})
+            elif kind == "history":
+                self.recorder.call(self.conn, kind, {"request": "history", "username": self.username,
+                                                     "limit": 100})
+            elif others:
+                receiver = rng.choice(others)
+                self.recorder.call(self.conn, kind, {
+                    "request": "transfer", "sender": self.username, "receiver": receiver,
+                    "sender_encrypted_amount": int(self.keys[self.username][0].encrypt(1)),
+                    "receiver_encrypted_amount": int(self.keys[receiver][0].encrypt(1))})
+
+    def close(self):
+        self.conn.close()
+        self.vault_conn.close()
+
+
+def run_load(clients=CLIENTS, requests=REQUESTS, mix=MIX, port=PORT, use_async=False,
+             cpu_workers=os.cpu_count(), key_size=KEY_SIZE, seed=0):
+    """Runs one load test and returns its results as a dict."""
+    kinds, weights = parse_mix(mix)
+    keys = {f"bench{i}": homomorphic.generate_keypair(key_size) for i in range(clients)}
+    recorder = Recorder()
+    users = [SimulatedClient(username, keys, port, recorder) for username in keys]
+
+    start_servers(port, use_async, cpu_workers)
+    setup_start = time.perf_counter()
+    threads = [threading.Thread(target=user.setup) for user in users]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    setup_time = time.perf_counter() - setup_start
+
+    run_start = time.perf_counter()
+    threads = [threading.Thread(target=user.run, args=(requests, kinds, weights, seed + i))
+               for i, user in enumerate(users)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    run_time = time.perf_counter() - run_start
+    for user in users:
+        user.close()
+
+    types = {}
+    for kind, samples in recorder.samples.items():
+        phase_time = run_time if kind in kinds else setup_time
+        types[kind] = dict(summarize(samples), errors=recorder.errors[kind],
+                           throughput=len(samples) / phase_time)
+    total = sum(len(recorder.samples[kind]) for kind in kinds)
+    return {
+        "benchmark": "load",
+        "environment": environment(),
+        "config": {"clients": clients, "requests": requests, "mix": mix, "async": use_async,
+                   "cpu_workers": cpu_workers if use_async else None, "key_size": key_size, "seed": seed},
+        "unit": "ms",
+        "setup_seconds": setup_time,
+        "run_seconds": run_time,
+        "throughput": total / run_time,
+        "types": types,
+    }
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--clients", type=int, default=CLIENTS)
+    parser.add_argument("--requests", type=int, default=REQUESTS, help="requests per client")
+    parser.add_argument("--mix", default=MIX, help="weights, e.g. transfer=6,balance=3,history=1,login=0")
+    parser.add_argument("--port", type=int, default=PORT)
+    parser.add_argument("--async", dest="use_async", action="store_true", help="use the asyncio servers")
+    parser.add_argument("--cpu-workers", type=int, default=os.cpu_count())
+    parser.add_argument("--key-size", type=int, default=KEY_SIZE)
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--workdir", help="directory for the servers' data files (default: a new temp dir)")
+    parser.add_argument("--output", help="JSON file to write (default: stdout)")
+    args = parser.parse_args(argv)
+
+    output = os.path.abspath(args.output) if args.output else None
+    os.chdir(args.workdir or tempfile.mkdtemp(prefix="wallet-bench-"))
+    # The servers log every connection, and their threads outlive run_load; keep that out of the results.
+    sys.stdout = open(os.devnull, "w")
+    results = run_load(args.clients, args.requests, args.mix, args.port, args.use_async,
+                       args.cpu_workers, args.key_size, args.seed)
+    write_results(results, output)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,69 @@
+"""Microbenchmarks for homomorphic.Paillier.
+
+    python -m bench.paillier --sizes 512 1024 2048 --output paillier.json
+
+Times keygen, encrypt, decrypt, homomorphic_addition and
+homomorphic_subtraction for each key size (as passed to Paillier(key_size)).
+Durations are reported in microseconds.
+"""
+import argparse
+import random
+import time
+import homomorphic
+from bench import environment, summarize, write_results
+
+SIZES = (512, 1024, 2048)
+ITERATIONS = 200
+KEYGEN_ITERATIONS = 3
+
+
+def timed(fn, args_list):
+    samples = []
+    for args in args_list:
+        start = time.perf_counter()
+        fn(*args)
+        samples.append(time.perf_counter() - start)
+    return samples
+
+
+def bench_size(key_size, iterations=ITERATIONS, keygen_iterations=KEYGEN_ITERATIONS):
+    """Returns {operation: timing summary} for one key size."""
+    results = {}
+    results["keygen"] = timed(lambda: homomorphic.Paillier(key_size).generate_keys(),
+                              [()] * keygen_iterations)
+
+    paillier = homomorphic.Paillier(key_size)
+    public_key, private_key = paillier.public_key, paillier.private_key
+    messages = [random.randrange(10 ** 6) for _ in range(iterations)]
+    results["encrypt"] = timed(paillier.encrypt, [(m, public_key) for m in messages])
+
+    ciphertexts = [paillier.encrypt(m, public_key) for m in messages]
+    results["decrypt"] = timed(paillier.decrypt, [(c, private_key) for c in ciphertexts])
+    pairs = [(a, b, public_key) for a, b in zip(ciphertexts, ciphertexts[1:] + ciphertexts[:1])]
+    results["homomorphic_addition"] = timed(paillier.homomorphic_addition, pairs)
+    results["homomorphic_subtraction"] = timed(paillier.homomorphic_subtraction, pairs)
+
+    summary = {}
+    for operation, samples in results.items():
+        summary[operation] = dict(summarize(samples, scale=1e6),
+                                  ops_per_sec=len(samples) / sum(samples))
+    return summary
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--sizes", type=int, nargs="+", default=list(SIZES))
+    parser.add_argument("--iterations", type=int, default=ITERATIONS)
+    parser.add_argument("--keygen-iterations", type=int, default=KEYGEN_ITERATIONS)
+    parser.add_argument("--output", help="JSON file to write (default: stdout)")
+    args = parser.parse_args(argv)
+
+    results = {"benchmark": "paillier", "environment": environment(), "unit": "us",
+               "iterations": args.iterations, "sizes": {}}
+    for key_size in args.sizes:
+        results["sizes"][str(key_size)] = bench_size(key_size, args.iterations, args.keygen_iterations)
+    write_results(results, args.output)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,231 @@
+import json
+import os
+import queue
+import re
+import secrets
+import threading
+import time
+from datetime import datetime
+import codec
+import history_log
+import homomorphic
+import locks
+import metrics
+import storage
+import utils
+
+JOB_DIR = "bulk_jobs"      # <job>.json holds a job's spec, <job>.progress.json how far it got
+BATCH_SIZE = 1000          # accounts locked, adjusted and committed together
+OPS = ("credit", "debit")
+
+
+def _check_job_id(job_id):
+    """Job ids name files in JOB_DIR, so only short lowercase hex is accepted."""
+    if not isinstance(job_id, str) or not re.fullmatch(r"[0-9a-f]{1,64}", job_id):
+        raise ValueError("Job ids are lowercase hex")
+
+
+class BulkJob:
+    """One adjustment applied to many accounts in checkpointed batches.
+
+    spec is {"op", "amount" | "amounts", "usernames", "started"}: a
+    plaintext amount credited or debited to every account, or a
+    {username: ciphertext} map credited or debited per account. Each batch
+    locks its accounts, computes the new balances on the workers pool and
+    commits them in one update that also adds the job id to the account's
+    "bulk_jobs", so a resumed job never adjusts an account twice. Ids of
+    jobs that live_jobs() no longer lists (finished ones) are dropped from
+    "bulk_jobs" on the way. History entries are appended after the commit,
+    and progress is saved after each batch.
+
+    The server cannot see balances, so a debit larger than a balance is
+    applied anyway and leaves it negative (clients decrypt values above
+    n/2 as negative and refuse transfers from such an account). Percentage
+    interest is not supported: Paillier has no homomorphic division.
+    """
+
+    def __init__(self, job_id, spec, directory=JOB_DIR, batch_size=BATCH_SIZE, live_jobs=None):
+        self.job_id = job_id
+        self.spec = spec
+        self.batch_size = batch_size
+        self.live_jobs = live_jobs
+        self.progress_path = os.path.join(directory, f"{job_id}.progress.json")
+        try:
+            with open(self.progress_path, "r") as f:
+                self.progress = json.load(f)
+        except (FileNotFoundError, json.JSONDecodeError):
+            self.progress = {"op": spec["op"], "total": len(spec["usernames"]), "done": 0, "adjusted": 0,
+                             "finished": False}
+
+    def status(self):
+        return {"job": self.job_id, **self.progress}
+
+    def _operand(self, username):
+        if "amounts" in self.spec:
+            return codec.decode(self.spec["amounts"][username])
+        return int(self.spec["amount"])
+
+    def _kind(self):
+        if "amounts" in self.spec:
+            return self.spec["op"] + "_ciphertext"
+        return self.spec["op"]
+
+    def _entry(self, current_time, account, operand):
+        entry = {"time": current_time, "type": "adjustment", "op": self.spec["op"], "job": self.job_id}
+        if "amounts" in self.spec:
+            entry["amount"] = codec.encode(operand, account["public_key"])
+        else:
+            # g^a = 1 + a·n is the encryption of a public amount the client can decrypt.
+            n = codec.decode(account["public_key"][0])
+            entry["amount"] = codec.encode((1 + operand * n) % (n * n), account["public_key"])
+        return entry
+
+    def _logged(self, username):
+        """True if the user's history already holds this job's entry (for the batch redone after a crash)."""
+        entries, _ = history_log.get_log().read(username, since=self.spec["started"])
+        return any(e.get("job") == self.job_id for e in entries)
+
+    def run_batch(self, usernames):
+        store = storage.get_store()
+        current_time = datetime.now().strftime("%H:%M:%S")
+        with locks.get_lock_manager().locked(*usernames):
+            with metrics.timed("storage_read"):
+                accounts = {u: store.get(u) for u in usernames}
+            todo = [u for u, a in accounts.items() if a is not None and self.job_id not in a.get("bulk_jobs", ())]
+            redone = [u for u, a in accounts.items() if a is not None and self.job_id in a.get("bulk_jobs", ())]
+            items = [(codec.decode(accounts[u]["public_key"][0]), codec.decode(accounts[u]["balance"]),
+                      self._operand(u)) for u in todo]
+            with metrics.timed("paillier"):
+                balances = homomorphic.adjust_many(self._kind(), items)
+            if todo:
+                live = self.live_jobs() if self.live_jobs is not None else None
+                with metrics.timed("storage_write"):
+                    store.update_many({u: {"balance": codec.encode(b, accounts[u]["public_key"]),
+                                           "bulk_jobs": [j for j in accounts[u].get("bulk_jobs", ())
+                                                         if live is None or j in live] + [self.job_id]}
+                                       for u, b in zip(todo, balances)})
+        entries = [(u, self._entry(current_time, accounts[u], self._operand(u)))
+                   for u in todo + [u for u in redone if not self._logged(u)]]
+        with metrics.timed("history_write"):
+            history_log.get_log().append_many(entries)
+        return len(todo)
+
+    def run(self):
+        """Applies the job to every account not yet done; safe to call again after a crash."""
+        usernames = self.spec["usernames"]
+        while self.progress["done"] < len(usernames):
+            start = self.progress["done"]
+            adjusted = self.run_batch(usernames[start:start + self.batch_size])
+            self.progress = dict(self.progress, done=min(start + self.batch_size, len(usernames)),
+                                 adjusted=self.progress["adjusted"] + adjusted)
+            utils.atomic_write_json(self.progress_path, self.progress)
+            metrics.inc("wallet_bulk_accounts_total", (("op", self.spec["op"]),), adjusted)
+        self.progress["finished"] = True
+        utils.atomic_write_json(self.progress_path, self.progress)
+        return self.progress
+
+
+class BulkEngine:
+    """Starts, tracks and resumes bulk jobs, one at a time and in submission order, in a background thread."""
+
+    def __init__(self, directory=JOB_DIR, batch_size=BATCH_SIZE):
+        self.directory = directory
+        self.batch_size = batch_size
+        self.jobs = {}     # jobs not finished yet, queued or running
+        self._lock = threading.Lock()
+        self._queue = queue.Queue()
+        self._worker = None
+        os.makedirs(directory, exist_ok=True)
+
+    def _live_jobs(self):
+        with self._lock:
+            return set(self.jobs)
+
+    def _job(self, job_id, spec):
+        return BulkJob(job_id, spec, self.directory, self.batch_size, self._live_jobs)
+
+    def _load(self, job_id):
+        with open(os.path.join(self.directory, f"{job_id}.json"), "r") as f:
+            return self._job(job_id, json.load(f))
+
+    def submit(self, op, amount=None, amounts=None, job_id=None):
+        """Validates and starts a job; returns its id.
+
+        job_id lets a caller (the shard router) start the same job on several servers.
+        """
+        if op not in OPS:
+            raise ValueError(f"Unknown bulk operation: {op}")
+        if job_id is None:
+            job_id = secrets.token_hex(8)
+        _check_job_id(job_id)
+        if os.path.exists(os.path.join(self.directory, f"{job_id}.json")):
+            raise ValueError(f"Job {job_id} already exists")
+        spec = {"op": op, "started": time.time()}
+        if amounts is not None:
+            spec["amounts"] = {u: codec.for_wire(c, codec.VERSION) for u, c in amounts.items()}
+        elif isinstance(amount, int) and amount >= 0:
+            spec["amount"] = amount
+        else:
+            raise ValueError(f"{op} needs a non-negative integer amount or per-account amounts")
+        spec["usernames"] = sorted(spec["amounts"]) if "amounts" in spec else sorted(storage.get_store().usernames())
+
+        utils.atomic_write_json(os.path.join(self.directory, f"{job_id}.json"), spec)
+        self._start(self._job(job_id, spec))
+        return job_id
+
+    def _start(self, job):
+        with self._lock:
+            self.jobs[job.job_id] = job
+            self._queue.put(job)
+            if self._worker is None:
+                self._worker = threading.Thread(target=self._run_jobs, daemon=True)
+                self._worker.start()
+
+    def _run_jobs(self):
+        while True:
+            job = self._queue.get()
+            try:
+                job.run()
+            except (OSError, KeyError, ValueError) as exc:
+                # It stays in self.jobs, so its account markers are kept until it resumes.
+                print(f"❌ Bulk job {job.job_id} stopped, it resumes on restart: {exc}")
+                continue
+            with self._lock:
+                self.jobs.pop(job.job_id, None)
+
+    def resume(self):
+        """Restarts every job whose progress file does not say it finished, oldest first."""
+        jobs = []
+        for name in os.listdir(self.directory):
+            if not name.endswith(".json") or name.endswith(".progress.json"):
+                continue
+            job = self._load(name[:-len(".json")])
+            if not job.progress["finished"]:
+                jobs.append(job)
+        for job in sorted(jobs, key=lambda job: (job.spec["started"], job.job_id)):
+            self._start(job)
+
+    def status(self, job_id):
+        """Returns a job's progress, or None for an unknown job; raises ValueError for a malformed id."""
+        _check_job_id(job_id)
+        with self._lock:
+            job = self.jobs.get(job_id)
+        if job is not None:
+            return job.status()
+        try:
+            with open(os.path.join(self.directory, f"{job_id}.progress.json"), "r") as f:
+                return {"job": job_id, **json.load(f)}
+        except (FileNotFoundError, json.JSONDecodeError):
+            return None
+
+
+_engine = None
+_engine_lock = threading.Lock()
+
+def get_engine():
+    """Returns the process-wide bulk engine."""
+    global _engine
+    with _engine_lock:
+        if _engine is None:
+            _engine = BulkEngine()
+        return _engine
@@ -0,0 +1,149 @@
+import json
+import os
+import threading
+import time
+from collections import defaultdict
+from datetime import datetime
+import history_log
+import homomorphic
+import codec
+import storage
+
+ARCHIVE_DIR = "history_archive"
+MAX_AGE_DAYS = 30         # fold entries older than this many days
+MAX_ENTRIES = 1000        # fold entries beyond a user's newest MAX_ENTRIES
+PERIOD = "%Y-%m"          # strftime format naming one checkpoint period (monthly)
+INTERVAL = 300            # seconds between passes of the background job
+USER_PAUSE = 0.05         # seconds between users within a pass
+
+MONEY_TYPES = ("send money", "receive money", "adjustment")
+
+
+class CheckpointPolicy:
+    """Decides which of a user's oldest history records get folded."""
+
+    def __init__(self, max_age_days=MAX_AGE_DAYS, max_entries=MAX_ENTRIES, period=PERIOD):
+        self.max_age_days = max_age_days
+        self.max_entries = max_entries
+        self.period = period
+
+    def foldable(self, records, total, now=None):
+        """Returns the longest prefix of records that is old or beyond max_entries."""
+        now = time.time() if now is None else now
+        cutoff = now - self.max_age_days * 86400 if self.max_age_days is not None else None
+        excess = total - self.max_entries if self.max_entries is not None else 0
+        prefix = []
+        for i, record in enumerate(records):
+            if not (i < excess or (cutoff is not None and record[1] < cutoff)):
+                break
+            prefix.append(record)
+        return prefix
+
+
+def _archive(username, records):
+    """Appends folded records to the user's archive file before they leave the log."""
+    os.makedirs(ARCHIVE_DIR, exist_ok=True)
+    path = os.path.join(ARCHIVE_DIR, f"{username.encode().hex()}.jsonl")
+    with open(path, "a") as f:
+        for seq, ts, entry in records:
+            f.write(json.dumps({"seq": seq, "ts": ts, "entry": entry}) + "\n")
+        f.flush()
+        os.fsync(f.fileno())
+
+
+def fold_records(records, public_key, policy):
+    """Folds money entries into one encrypted checkpoint per period.
+
+    Existing checkpoints in the range are merged with new totals of the same
+    period; bulk credits count as received and bulk debits as sent. Other
+    entry types are only archived. Returns (drop_through,
+    replacements) in the form HistoryLog.compact() expects.
+    """
+    key = homomorphic.as_public_key(public_key)
+    checkpoints = {}
+    amounts = defaultdict(list)
+    for seq, ts, entry in records:
+        if entry["type"] == "checkpoint":
+            period = entry["period"]
+        elif entry["type"] in MONEY_TYPES:
+            period = datetime.fromtimestamp(ts).strftime(policy.period)
+        else:
+            continue
+        checkpoint = checkpoints.setdefault(period, [seq, ts, {
+            "time": entry.get("time"), "type": "checkpoint", "period": period,
+            "sent": None, "sent_count": 0, "received": None, "received_count": 0}])
+        checkpoint[0], checkpoint[1] = max(checkpoint[0], seq), max(checkpoint[1], ts)
+        total = checkpoint[2]
+        if entry["type"] == "checkpoint":
+            parts = [("sent", entry["sent"], entry["sent_count"]),
+                     ("received", entry["received"], entry["received_count"])]
+        elif entry["type"] == "send money" or entry.get("op") == "debit":
+            parts = [("sent", entry["amount"], 1)]
+        else:
+            parts = [("received", entry["amount"], 1)]
+        for field, amount, count in parts:
+            if amount is None:
+                continue
+            amounts[period, field].append(codec.decode(amount))
+            total[f"{field}_count"] += count
+    for (period, field), ciphertexts in amounts.items():
+        checkpoints[period][2][field] = codec.encode(homomorphic.sum_ciphertexts(key, ciphertexts), key)
+    return records[-1][0], [tuple(c) for c in checkpoints.values()]
+
+
+def checkpoint_user(username, policy=None, history=None):
+    """Folds one user's old history into checkpoints; returns the number of records folded."""
+    policy = policy or CheckpointPolicy()
+    history = history or history_log.get_log()
+    account = storage.get_store().get(username)
+    if account is None:
+        return 0
+    folded = []
+
+    def folder(records, total):
+        prefix = policy.foldable(records, total)
+        # Folding a lone checkpoint into itself would only rewrite the log.
+        if not prefix or all(r[2]["type"] == "checkpoint" for r in prefix):
+            return None
+        _archive(username, [r for r in prefix if r[2]["type"] != "checkpoint"])
+        folded.extend(prefix)
+        return fold_records(prefix, account["public_key"], policy)
+
+    history.fold(username, folder)
+    return len(folded)
+
+
+class CheckpointJob:
+    """Background thread that checkpoints every user's history, one user at a time."""
+
+    def __init__(self, policy=None, interval=INTERVAL, history=None):
+        self.policy = policy or CheckpointPolicy()
+        self.interval = interval
+        self.history = history
+        self._stop = threading.Event()
+        self._thread = threading.Thread(target=self._run, daemon=True)
+
+    def start(self):
+        self._thread.start()
+        return self
+
+    def stop(self):
+        self._stop.set()
+
+    def run_once(self):
+        history = self.history or history_log.get_log()
+        folded = 0
+        for username in history.usernames():
+            if self._stop.is_set():
+                break
+            try:
+                folded += checkpoint_user(username, self.policy, history)
+            except (OSError, ValueError, KeyError) as exc:
+                print(f"Checkpointing history of {username} failed: {exc}")
+            self._stop.wait(USER_PAUSE)
+        return folded
+
+    def _run(self):
+        while not self._stop.is_set():
+            self.run_once()
+            self._stop.wait(self.interval)
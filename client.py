@@ -1,113 +1,428 @@
+import csv
+import io
 import json
+import queue
 import socket
-from homomorphic import Paillier
+import os
+import threading
+import protocol
+import workers
+from concurrent.futures import Future
+from homomorphic import decrypt_many, encrypt_grouped, get_engine
 import utils
+import codec
+from key_ring import get_key_ring
+from key_pool import get_key_pool
 
-BUFFER_SIZE = 1024 * 10
+HISTORY_PAGE = 500
+EXPORT_QUEUE = 4                # decrypted history pages waiting for the export writer
+EXPORT_FORMATS = ("json", "jsonl", "csv")
+CSV_FIELDS = ["time", "type", "amount", "balance", "sender", "receiver",
+              "period", "sent", "sent_count", "received", "received_count"]
+CPU_WORKERS = os.cpu_count()    # processes used to encrypt batch transfers
+TRANSFER_ATTEMPTS = 3           # tries when the server reports the cached balance is stale
+REPLICA_PORT = int(os.environ.get("WALLET_REPLICA_PORT", "0"))   # read replica to send reads to; 0 reads from the server
 
-def check_balance(client_socket, username):
-    request = {"request": "balance", "username": username}
-    private_key = utils.load_private_key(username)
-    
-    client_socket.sendall(json.dumps(request).encode())
-    response = json.loads(client_socket.recv(BUFFER_SIZE).decode())
-    
-    decrypted_balance = Paillier().decrypt(response["balance"], private_key)
-    return int(decrypted_balance)
 
-def send_money(client_socket, username):
-    public_key = utils.load_public_key(username)
+class BalanceCache:
+    """Last known plaintext balance of each logged-in user, with its server version.
+
+    The version is the server's fingerprint of the encrypted balance, so a
+    cached balance can be checked with a balance_version request instead of
+    fetching and decrypting the ciphertext.
+    """
+
+    def __init__(self):
+        self._balances = {}
+
+    def get(self, username):
+        """Returns (version, balance), or None if nothing is cached."""
+        return self._balances.get(username)
+
+    def set(self, username, version, balance):
+        self._balances[username] = (version, balance)
+
+    def drop(self, username):
+        self._balances.pop(username, None)
+
+balances = BalanceCache()
+
+def _copy_result(source, target):
+    if source.exception() is not None:
+        target.set_exception(source.exception())
+    else:
+        target.set_result(source.result())
+
+class ReadRouter:
+    """Sends balance and history reads to a read replica and everything else to the server.
+
+    The server's responses carry the change-log position ("lsn") it had
+    reached; reads pass the highest one seen as min_lsn, so the replica
+    answers only once it has this client's own writes. Reads the replica
+    refuses as "lagging", or cannot answer, are retried on the server.
+    """
+
+    READS = ("balance", "balance_version", "history")
+
+    def __init__(self, primary, replica):
+        self.primary = primary
+        self.replica = replica
+        self.defaults = replica.defaults = primary.defaults
+        self.lsn = 0
+
+    def _seen(self, future):
+        if future.exception() is None:
+            self.lsn = max(self.lsn, future.result().get("lsn") or 0)
+
+    def _submit_primary(self, request):
+        future = self.primary.submit(request)
+        future.add_done_callback(self._seen)
+        return future
+
+    def submit(self, request):
+        if request.get("request") not in self.READS:
+            return self._submit_primary(request)
+        result = Future()
+
+        def answered(done):
+            if done.exception() is None and done.result()["status"] != "lagging":
+                result.set_result(done.result())
+            else:
+                self._submit_primary(request).add_done_callback(lambda f: _copy_result(f, result))
+
+        self.replica.submit(dict(request, min_lsn=self.lsn)).add_done_callback(answered)
+        return result
+
+    def call(self, request, timeout=None):
+        return self.submit(request).result(timeout)
+
+def fetch_balance(server_conn, username, pending=None):
+    """Fetches and decrypts a user's balance and caches it; returns (version, balance).
+
+    pending may be a Future for a balance request that is already in flight.
+    """
+    response = pending.result() if pending else server_conn.call({"request": "balance", "username": username})
+    balance = int(get_key_ring().private_key(username).decrypt(codec.decode(response["balance"])))
+    balances.set(username, response["version"], balance)
+    return response["version"], balance
+
+def check_balance(server_conn, username):
+    cached = balances.get(username)
+    if cached is not None:
+        response = server_conn.call({"request": "balance_version", "username": username})
+        if response.get("version") == cached[0]:
+            return cached[1]
+    return fetch_balance(server_conn, username)[1]
+
+def fetch_public_keys(third_party_conn, usernames):
+    """Fetches many users' public keys from the key vault in one round trip."""
+    response = third_party_conn.call({"type": "acquire_keys", "usernames": list(usernames)})
+    return {u: codec.decode_key(key) for u, key in response.get("public_keys", {}).items()}
+
+def receiver_public_keys(third_party_conn, usernames):
+    """Returns {username: PaillierPublicKey}, served from the key ring where possible.
+
+    Without a vault connection only keys already in the local key ring are known.
+    Users without a known key are left out of the result.
+    """
+    ring = get_key_ring()
+    if third_party_conn is None:
+        return {u: ring.public_key(u) for u in usernames if ring.public_key(u) is not None}
+    return ring.receiver_keys(usernames, lambda missing: fetch_public_keys(third_party_conn, missing))
+
+def send_money(server_conn, username, third_party_conn=None):
+    public_key = get_key_ring().public_key(username)
     
     receiver = input("Receiver: ").strip()
     amount = int(input("Amount to transfer: "))
     
-    balance = check_balance(client_socket, username)
-    if balance < amount:
-        print('Not enough balance')
+    # Without a cached balance, keep the balance request in flight while the amounts are encrypted.
+    cached = balances.get(username)
+    pending_balance = None if cached else server_conn.submit({"request": "balance", "username": username})
+    recv_keys = receiver_public_keys(third_party_conn, [receiver])
+    if receiver not in recv_keys:
+        if pending_balance:
+            pending_balance.result()
+        print(f"No public key for {receiver}")
         return
+    recv_enc_amount = recv_keys[receiver].encrypt(amount)
+    send_enc_amount = public_key.encrypt(amount)
+
+    for _ in range(TRANSFER_ATTEMPTS):
+        if cached and cached[1] < amount:
+            cached = None   # credits may have arrived since the balance was cached
+        version, balance = cached or fetch_balance(server_conn, username, pending_balance)
+        if balance < amount or balance < 0:
+            print('Not enough balance')
+            return
+        
+        request = {"request": "transfer", "sender": username, "receiver": receiver, "receiver_encrypted_amount": codec.encode(recv_enc_amount, recv_keys[receiver]), "sender_encrypted_amount": codec.encode(send_enc_amount, public_key), "expected_version": version}
+                        
+        response = server_conn.call(request)
+        if response["status"] != "stale":
+            break
+        cached = pending_balance = None
     
-    recv_pub_key = utils.load_public_key(receiver)
-    recv_enc_amount = Paillier().encrypt(amount, recv_pub_key)
-    send_enc_amount = Paillier().encrypt(amount, public_key)
-    request = {"request": "transfer", "sender": username, "receiver": receiver, "receiver_encrypted_amount": int(recv_enc_amount), "sender_encrypted_amount": int(send_enc_amount)}
-                    
-    client_socket.sendall(json.dumps(request).encode())
-    response = json.loads(client_socket.recv(BUFFER_SIZE).decode())
-    
+    if response["status"] == "success":
+        balances.set(username, response["version"], balance - amount)
     print("Server:", response)
     
-def download_history(client_socket, username):
-    request = {"request": "history", "username": username}
-    
-    client_socket.sendall(json.dumps(request).encode())
-    response = json.loads(client_socket.recv(BUFFER_SIZE).decode())
-    
-    request = {"request": "history", "username": username}
-    client_socket.sendall(json.dumps(request).encode())
-    response = json.loads(client_socket.recv(BUFFER_SIZE).decode())
+def send_batch(server_conn, username, transfers, third_party_conn=None, expected_version=None):
+    """Sends many (receiver, amount) transfers from one account in a single request.
+
+    Receivers' public keys are fetched in one vault request, and amounts are
+    grouped by key and encrypted in parallel across the worker pool. With
+    expected_version the server refuses the batch if the balance has changed.
+    """
+    public_key = tuple(utils.serialize_key(get_key_ring().public_key(username)))
+    receiver_keys = receiver_public_keys(third_party_conn, [receiver for receiver, _ in transfers])
+    groups, slots = {}, []
+    for receiver, amount in transfers:
+        if receiver not in receiver_keys:
+            return {"status": "error", "message": f"No public key for {receiver}"}
+        pair = []
+        for key in (tuple(utils.serialize_key(receiver_keys[receiver])), public_key):
+            groups.setdefault(key, []).append(amount)
+            pair.append((key, len(groups[key]) - 1))
+        slots.append(pair)
+    ciphertexts = encrypt_grouped(groups)
+
+    request = {"request": "batch_transfer", "sender": username, "expected_version": expected_version, "transfers": [
+        {"receiver": receiver, "receiver_encrypted_amount": codec.encode(ciphertexts[rkey][ri], rkey),
+         "sender_encrypted_amount": codec.encode(ciphertexts[skey][si], skey)}
+        for (receiver, _), ((rkey, ri), (skey, si)) in zip(transfers, slots)]}
+    return server_conn.call(request)
+
+def batch_transfer(server_conn, username, third_party_conn=None):
+    path = input("CSV file with receiver,amount lines: ").strip()
+    with open(path, "r") as f:
+        transfers = [(receiver.strip(), int(amount)) for receiver, amount in
+                     (line.split(",") for line in f if line.strip())]
+
+    total = sum(amount for _, amount in transfers)
+    for _ in range(TRANSFER_ATTEMPTS):
+        balance = check_balance(server_conn, username)
+        if balance < total or balance < 0:
+            print('Not enough balance')
+            return
+        response = send_batch(server_conn, username, transfers, third_party_conn, balances.get(username)[0])
+        if response["status"] != "stale":
+            break
+        balances.drop(username)
 
     if response["status"] == "success":
-        history = response["transactions"]
-        private_key = utils.load_private_key(username)
+        balances.set(username, response["version"], balance - total)
+    print("Server:", response)
 
-        for entry in history:
-            if entry["type"] in ["balance_check"]:
-                entry["balance"] = Paillier().decrypt(entry["balance"], private_key)
-            elif entry["type"] in ["receive money", "send money"]:
-                entry["amount"] = Paillier().decrypt(entry["amount"], private_key)
-                
-        with open(f"{username}_history.json", "w") as history_file:
-            json.dump(history, history_file, indent=4)
+def decrypt_entries(private_key, entries):
+    """Decrypts the ciphertext fields of history entries in place, as one batch across the worker pool."""
+    encrypted = []
+    for entry in entries:
+        if entry["type"] in ["balance_check"]:
+            encrypted.append((entry, "balance"))
+        elif entry["type"] in ["receive money", "send money", "adjustment"]:
+            encrypted.append((entry, "amount"))
+        elif entry["type"] == "checkpoint":
+            for field in ("sent", "received"):
+                if entry[field] is not None:
+                    encrypted.append((entry, field))
+    plaintexts = decrypt_many(private_key, [codec.decode(entry[field]) for entry, field in encrypted])
+    for (entry, field), value in zip(encrypted, plaintexts):
+        entry[field] = value
+    return entries
 
-        print(f"Transaction history saved to {username}_history.json")
+class HistoryFile:
+    """Appends decrypted history pages to a JSON Lines, CSV or JSON array file.
 
-    else:
-        print("Error fetching transaction history:", response.get("message"))
-    
-def login(third_party_socket, username, password):
+    After every page the file length, the cursor of the next page and
+    whether that was the last page ("done") are saved to <path>.cursor.
+    Opening a file that still has one truncates it to that length, so an
+    interrupted export resumes without duplicates; a done one only needs
+    finish().
+    """
+
+    def __init__(self, path, fmt):
+        if fmt not in EXPORT_FORMATS:
+            raise ValueError(f"Unknown export format: {fmt}")
+        self.path = path
+        self.fmt = fmt
+        self.state_path = path + ".cursor"
+        try:
+            with open(self.state_path, "r") as f:
+                self.state = json.load(f)
+        except (FileNotFoundError, json.JSONDecodeError):
+            self.state = None
+        if self.state is not None and os.path.exists(path):
+            self.file = open(path, "r+b")
+            self.file.seek(self.state["offset"])
+            self.file.truncate()
+        else:
+            self.state = {"cursor": None, "offset": 0, "count": 0, "done": False}
+            self.file = open(path, "wb")
+            self.file.write({"json": b"[", "jsonl": b"", "csv": self._csv_rows([dict(zip(CSV_FIELDS, CSV_FIELDS))])}[fmt])
+
+    @property
+    def cursor(self):
+        return self.state["cursor"]
+
+    @property
+    def done(self):
+        return self.state.get("done", False)
+
+    def _csv_rows(self, entries):
+        buffer = io.StringIO()
+        writer = csv.DictWriter(buffer, CSV_FIELDS, extrasaction="ignore")
+        writer.writerows(entries)
+        return buffer.getvalue().encode()
+
+    def write_page(self, entries, next_cursor):
+        if self.fmt == "csv":
+            data = self._csv_rows(entries)
+        elif self.fmt == "jsonl":
+            data = "".join(json.dumps(entry) + "\n" for entry in entries).encode()
+        else:
+            first = ",\n" if self.state["count"] else "\n"
+            data = (first + ",\n".join(json.dumps(entry) for entry in entries)).encode() if entries else b""
+        self.file.write(data)
+        self.file.flush()
+        os.fsync(self.file.fileno())
+        self.state = {"cursor": next_cursor, "offset": self.file.tell(), "count": self.state["count"] + len(entries),
+                      "done": next_cursor is None}
+        utils.atomic_write_json(self.state_path, self.state)
+
+    def finish(self):
+        if self.fmt == "json":
+            self.file.write(b"\n]\n")
+        self.file.close()
+        if os.path.exists(self.state_path):
+            os.remove(self.state_path)
+
+    def close(self):
+        self.file.close()
+
+def export_history(server_conn, username, path=None, fmt="jsonl", page=HISTORY_PAGE):
+    """Streams a user's decrypted history to a file; returns the number of entries written.
+
+    Fetching, decrypting and writing overlap: the next page is requested as
+    soon as one arrives, each page is decrypted across the worker pool, and
+    a writer thread appends finished pages, with at most EXPORT_QUEUE of them
+    waiting. Memory therefore stays at a few pages whatever the history
+    length. If the export stops part way, calling it again resumes at the
+    last written page (see HistoryFile).
+    """
+    path = path or f"{username}_history.{fmt}"
+    out = HistoryFile(path, fmt)
+    if out.done:
+        # Every page was written before the last run stopped; only the closing is missing.
+        out.finish()
+        return out.state["count"]
+    private_key = get_key_ring().private_key(username)
+    pages = queue.Queue(maxsize=EXPORT_QUEUE)
+    failure = []
+
+    def write_pages():
+        while True:
+            item = pages.get()
+            if item is None:
+                return
+            if not failure:
+                try:
+                    out.write_page(*item)
+                except OSError as exc:
+                    failure.append(exc)
+
+    writer = threading.Thread(target=write_pages, daemon=True)
+    writer.start()
+
+    def request(cursor):
+        return server_conn.submit({"request": "history", "username": username, "cursor": cursor,
+                                   "limit": page, "compress": True})
+
+    response, completed = None, False
+    try:
+        pending = request(out.cursor)
+        while pending is not None:
+            response = pending.result()
+            if response["status"] != "success":
+                break
+            next_cursor = response.get("next_cursor")
+            pending = request(next_cursor) if next_cursor is not None else None
+            if "transactions_zlib" in response:
+                entries = codec.decompress(response["transactions_zlib"])
+            else:
+                entries = response["transactions"]
+            pages.put((decrypt_entries(private_key, entries), next_cursor))
+        completed = response["status"] == "success"
+    finally:
+        pages.put(None)
+        writer.join()
+        if failure or not completed:
+            out.close()
+    if failure:
+        raise failure[0]
+    if response["status"] != "success":
+        raise ConnectionError(response.get("message", "Transaction history not available."))
+    out.finish()
+    return out.state["count"]
+
+def download_history(server_conn, username):
+    path = f"{username}_history.json"
+    try:
+        export_history(server_conn, username, path, fmt="json")
+    except (OSError, ConnectionError) as exc:
+        print("Error fetching transaction history:", exc)
+        return
+    print(f"Transaction history saved to {path}")
+
+def login(third_party_conn, username, password):
     request = {
         "type": "acquire_keys",
         "username": username
     }
-    third_party_socket.sendall(json.dumps(request).encode())
-    response = json.loads(third_party_socket.recv(BUFFER_SIZE).decode())
-    public_key = response["public_key"]
-    private_key = response["private_key"]
+    response = third_party_conn.call(request)
+    public_key = codec.decode_key(response["public_key"])
+    private_key = codec.decode_key(response["private_key"])
     request = {"request": "login", "username": username, "password": password}
     return public_key, private_key, request
     
-def signup(third_party_socket, username, password):
+def signup(third_party_conn, username, password):
     balance = int(input("Enter balance: "))
-    p = Paillier()
-    public_key, private_key = p.generate_keys()
+    public_key, private_key = get_key_pool().take()
 
     request = {
         "type": "store_keys",
         "username": username,
-        "private_key": [int(private_key[0]), int(private_key[1]), int(private_key[2])],
-        "public_key": [int(public_key[0]), int(public_key[1])]
+        "private_key": codec.encode_key(private_key),
+        "public_key": codec.encode_key(public_key)
     }
-    third_party_socket.sendall(json.dumps(request).encode())
-    response = json.loads(third_party_socket.recv(BUFFER_SIZE).decode())
+    response = third_party_conn.call(request)
     print("Third party:", response)
     
     request = {
         "request": "signup",
         "username": username,
         "password": password,
-        "balance": int(p.encrypt(balance, public_key)),
+        "balance": codec.encode(public_key.encrypt(balance), public_key),
         "public_key": (int(public_key[0]), int(public_key[1]))
     }
     
     return public_key, private_key, request
     
-def start_client(host="127.0.0.1", port=65432):
+def start_client(host="127.0.0.1", port=65432, replica_port=REPLICA_PORT):
     """Handles client communication."""
     try:
         with socket.socket(socket.AF_INET, socket.SOCK_STREAM) as client_socket, \
             socket.socket(socket.AF_INET, socket.SOCK_STREAM) as third_party_socket:
             client_socket.connect((host, port))
             third_party_socket.connect((host, port-1))
+            server_conn = protocol.Client(client_socket)
+            third_party_conn = protocol.Client(third_party_socket)
+            server_conn.defaults["codec"] = third_party_conn.defaults["codec"] = codec.VERSION
+            if replica_port:
+                replica_conn = protocol.Client(socket.create_connection((host, replica_port)))
+                server_conn = ReadRouter(server_conn, replica_conn)
+            workers.configure(CPU_WORKERS)
+            get_key_pool().start()
             
             while True:
                 option = input("Choose one option:\n1. Login\n2. Signup\n").strip()
@@ -115,30 +430,44 @@ def start_client(host="127.0.0.1", port=65432):
                 password = input("Enter Password: ").strip()
 
                 if option == "2":
-                    public_key, private_key, request = signup(third_party_socket, username, password)
+                    public_key, private_key, request = signup(third_party_conn, username, password)
                 else:
-                    public_key, private_key, request = login(third_party_socket, username, password)
+                    public_key, private_key, request = login(third_party_conn, username, password)
                     
-                client_socket.sendall(json.dumps(request).encode())
-                response = json.loads(client_socket.recv(BUFFER_SIZE).decode())
+                response = server_conn.call(request)
                 print("Server:", response)
 
                 if response["status"] == "success":
-                    utils.save_keys(username, [int(private_key[0]), int(private_key[1]), int(private_key[2])], [int(public_key[0]), int(public_key[1])])
+                    server_conn.defaults["token"] = response["token"]
+                    get_key_ring().save(username, private_key, public_key)
+                    get_engine(public_key)  # start filling the randomness pool while the menu is up
                     while True:
-                        option = input("Menu:\n1.Send Money\n2.Check balance\n3.Transaction History\n4.Log out\nChoose one option: ").strip()
+                        option = input("Menu:\n1.Send Money\n2.Check balance\n3.Transaction History\n4.Batch Transfer\n5.Export History\n6.Log out\nChoose one option: ").strip()
                         if option == "1":
-                            send_money(client_socket, username)
+                            send_money(server_conn, username, third_party_conn)
                         elif option == "2":
-                            balance = check_balance(client_socket, username)     
+                            balance = check_balance(server_conn, username)     
                             print("Your Balance:", balance)
                         elif option == "3":
-                            download_history(client_socket, username)
+                            download_history(server_conn, username)
+                        elif option == "4":
+                            batch_transfer(server_conn, username, third_party_conn)
+                        elif option == "5":
+                            fmt = input("Format (jsonl/csv): ").strip() or "jsonl"
+                            try:
+                                count = export_history(server_conn, username, fmt=fmt)
+                                print(f"Exported {count} entries to {username}_history.{fmt}")
+                            except (OSError, ConnectionError, ValueError) as exc:
+                                print("Export stopped, run it again to resume:", exc)
                         else:
+                            server_conn.call({"request": "logout", "username": username})
+                            server_conn.defaults.pop("token", None)
                             break
                     
     except ConnectionRefusedError:
         print("Failed to connect to server. Is it running?")
+    finally:
+        get_key_ring().close()
 
 if __name__ == "__main__":
     start_client()
\ No newline at end of file
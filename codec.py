@@ -0,0 +1,82 @@
+import base64
+import json
+import zlib
+
+VERSION = 2      # ciphertexts as base64 of fixed-width big-endian bytes
+LEGACY = 1       # ciphertexts as decimal JSON integers
+CIPHERTEXT_FIELDS = ("balance", "amount", "sent", "received")   # history/account fields holding ciphertexts
+
+
+def width(public_key):
+    """Byte length of a ciphertext under public_key (that of n², i.e. 2·|n|)."""
+    n = decode(public_key[0])
+    return 2 * ((n.bit_length() + 7) // 8)
+
+
+def pack(value, size=None):
+    """Returns value as big-endian bytes, padded to size when given."""
+    value = int(value)
+    return value.to_bytes(size or max(1, (value.bit_length() + 7) // 8), "big")
+
+
+def unpack(data):
+    return int.from_bytes(data, "big")
+
+
+def encode(value, public_key=None):
+    """Encodes a ciphertext (or key component) as a base64 string.
+
+    With public_key the bytes are fixed-width for that key, so every
+    ciphertext under one key has the same encoded length.
+    """
+    return base64.b64encode(pack(value, width(public_key) if public_key is not None else None)).decode()
+
+
+def decode(value):
+    """Returns the int behind an encoded string or a legacy decimal integer."""
+    if isinstance(value, str):
+        return unpack(base64.b64decode(value))
+    return int(value)
+
+
+def encode_key(key):
+    return [encode(x) for x in key]
+
+
+def decode_key(key):
+    return [decode(x) for x in key]
+
+
+def negotiate(request):
+    """Returns the encoding to answer a request in: the client's "codec", capped at VERSION."""
+    try:
+        return max(LEGACY, min(VERSION, int(request.get("codec", LEGACY))))
+    except (TypeError, ValueError):
+        return LEGACY
+
+
+def for_wire(value, version):
+    """Converts a stored ciphertext to the representation a client negotiated."""
+    if version >= VERSION:
+        return value if isinstance(value, str) else encode(value)
+    return decode(value)
+
+
+def entry_for_wire(entry, version):
+    """Converts the ciphertext fields of a history entry for a client."""
+    fields = [f for f in CIPHERTEXT_FIELDS if entry.get(f) is not None]
+    if not fields:
+        return entry
+    entry = dict(entry)
+    for field in fields:
+        entry[field] = for_wire(entry[field], version)
+    return entry
+
+
+def compress(obj):
+    """JSON-encodes and zlib-compresses obj into a base64 string."""
+    return base64.b64encode(zlib.compress(json.dumps(obj, separators=(",", ":")).encode())).decode()
+
+
+def decompress(text):
+    return json.loads(zlib.decompress(base64.b64decode(text)))
@@ -0,0 +1,320 @@
+import json
+import os
+import struct
+import threading
+import time
+from array import array
+from bisect import bisect_left, bisect_right
+
+HISTORY_DIR = "history"
+SEGMENT_BYTES = 1 << 20        # rotate a user's active segment past this size
+COMPACT_MIN_SEGMENTS = 8       # sealed segments before a rotation merges them
+INDEX_RECORD = struct.Struct(">QQd")   # seq, byte offset in the segment, timestamp
+
+
+class Segment:
+    """One <base_seq>.log file of JSON lines plus its .idx offset index."""
+
+    def __init__(self, directory, base_seq):
+        self.base_seq = base_seq
+        self.log_path = os.path.join(directory, f"{base_seq:020d}.log")
+        self.idx_path = os.path.join(directory, f"{base_seq:020d}.idx")
+        self.seqs = array("Q")
+        self.offsets = array("Q")
+        self.times = array("d")
+        self.size = 0
+
+    def load_index(self):
+        """Loads the .idx file, rebuilding it from the log if it is missing or stale."""
+        self.size = os.path.getsize(self.log_path) if os.path.exists(self.log_path) else 0
+        try:
+            with open(self.idx_path, "rb") as f:
+                data = f.read()
+        except FileNotFoundError:
+            data = b""
+        data = data[:len(data) - len(data) % INDEX_RECORD.size]
+        for seq, offset, ts in INDEX_RECORD.iter_unpack(data):
+            self.seqs.append(seq)
+            self.offsets.append(offset)
+            self.times.append(ts)
+        if not self._index_matches_log():
+            self.rebuild_index()
+
+    def _index_matches_log(self):
+        if not self.seqs:
+            return self.size == 0
+        with open(self.log_path, "rb") as f:
+            f.seek(self.offsets[-1])
+            line = f.readline()
+            end = f.tell()
+        try:
+            return line.endswith(b"\n") and json.loads(line)["seq"] == self.seqs[-1] and end == self.size
+        except (ValueError, KeyError):
+            return False
+
+    def rebuild_index(self):
+        """Rescans the log, dropping a torn last line, and rewrites the .idx file."""
+        self.seqs, self.offsets, self.times = array("Q"), array("Q"), array("d")
+        offset = 0
+        if os.path.exists(self.log_path):
+            with open(self.log_path, "rb") as f:
+                for line in f:
+                    try:
+                        record = json.loads(line)
+                    except ValueError:
+                        break
+                    if not line.endswith(b"\n"):
+                        break
+                    self.seqs.append(record["seq"])
+                    self.offsets.append(offset)
+                    self.times.append(record["ts"])
+                    offset += len(line)
+            with open(self.log_path, "r+b") as f:
+                f.truncate(offset)
+        self.size = offset
+        with open(self.idx_path, "wb") as f:
+            for i in range(len(self.seqs)):
+                f.write(INDEX_RECORD.pack(self.seqs[i], self.offsets[i], self.times[i]))
+
+    def read_from(self, position):
+        """Yields (seq, ts, entry) starting at the position-th record of this segment."""
+        if position >= len(self.seqs):
+            return
+        with open(self.log_path, "rb") as f:
+            f.seek(self.offsets[position])
+            for _ in range(len(self.seqs) - position):
+                record = json.loads(f.readline())
+                yield record["seq"], record["ts"], record["entry"]
+
+    def remove(self):
+        for path in (self.log_path, self.idx_path):
+            if os.path.exists(path):
+                os.remove(path)
+
+
+class UserLog:
+    """Append-only, segmented transaction log of a single user."""
+
+    def __init__(self, directory):
+        self.directory = directory
+        self.lock = threading.Lock()
+        os.makedirs(directory, exist_ok=True)
+        bases = sorted(int(name[:-4]) for name in os.listdir(directory) if name.endswith(".log"))
+        self.segments = []
+        for base in bases:
+            segment = Segment(directory, base)
+            segment.load_index()
+            # A segment whose records are already covered by the previous one is
+            # a leftover from a compaction that crashed before deleting it.
+            if self.segments and self.segments[-1].seqs and segment.base_seq <= self.segments[-1].seqs[-1]:
+                segment.remove()
+                continue
+            self.segments.append(segment)
+        last = self.segments[-1] if self.segments else None
+        self.next_seq = last.seqs[-1] + 1 if last is not None and last.seqs else (last.base_seq if last else 0)
+        self.last_ts = last.times[-1] if last is not None and last.times else 0.0
+
+    def append(self, entry):
+        """Appends one entry and returns its sequence number.
+
+        Rotating to a new segment merges the sealed ones once there are
+        COMPACT_MIN_SEGMENTS of them, which bounds a user's open segments.
+        """
+        active = self.segments[-1] if self.segments else None
+        if active is None or active.size >= SEGMENT_BYTES:
+            active = Segment(self.directory, self.next_seq)
+            self.segments.append(active)
+            if len(self.segments) - 1 >= COMPACT_MIN_SEGMENTS:
+                self.compact()
+        seq = self.next_seq
+        ts = self.last_ts = max(time.time(), self.last_ts)
+        line = (json.dumps({"seq": seq, "ts": ts, "entry": entry}) + "\n").encode()
+        with open(active.log_path, "ab") as f:
+            f.write(line)
+        with open(active.idx_path, "ab") as f:
+            f.write(INDEX_RECORD.pack(seq, active.size, ts))
+        active.seqs.append(seq)
+        active.offsets.append(active.size)
+        active.times.append(ts)
+        active.size += len(line)
+        self.next_seq += 1
+        return seq
+
+    def _locate(self, cursor, since):
+        """Returns (segment index, record position) of the first record to read."""
+        start = (0, 0)
+        if cursor:
+            i = max(bisect_right([s.base_seq for s in self.segments], cursor) - 1, 0)
+            start = max(start, (i, bisect_left(self.segments[i].seqs, cursor)))
+        if since is not None:
+            first_times = [s.times[0] if s.times else float("inf") for s in self.segments]
+            i = max(bisect_right(first_times, since) - 1, 0)
+            start = max(start, (i, bisect_left(self.segments[i].times, since)))
+        return start
+
+    def read(self, cursor=None, limit=None, since=None, until=None):
+        """Returns (entries, next_cursor) for the requested slice of the log."""
+        entries = []
+        if not self.segments:
+            return entries, None
+        first, position = self._locate(cursor, since)
+        for segment in self.segments[first:]:
+            for seq, ts, entry in segment.read_from(position):
+                if until is not None and ts > until:
+                    return entries, None
+                if limit is not None and len(entries) >= limit:
+                    return entries, seq
+                entries.append(entry)
+            position = 0
+        return entries, None
+
+    def count(self):
+        return sum(len(segment.seqs) for segment in self.segments)
+
+    def rotate(self):
+        """Seals the active segment so that its records can be compacted."""
+        if self.segments and self.segments[-1].seqs:
+            self.segments.append(Segment(self.directory, self.next_seq))
+
+    def compact(self, drop_through=None, replacements=()):
+        """Merges the sealed segments into one.
+
+        Records with seq <= drop_through are dropped and the (seq, ts, entry)
+        replacements are merged in, which lets callers fold old entries into
+        a summary. The active segment is left alone.
+        """
+        sealed = self.segments[:-1]
+        if not sealed:
+            return
+        records = [r for s in sealed for r in s.read_from(0)
+                   if drop_through is None or r[0] > drop_through]
+        records = sorted(records + list(replacements), key=lambda r: r[0])
+        if not records:
+            for segment in sealed:
+                segment.remove()
+            self.segments = self.segments[-1:]
+            return
+        merged = Segment(self.directory, sealed[0].base_seq)
+        tmp_log, tmp_idx = merged.log_path + ".tmp", merged.idx_path + ".tmp"
+        offset = 0
+        with open(tmp_log, "wb") as log_file, open(tmp_idx, "wb") as idx_file:
+            for seq, ts, entry in records:
+                line = (json.dumps({"seq": seq, "ts": ts, "entry": entry}) + "\n").encode()
+                log_file.write(line)
+                idx_file.write(INDEX_RECORD.pack(seq, offset, ts))
+                merged.seqs.append(seq)
+                merged.offsets.append(offset)
+                merged.times.append(ts)
+                offset += len(line)
+            log_file.flush()
+            os.fsync(log_file.fileno())
+        merged.size = offset
+        os.replace(tmp_log, merged.log_path)
+        os.replace(tmp_idx, merged.idx_path)
+        for segment in sealed[1:]:
+            segment.remove()
+        self.segments = [merged] + self.segments[-1:]
+
+
+class HistoryLog:
+    """Per-user transaction history stored as append-only segmented logs."""
+
+    def __init__(self, directory=HISTORY_DIR):
+        self.directory = directory
+        self._users = {}
+        self._users_lock = threading.Lock()
+        os.makedirs(directory, exist_ok=True)
+
+    def _user(self, username):
+        with self._users_lock:
+            log = self._users.get(username)
+            if log is None:
+                log = self._users[username] = UserLog(os.path.join(self.directory, username.encode().hex()))
+            return log
+
+    def has_user(self, username):
+        return os.path.isdir(os.path.join(self.directory, username.encode().hex()))
+
+    def usernames(self):
+        return [bytes.fromhex(name).decode() for name in os.listdir(self.directory)]
+
+    def append(self, username, entry):
+        log = self._user(username)
+        with log.lock:
+            return log.append(entry)
+
+    def append_many(self, items):
+        """Appends (username, entry) pairs, taking each user's lock once."""
+        by_user = {}
+        for username, entry in items:
+            by_user.setdefault(username, []).append(entry)
+        for username, entries in by_user.items():
+            log = self._user(username)
+            with log.lock:
+                for entry in entries:
+                    log.append(entry)
+
+    def read(self, username, cursor=None, limit=None, since=None, until=None):
+        """Returns (entries, next_cursor); next_cursor is None once the slice is exhausted."""
+        if not self.has_user(username):
+            return [], None
+        log = self._user(username)
+        with log.lock:
+            return log.read(cursor, limit, since, until)
+
+    def compact(self, username, drop_through=None, replacements=(), min_segments=COMPACT_MIN_SEGMENTS):
+        """Merges a user's sealed segments once there are at least min_segments of them."""
+        log = self._user(username)
+        with log.lock:
+            if len(log.segments) - 1 >= min_segments or drop_through is not None:
+                log.compact(drop_through, replacements)
+
+    def fold(self, username, folder):
+        """Rewrites the oldest part of a user's log.
+
+        folder(records, total) gets the user's (seq, ts, entry) records, oldest
+        first, plus their count, and returns (drop_through, replacements) for
+        compact(), or None to leave the log alone. The active segment is
+        sealed first if drop_through reaches into it.
+        """
+        if not self.has_user(username):
+            return
+        log = self._user(username)
+        with log.lock:
+            records = (r for segment in log.segments for r in segment.read_from(0))
+            result = folder(records, log.count())
+            if result is None:
+                return
+            active = log.segments[-1]
+            if active.seqs and result[0] >= active.seqs[0]:
+                log.rotate()
+            log.compact(*result)
+
+    def import_legacy(self, path):
+        """Moves entries from a legacy history.json into the log, then renames the file."""
+        try:
+            with open(path, "r") as f:
+                legacy = json.load(f)
+        except (FileNotFoundError, json.JSONDecodeError):
+            return
+        self.append_many((username, entry) for username, entries in legacy.items()
+                         if not self.has_user(username) for entry in entries)
+        os.replace(path, path + ".imported")
+
+
+_log = None
+_log_lock = threading.Lock()
+
+def get_log():
+    """Returns the process-wide history log, opening it on first use."""
+    global _log
+    with _log_lock:
+        if _log is None:
+            _log = HistoryLog()
+        return _log
+
+def set_log(log):
+    """Replaces the process-wide history log (e.g. with one that publishes its appends)."""
+    global _log
+    with _log_lock:
+        _log = log
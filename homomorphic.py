@@ -1,40 +1,433 @@
-import random
+import secrets
+import threading
+from functools import lru_cache
+from collections import OrderedDict, deque
 import gmpy2
+import workers
+
+POOL_SIZE = 64      # precomputed r^n values kept per public key
+MAX_ENGINES = 32    # encryption engines (and refill threads) kept alive at once
+MIN_CHUNK = 32      # smallest slice of a batch sent to one worker process
+
+class PaillierPublicKey:
+    """Paillier public key (n, g) with n² cached.
+
+    Indexes and iterates like the (n, g) tuple it replaces.
+    """
+
+    def __init__(self, n, g=None):
+        self.n = gmpy2.mpz(n)
+        self.g = gmpy2.mpz(g) if g is not None else self.n + 1
+        self.n_sq = self.n * self.n
+
+    def __getitem__(self, index):
+        return (self.n, self.g)[index]
+
+    def __iter__(self):
+        return iter((self.n, self.g))
+
+    def __len__(self):
+        return 2
+
+    def __eq__(self, other):
+        try:
+            return tuple(self) == tuple(other)
+        except TypeError:
+            return NotImplemented
+
+    def __hash__(self):
+        return hash((int(self.n), int(self.g)))
+
+    def encrypt(self, m):
+        if self.g == self.n + 1:
+            return get_engine(self).encrypt(m)
+        r = _random_unit(self.n)
+        return gmpy2.powmod(self.g, m, self.n_sq) * gmpy2.powmod(r, self.n, self.n_sq) % self.n_sq
+
+    def add(self, a, b):
+        """input: a, b : returns a + b"""
+        return a * b % self.n_sq
+
+    def subtract(self, a, b):
+        """input: a, b : returns a - b"""
+        return a * gmpy2.invert(b, self.n_sq) % self.n_sq  # Enc(a) * Enc(b)^(-1) mod n²
+
+
+class PaillierPrivateKey:
+    """Paillier private key in classic (λ, μ, n) or expanded CRT form.
+
+    Indexes and iterates like the key tuple it replaces.
+    """
+
+    def __init__(self, key):
+        self.key = tuple(gmpy2.mpz(x) for x in key)
+        self.lam, self.mu, self.n = self.key[:3]
+        self.n_sq = self.n * self.n
+
+    def __getitem__(self, index):
+        return self.key[index]
+
+    def __iter__(self):
+        return iter(self.key)
+
+    def __len__(self):
+        return len(self.key)
+
+    @property
+    def public_key(self):
+        return as_public_key((self.n, self.n + 1))
+
+    def decrypt(self, c):
+        """Returns the plaintext, read as negative above n/2 (e.g. a balance debited past zero)."""
+        if len(self.key) > 3:
+            m = decrypt_crt(c, self.key)
+        else:
+            x = gmpy2.powmod(c, self.lam, self.n_sq) - 1
+            m = int((x // self.n) * self.mu % self.n)
+        return m - int(self.n) if m > self.n // 2 else m
+
+
+@lru_cache(maxsize=256)
+def _public_key(n, g):
+    return PaillierPublicKey(n, g)
+
+def as_public_key(key):
+    """Returns a (cached) PaillierPublicKey for a key object, tuple or JSON list."""
+    if isinstance(key, PaillierPublicKey):
+        return key
+    n, g = key
+    return _public_key(int(n), int(g))
+
+def as_private_key(key):
+    """Returns a PaillierPrivateKey for a key object, tuple or JSON list."""
+    if isinstance(key, PaillierPrivateKey):
+        return key
+    return PaillierPrivateKey(key)
+
+@lru_cache(maxsize=16)
+def _private_key(key):
+    return PaillierPrivateKey(key)
+
+def _random_unit(n):
+    """Returns a uniformly random r with 1 <= r < n from the OS CSPRNG."""
+    return secrets.randbelow(int(n) - 1) + 1
+
+def random_prime(bits):
+    """Returns a random prime of exactly bits bits, from the OS CSPRNG.
+
+    The top two bits are set, so the product of two such primes has exactly
+    2·bits bits.
+    """
+    while True:
+        candidate = secrets.randbits(bits) | (3 << (bits - 2)) | 1
+        prime = gmpy2.next_prime(candidate)
+        if prime.bit_length() == bits:
+            return int(prime)
+
+def generate_keypair(key_size=512, parallel=False):
+    """Generates a fresh (PaillierPublicKey, PaillierPrivateKey) pair.
+
+    p and q are key_size-bit primes, so n has exactly 2·key_size bits. With
+    parallel=True the two prime searches run on the workers process pool.
+    """
+    while True:
+        if parallel:
+            p, q = workers.map(random_prime, [key_size, key_size])
+        else:
+            p, q = random_prime(key_size), random_prime(key_size)
+        if p != q and (p * q).bit_length() == 2 * key_size:
+            break
+    private_key = PaillierPrivateKey(expand_private_key(p, q))
+    return private_key.public_key, private_key
+
 
 class Paillier:
+    """Compatibility shim for the old tuple-based API.
+
+    Keys are only generated when public_key/private_key are first read or
+    generate_keys() is called; all other methods delegate to the key objects.
+    """
+
     def __init__(self, key_size=512):
         self.key_size = key_size
-        self.public_key, self.private_key = self.generate_keys()
+        self._keys = None
+
+    @property
+    def public_key(self):
+        if self._keys is None:
+            self._keys = self.generate_keys()
+        return self._keys[0]
+
+    @property
+    def private_key(self):
+        if self._keys is None:
+            self._keys = self.generate_keys()
+        return self._keys[1]
 
     def generate_keys(self):
-        p = gmpy2.next_prime(random.getrandbits(self.key_size))
-        q = gmpy2.next_prime(random.getrandbits(self.key_size))
-        n = p * q
-        λ = (p - 1) * (q - 1) // gmpy2.gcd(p - 1, q - 1)
-        g = n + 1
-        μ = gmpy2.invert(λ, n)
-        return (n, g), (λ, μ, n)
+        public_key, private_key = generate_keypair(self.key_size)
+        return tuple(public_key), tuple(private_key)
 
     def encrypt(self, m, public_key):
-        n, g = public_key
-        r = random.randint(1, n - 1)
-        return (pow(g, m, n * n) * pow(r, n, n * n)) % (n * n)
-
+        return as_public_key(public_key).encrypt(m)
 
     def decrypt(self, c, private_key):
-        λ, μ, n = private_key
-        x = pow(c, λ, n * n) - 1
-        return int((x // n) * μ % n)
+        return as_private_key(private_key).decrypt(c)
 
     def homomorphic_addition(self, a, b, public_key):
         """input: a, b : returns a + b"""
-        return (a * b) % (public_key[0] ** 2)
+        return as_public_key(public_key).add(a, b)
 
     def homomorphic_subtraction(self, a, b, public_key):
         """input: a, b : returns a - b"""
-        n, _ = public_key
-        b_inv = gmpy2.invert(b, n * n)  # modular inverse of Enc(b)
-        return (a * b_inv) % (n * n)  # Enc(a) * Enc(b)^(-1) mod n²
+        return as_public_key(public_key).subtract(a, b)
+
+
+def apply_transfer(sender_key, sender_balance, debit, receiver_key, receiver_balance, credit):
+    """Returns the new (sender, receiver) encrypted balances of a transfer.
+
+    Takes and returns plain ints and key lists so it can run in a worker process.
+    """
+    sender_key, receiver_key = as_public_key(sender_key), as_public_key(receiver_key)
+    return (int(sender_key.subtract(sender_balance, debit)),
+            int(receiver_key.add(receiver_balance, credit)))
+
+
+def apply_batch_transfer(sender_key, sender_balance, debits, receivers):
+    """Returns the new sender balance and {receiver: new balance} of a batch.
+
+    The debits are multiplied into one ciphertext so the sender's balance
+    needs a single modular inverse. receivers maps each receiver to
+    (public key, balance, [credits]).
+    """
+    sender_key = as_public_key(sender_key)
+    total_debit = 1
+    for debit in debits:
+        total_debit = sender_key.add(total_debit, debit)
+    new_receiver_balances = {}
+    for receiver, (key, balance, credits) in receivers.items():
+        key = as_public_key(key)
+        for credit in credits:
+            balance = key.add(balance, credit)
+        new_receiver_balances[receiver] = int(balance)
+    return int(sender_key.subtract(sender_balance, total_debit)), new_receiver_balances
+
+
+def _encrypt_chunk(public_key, messages):
+    key = _public_key(*public_key)
+    if key.g != key.n + 1:
+        return [int(key.encrypt(m)) for m in messages]
+    n, n_sq = key.n, key.n_sq
+    return [int((1 + m * n) % n_sq * gmpy2.powmod(_random_unit(n), n, n_sq) % n_sq)
+            for m in messages]
+
+def _decrypt_chunk(private_key, ciphertexts):
+    key = _private_key(private_key)
+    return [key.decrypt(c) for c in ciphertexts]
+
+def _add_chunk(n_sq, pairs):
+    return [int(gmpy2.mpz(a) * b % n_sq) for a, b in pairs]
+
+def _sum_chunk(n_sq, ciphertexts):
+    total = gmpy2.mpz(1)
+    for c in ciphertexts:
+        total = total * c % n_sq
+    return int(total)
+
+def _adjust_chunk(op, items):
+    """Applies one bulk adjustment to (n, balance, operand) items; returns the new balances.
+
+    Plaintext credits and debits multiply by g^±a = 1 ± a·n (mod n²), which
+    needs no randomness or exponentiation since the amount is public anyway.
+    """
+    balances = []
+    for n, balance, operand in items:
+        n = gmpy2.mpz(n)
+        n_sq = n * n
+        if op == "credit":
+            balance = balance * (1 + operand * n) % n_sq
+        elif op == "debit":
+            balance = balance * ((1 - operand * n) % n_sq) % n_sq
+        elif op == "credit_ciphertext":
+            balance = gmpy2.mpz(balance) * operand % n_sq
+        elif op == "debit_ciphertext":
+            balance = balance * gmpy2.invert(operand, n_sq) % n_sq
+        else:
+            raise ValueError(f"Unknown adjustment: {op}")
+        balances.append(int(balance))
+    return balances
+
+def _run_chunked(fn, key, items, chunk_size=None):
+    """Applies fn(key, chunk) to slices of items, across the workers pool when there is more than one slice."""
+    items = list(items)
+    if chunk_size is None:
+        chunk_size = max(MIN_CHUNK, -(-len(items) // (4 * max(1, workers.size()))))
+    chunks = [items[i:i + chunk_size] for i in range(0, len(items), chunk_size)]
+    if len(chunks) <= 1:
+        return [fn(key, chunk) for chunk in chunks]
+    return workers.map(fn, [key] * len(chunks), chunks)
+
+def encrypt_many(public_key, messages, chunk_size=None):
+    """Encrypts a sequence of plaintexts; returns a list of ciphertext ints.
+
+    Large batches are split across the workers process pool. Each worker
+    keeps the key objects it has built, so constants such as n² are
+    computed once per key rather than once per call.
+    """
+    key = tuple(int(x) for x in public_key)
+    return [c for chunk in _run_chunked(_encrypt_chunk, key, messages, chunk_size) for c in chunk]
+
+def encrypt_grouped(groups, chunk_size=None):
+    """Encrypts {public key: [plaintexts]}; returns {public key: [ciphertext ints]}.
+
+    Like encrypt_many for several keys at once: every key's slices go to
+    the workers pool together, so many small groups still run in parallel.
+    """
+    groups = {tuple(int(x) for x in key): list(messages) for key, messages in groups.items()}
+    if chunk_size is None:
+        total = sum(len(messages) for messages in groups.values())
+        chunk_size = max(MIN_CHUNK, -(-total // (4 * max(1, workers.size()))))
+    keys, chunks = [], []
+    for key, messages in groups.items():
+        for i in range(0, len(messages), chunk_size):
+            keys.append(key)
+            chunks.append(messages[i:i + chunk_size])
+    results = {key: [] for key in groups}
+    for key, ciphertexts in zip(keys, workers.map(_encrypt_chunk, keys, chunks,
+                                                   chunksize=max(1, len(chunks) // (4 * max(1, workers.size()))))):
+        results[key] += ciphertexts
+    return results
+
+def decrypt_many(private_key, ciphertexts, chunk_size=None):
+    """Decrypts a sequence of ciphertexts (with CRT for expanded keys); returns a list of ints."""
+    key = tuple(int(x) for x in private_key)
+    return [m for chunk in _run_chunked(_decrypt_chunk, key, ciphertexts, chunk_size) for m in chunk]
+
+def add_many(public_key, a, b, chunk_size=None):
+    """Adds two sequences of ciphertexts element-wise; returns Enc(a[i] + b[i]) for each i."""
+    n_sq = int(as_public_key(public_key).n_sq)
+    return [c for chunk in _run_chunked(_add_chunk, n_sq, zip(a, b), chunk_size) for c in chunk]
+
+def sum_ciphertexts(public_key, ciphertexts, chunk_size=None):
+    """Returns the encryption of the total of a sequence of ciphertexts (Enc(0) for none)."""
+    n_sq = int(as_public_key(public_key).n_sq)
+    return _sum_chunk(n_sq, _run_chunked(_sum_chunk, n_sq, ciphertexts, chunk_size))
+
+
+def adjust_many(op, items, chunk_size=None):
+    """Applies op ("credit", "debit", "credit_ciphertext" or "debit_ciphertext")
+    to many (n, balance, operand) items, which may each use a different key;
+    returns the new balances, split across the workers pool.
+    """
+    return [c for chunk in _run_chunked(_adjust_chunk, op, items, chunk_size) for c in chunk]
+
+
+def expand_private_key(p, q):
+    """Builds the expanded private key (λ, μ, n, p, q, p², q², hp, hq, q⁻¹ mod p).
+
+    The first three fields are the classic (λ, μ, n) key, so code that only
+    knows about that form keeps working on an expanded key.
+    """
+    p, q = gmpy2.mpz(p), gmpy2.mpz(q)
+    n = p * q
+    λ = (p - 1) * (q - 1) // gmpy2.gcd(p - 1, q - 1)
+    μ = gmpy2.invert(λ, n)
+    p_sq, q_sq = p * p, q * q
+    g = n + 1
+    hp = gmpy2.invert((gmpy2.powmod(g, p - 1, p_sq) - 1) // p, p)
+    hq = gmpy2.invert((gmpy2.powmod(g, q - 1, q_sq) - 1) // q, q)
+    q_inv = gmpy2.invert(q, p)
+    return (λ, μ, n, p, q, p_sq, q_sq, hp, hq, q_inv)
+
+
+def decrypt_crt(c, private_key):
+    """Decrypts with an expanded private key, working mod p² and mod q² separately."""
+    _, _, _, p, q, p_sq, q_sq, hp, hq, q_inv = private_key
+    c = gmpy2.mpz(c)
+    mp = (gmpy2.powmod(c % p_sq, p - 1, p_sq) - 1) // p * hp % p
+    mq = (gmpy2.powmod(c % q_sq, q - 1, q_sq) - 1) // q * hq % q
+    return int(mq + (mp - mq) * q_inv % p * q)
+
+
+class RandomnessPool:
+    """Stock of precomputed r^n mod n² factors for one public key.
+
+    A daemon thread tops the pool up whenever it drops below half of its
+    size; when it runs dry, take() computes a fresh factor inline.
+    """
+
+    def __init__(self, n, size=POOL_SIZE, background=True):
+        self.n = gmpy2.mpz(n)
+        self.n_sq = self.n * self.n
+        self.size = size
+        self._pool = deque()
+        self._wakeup = threading.Event()
+        self._closed = False
+        if background and size > 0:
+            self._wakeup.set()
+            threading.Thread(target=self._refill_loop, daemon=True).start()
+
+    def _compute(self):
+        return gmpy2.powmod(_random_unit(self.n), self.n, self.n_sq)
+
+    def _refill_loop(self):
+        # Let the main thread run while this one sits in powmod.
+        gmpy2.get_context().allow_release_gil = True
+        while not self._closed:
+            self._wakeup.wait()
+            self._wakeup.clear()
+            while not self._closed and len(self._pool) < self.size:
+                self._pool.append(self._compute())
+
+    def take(self):
+        """Returns one r^n mod n² factor, computing it inline if the pool is empty."""
+        try:
+            factor = self._pool.popleft()
+        except IndexError:
+            factor = self._compute()
+        if len(self._pool) < self.size // 2:
+            self._wakeup.set()
+        return factor
+
+    def close(self):
+        self._closed = True
+        self._wakeup.set()
+
+
+class EncryptionEngine:
+    """Online Paillier encryption for a g = n + 1 public key.
+
+    g^m mod n² collapses to 1 + m·n, and the r^n factor comes from a
+    RandomnessPool, so an encryption costs two multiplications mod n².
+    """
+
+    def __init__(self, public_key, pool_size=POOL_SIZE, background=True):
+        self.n = gmpy2.mpz(public_key[0])
+        self.n_sq = self.n * self.n
+        self.pool = RandomnessPool(self.n, pool_size, background)
+
+    def encrypt(self, m):
+        return (1 + m * self.n) % self.n_sq * self.pool.take() % self.n_sq
+
+    def close(self):
+        self.pool.close()
+
+
+_engines = OrderedDict()
+_engines_lock = threading.Lock()
+
+def get_engine(public_key, pool_size=POOL_SIZE):
+    """Returns the shared encryption engine for a public key, creating it on first use."""
+    n = int(public_key[0])
+    with _engines_lock:
+        engine = _engines.get(n)
+        if engine is not None:
+            _engines.move_to_end(n)
+            return engine
+        engine = _engines[n] = EncryptionEngine(public_key, pool_size)
+        if len(_engines) > MAX_ENGINES:
+            _engines.popitem(last=False)[1].close()
+        return engine
 
     
 if __name__ == "__main__":
@@ -44,4 +437,5 @@ if __name__ == "__main__":
     b = p.encrypt(5, pb)
 
     print(p.decrypt(p.homomorphic_addition(a, b, pb), pr))
-    print(p.decrypt(p.homomorphic_subtraction(a, b, pb), pr))
\ No newline at end of file
+    print(p.decrypt(p.homomorphic_subtraction(a, b, pb), pr))
+    print(p.decrypt(p.homomorphic_subtraction(a, b, pb), pr[:3]))
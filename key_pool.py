@@ -0,0 +1,173 @@
+import base64
+import fcntl
+import hashlib
+import hmac
+import json
+import os
+import secrets
+import threading
+from contextlib import contextmanager
+import homomorphic
+import utils
+
+POOL_PATH = "key_pool.bin"
+SECRET_PATH = "key_pool.key"   # used when WALLET_KEY_POOL_SECRET is not set
+SECRET = os.environ.get("WALLET_KEY_POOL_SECRET")
+KEY_SIZE = 512                 # bits per prime, as for homomorphic.generate_keypair
+TARGET = 8                     # keypairs kept ready
+LOW_WATER = 4                  # refill starts when fewer than this many remain
+
+
+def _load_secret(path=SECRET_PATH):
+    """Returns the pool secret from the environment, or from (a newly created) secret file."""
+    if SECRET:
+        return SECRET.encode()
+    try:
+        fd = os.open(path, os.O_WRONLY | os.O_CREAT | os.O_EXCL, 0o600)
+    except FileExistsError:
+        with open(path, "rb") as f:
+            return f.read()
+    secret = secrets.token_bytes(32)
+    with os.fdopen(fd, "wb") as f:
+        f.write(secret)
+    return secret
+
+
+def _keystream(key, nonce, length):
+    blocks = []
+    for counter in range(-(-length // 32)):
+        blocks.append(hmac.new(key, nonce + counter.to_bytes(8, "big"), hashlib.sha256).digest())
+    return b"".join(blocks)[:length]
+
+
+def _xor(data, stream):
+    return (int.from_bytes(data, "big") ^ int.from_bytes(stream, "big")).to_bytes(len(data), "big")
+
+
+def seal(secret, plaintext):
+    """Encrypts then MACs plaintext: HMAC-SHA256 in counter mode, then HMAC-SHA256 over nonce and ciphertext."""
+    enc_key = hmac.new(secret, b"key-pool-enc", hashlib.sha256).digest()
+    mac_key = hmac.new(secret, b"key-pool-mac", hashlib.sha256).digest()
+    nonce = secrets.token_bytes(16)
+    ciphertext = _xor(plaintext, _keystream(enc_key, nonce, len(plaintext)))
+    tag = hmac.new(mac_key, nonce + ciphertext, hashlib.sha256).digest()
+    return nonce + tag + ciphertext
+
+
+def unseal(secret, blob):
+    """Reverses seal(); raises ValueError if the blob was altered or sealed with another secret."""
+    enc_key = hmac.new(secret, b"key-pool-enc", hashlib.sha256).digest()
+    mac_key = hmac.new(secret, b"key-pool-mac", hashlib.sha256).digest()
+    nonce, tag, ciphertext = blob[:16], blob[16:48], blob[48:]
+    if not hmac.compare_digest(tag, hmac.new(mac_key, nonce + ciphertext, hashlib.sha256).digest()):
+        raise ValueError("Key pool failed authentication")
+    return _xor(ciphertext, _keystream(enc_key, nonce, len(ciphertext)))
+
+
+class KeyPool:
+    """Pre-generated Paillier keypairs, encrypted at rest, for instant signup.
+
+    The pool file holds a sealed JSON list of serialized keypairs. Every
+    take or refill rewrites it atomically under an flock, so several client
+    processes sharing the file never hand out the same keypair. A daemon
+    thread tops the pool up to TARGET, finding p and q in parallel on the
+    workers pool.
+    """
+
+    def __init__(self, path=POOL_PATH, key_size=KEY_SIZE, target=TARGET, low_water=LOW_WATER, secret=None):
+        self.path = path
+        self.key_size = key_size
+        self.target = target
+        self.low_water = low_water
+        self.secret = secret or _load_secret()
+        self._wakeup = threading.Event()
+        self._started = False
+
+    @contextmanager
+    def _locked(self):
+        fd = os.open(self.path + ".lock", os.O_RDWR | os.O_CREAT, 0o600)
+        try:
+            fcntl.flock(fd, fcntl.LOCK_EX)
+            yield
+        finally:
+            fcntl.flock(fd, fcntl.LOCK_UN)
+            os.close(fd)
+
+    def _load(self):
+        try:
+            with open(self.path, "rb") as f:
+                blob = f.read()
+        except FileNotFoundError:
+            return []
+        try:
+            return json.loads(unseal(self.secret, base64.b64decode(blob)))
+        except ValueError as exc:
+            print(f"❌ Discarding unreadable key pool: {exc}")
+            return []
+
+    def _save(self, keypairs):
+        tmp_path = f"{self.path}.tmp"
+        fd = os.open(tmp_path, os.O_WRONLY | os.O_CREAT | os.O_TRUNC, 0o600)
+        with os.fdopen(fd, "wb") as f:
+            f.write(base64.b64encode(seal(self.secret, json.dumps(keypairs).encode())))
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(tmp_path, self.path)
+
+    def size(self):
+        with self._locked():
+            return len(self._load())
+
+    def take(self):
+        """Returns a (PaillierPublicKey, PaillierPrivateKey) pair, generating one inline if the pool is empty."""
+        with self._locked():
+            keypairs = self._load()
+            keypair = keypairs.pop() if keypairs else None
+            if keypair is not None:
+                self._save(keypairs)
+            remaining = len(keypairs)
+        if remaining < self.low_water:
+            self._wakeup.set()
+        if keypair is None:
+            return homomorphic.generate_keypair(self.key_size, parallel=True)
+        private_key = homomorphic.as_private_key(keypair["private_key"])
+        return private_key.public_key, private_key
+
+    def refill(self):
+        """Generates keypairs until the pool holds target of them."""
+        while self.size() < self.target:
+            public_key, private_key = homomorphic.generate_keypair(self.key_size, parallel=True)
+            with self._locked():
+                keypairs = self._load()
+                if len(keypairs) >= self.target:
+                    return
+                keypairs.append({"private_key": utils.serialize_key(private_key)})
+                self._save(keypairs)
+
+    def _refill_loop(self):
+        while True:
+            self._wakeup.wait()
+            self._wakeup.clear()
+            try:
+                self.refill()
+            except OSError as exc:
+                print(f"❌ Key pool refill failed: {exc}")
+
+    def start(self):
+        """Starts the background refill thread (once) and triggers a first refill."""
+        if not self._started:
+            self._started = True
+            threading.Thread(target=self._refill_loop, daemon=True).start()
+        self._wakeup.set()
+
+
+_pool = None
+_pool_lock = threading.Lock()
+
+def get_key_pool():
+    """Returns the process-wide key pool."""
+    global _pool
+    with _pool_lock:
+        if _pool is None:
+            _pool = KeyPool()
+        return _pool
@@ -0,0 +1,136 @@
+import json
+import threading
+import time
+from collections import OrderedDict
+import homomorphic
+import storage
+import utils
+
+LOG_SUFFIX = ".log"
+COMPACT_EVERY = 100        # logged key changes between rewrites of keys.json
+RECEIVER_TTL = 600         # seconds a receiver's public key is trusted before refetching
+RECEIVER_CACHE_SIZE = 4096
+
+
+class KeyRing:
+    """Client-side key cache, so key lookups are dictionary accesses.
+
+    The user's own keys are read from keys.json (plus <path>.log) once and
+    kept as PaillierPublicKey/PaillierPrivateKey objects. Changes are
+    appended to the log and folded into keys.json every COMPACT_EVERY
+    changes or on close(). Receivers' public keys fetched from the vault are
+    kept in an LRU and refetched after RECEIVER_TTL seconds.
+    """
+
+    def __init__(self, path=utils.KEYS_FILE, ttl=RECEIVER_TTL, cache_size=RECEIVER_CACHE_SIZE,
+                 compact_every=COMPACT_EVERY):
+        self.path = path
+        self.ttl = ttl
+        self.cache_size = cache_size
+        self.compact_every = compact_every
+        self._lock = threading.Lock()
+        self._receivers = OrderedDict()
+        try:
+            with open(path, "r") as f:
+                self._raw = json.load(f)
+        except (FileNotFoundError, json.JSONDecodeError):
+            self._raw = {}
+        self._log = storage.WriteAheadLog(path + LOG_SUFFIX)
+        records = self._log.replay()
+        for record in records:
+            self._raw[record["username"]] = record["keys"]
+        self._since_compaction = len(records)
+        self._own = {}
+        for username, keys in self._raw.items():
+            self._own[username] = self._decode(keys)
+
+    @staticmethod
+    def _decode(keys):
+        return (homomorphic.as_public_key(keys["public_key"]),
+                homomorphic.as_private_key(keys["private_key"]))
+
+    def save(self, username, private_key, public_key):
+        """Remembers a user's own keys; only writes if they changed."""
+        keys = {"private_key": utils.serialize_key(private_key),
+                "public_key": utils.serialize_key(public_key)}
+        with self._lock:
+            if self._raw.get(username) == keys:
+                return
+            self._raw[username] = keys
+            self._own[username] = self._decode(keys)
+            ticket = self._log.enqueue({"username": username, "keys": keys})
+            self._since_compaction += 1
+            if self._since_compaction >= self.compact_every:
+                self._compact_locked()
+                return
+        self._log.wait(ticket)
+
+    def public_key(self, username):
+        """Returns the user's own PaillierPublicKey, or None."""
+        pair = self._own.get(username)
+        return pair and pair[0]
+
+    def private_key(self, username):
+        """Returns the user's own PaillierPrivateKey, or None."""
+        pair = self._own.get(username)
+        return pair and pair[1]
+
+    def receiver_keys(self, usernames, fetch):
+        """Returns {username: PaillierPublicKey} for the given receivers.
+
+        Keys not cached (or expired) are looked up with one call to
+        fetch(usernames), which returns {username: public key}. Receivers
+        without a known key are left out.
+        """
+        now = time.monotonic()
+        found, stale = {}, []
+        with self._lock:
+            for username in dict.fromkeys(usernames):
+                cached = self._receivers.get(username)
+                if cached is not None and cached[1] > now:
+                    self._receivers.move_to_end(username)
+                    found[username] = cached[0]
+                else:
+                    stale.append(username)
+        if not stale:
+            return found
+        fetched = {u: homomorphic.as_public_key(key) for u, key in fetch(stale).items()}
+        with self._lock:
+            for username, key in fetched.items():
+                self._receivers[username] = (key, now + self.ttl)
+                self._receivers.move_to_end(username)
+            while len(self._receivers) > self.cache_size:
+                self._receivers.popitem(last=False)
+        found.update(fetched)
+        return found
+
+    def forget(self, username):
+        """Drops a receiver's cached public key."""
+        with self._lock:
+            self._receivers.pop(username, None)
+
+    def _compact_locked(self):
+        self._log.sync()
+        utils.atomic_write_json(self.path, self._raw)
+        self._log.truncate()
+        self._since_compaction = 0
+
+    def compact(self):
+        with self._lock:
+            self._compact_locked()
+
+    def close(self):
+        self.compact()
+        self._log.close()
+
+
+_ring = None
+_ring_lock = threading.Lock()
+
+def get_key_ring():
+    """Returns the process-wide key ring, loading keys.json on first use."""
+    global _ring
+    with _ring_lock:
+        if _ring is None:
+            _ring = KeyRing()
+        return _ring
@@ -0,0 +1,92 @@
+import json
+import threading
+import storage
+import utils
+
+VAULT_PATH = "key_vault.json"
+LOG_SUFFIX = ".log"
+COMPACT_EVERY = 500        # logged stores between snapshot rewrites
+
+
+class KeyVault:
+    """Key store of the third-party server.
+
+    All keys live in an in-memory index. New keys are appended to
+    <path>.log (fsynced, with group commit) and the key_vault.json snapshot
+    is rewritten atomically every COMPACT_EVERY stores, after which the log
+    is truncated. Keys are served exactly as stored, so the vault never
+    decodes them into key objects.
+    """
+
+    def __init__(self, path=VAULT_PATH, compact_every=COMPACT_EVERY):
+        self.path = path
+        self.compact_every = compact_every
+        self._lock = threading.Lock()
+        try:
+            with open(path, "r") as f:
+                self._keys = json.load(f)
+        except (FileNotFoundError, json.JSONDecodeError):
+            self._keys = {}
+        self._log = storage.WriteAheadLog(path + LOG_SUFFIX)
+        records = self._log.replay()
+        for record in records:
+            self._keys[record["username"]] = record["keys"]
+        self._since_compaction = len(records)
+
+    def store(self, username, private_key, public_key):
+        """Adds a user's keys; returns False if the username already has keys."""
+        keys = {"private_key": private_key, "public_key": public_key}
+        with self._lock:
+            if username in self._keys:
+                return False
+            self._keys[username] = keys
+            ticket = self._log.enqueue({"username": username, "keys": keys})
+            self._since_compaction += 1
+            if self._since_compaction >= self.compact_every:
+                self._compact_locked()
+                return True
+        self._log.wait(ticket)
+        return True
+
+    def get(self, username):
+        """Returns {"private_key", "public_key"} for a user, or None."""
+        with self._lock:
+            return self._keys.get(username)
+
+    def public_keys(self, usernames):
+        """Returns ({username: public key}, [usernames without keys])."""
+        found, missing = {}, []
+        with self._lock:
+            for username in usernames:
+                keys = self._keys.get(username)
+                if keys is None:
+                    missing.append(username)
+                else:
+                    found[username] = keys["public_key"]
+        return found, missing
+
+    def _compact_locked(self):
+        self._log.sync()
+        utils.atomic_write_json(self.path, self._keys)
+        self._log.truncate()
+        self._since_compaction = 0
+
+    def compact(self):
+        with self._lock:
+            self._compact_locked()
+
+    def close(self):
+        self.compact()
+        self._log.close()
+
+
+_vault = None
+_vault_lock = threading.Lock()
+
+def get_vault():
+    """Returns the process-wide key vault, opening it on first use."""
+    global _vault
+    with _vault_lock:
+        if _vault is None:
+            _vault = KeyVault()
+        return _vault
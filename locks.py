@@ -0,0 +1,145 @@
+import fcntl
+import hashlib
+import os
+import threading
+import time
+from contextlib import contextmanager
+
+LOCK_MODE = os.environ.get("WALLET_LOCKS", "thread")   # "thread" or "file"
+LOCK_DIR = "locks"
+FILE_STRIPES = 1024
+
+
+class _Stats:
+    """Contention counters shared by the lock managers."""
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self.acquisitions = 0
+        self.contended = 0
+        self.wait_seconds = 0.0
+        self.max_wait_seconds = 0.0
+
+    def record(self, waited):
+        with self._lock:
+            self.acquisitions += 1
+            if waited is not None:
+                self.contended += 1
+                self.wait_seconds += waited
+                self.max_wait_seconds = max(self.max_wait_seconds, waited)
+
+    def snapshot(self):
+        with self._lock:
+            return {
+                "acquisitions": self.acquisitions,
+                "contended": self.contended,
+                "wait_seconds": round(self.wait_seconds, 6),
+                "max_wait_seconds": round(self.max_wait_seconds, 6),
+            }
+
+
+class AccountLockManager:
+    """Per-account locks for the worker threads of one process.
+
+    locked() takes every requested account's lock in sorted username order,
+    so two transfers touching the same pair of accounts can never deadlock,
+    and transfers on disjoint accounts never wait for each other.
+    """
+
+    def __init__(self):
+        self._guard = threading.Lock()
+        self._locks = {}   # username -> [lock, number of threads using it]
+        self._stats = _Stats()
+
+    def _ref(self, key):
+        with self._guard:
+            entry = self._locks.setdefault(key, [threading.Lock(), 0])
+            entry[1] += 1
+            return entry[0]
+
+    def _unref(self, key):
+        with self._guard:
+            entry = self._locks[key]
+            entry[1] -= 1
+            if entry[1] == 0:
+                del self._locks[key]
+
+    @contextmanager
+    def locked(self, *usernames):
+        held = []
+        try:
+            for key in sorted(set(usernames)):
+                lock = self._ref(key)
+                waited = None
+                if not lock.acquire(blocking=False):
+                    start = time.perf_counter()
+                    lock.acquire()
+                    waited = time.perf_counter() - start
+                held.append((key, lock))
+                self._stats.record(waited)
+            yield
+        finally:
+            for key, lock in reversed(held):
+                lock.release()
+                self._unref(key)
+
+    def stats(self):
+        stats = self._stats.snapshot()
+        with self._guard:
+            stats["locked_accounts"] = len(self._locks)
+        return stats
+
+
+class FileLockManager:
+    """Account locks shared between processes, built on flock().
+
+    Accounts hash onto FILE_STRIPES lock files; stripes are taken in index
+    order. Each acquisition opens its own file description, so the locks
+    also exclude threads of the same process.
+    """
+
+    def __init__(self, directory=LOCK_DIR, stripes=FILE_STRIPES):
+        self.directory = directory
+        self.stripes = stripes
+        self._stats = _Stats()
+        os.makedirs(directory, exist_ok=True)
+
+    def _stripe(self, username):
+        digest = hashlib.blake2b(username.encode(), digest_size=8).digest()
+        return int.from_bytes(digest, "big") % self.stripes
+
+    @contextmanager
+    def locked(self, *usernames):
+        held = []
+        try:
+            for stripe in sorted({self._stripe(u) for u in usernames}):
+                fd = os.open(os.path.join(self.directory, f"{stripe:04d}.lock"), os.O_RDWR | os.O_CREAT, 0o600)
+                waited = None
+                try:
+                    fcntl.flock(fd, fcntl.LOCK_EX | fcntl.LOCK_NB)
+                except BlockingIOError:
+                    start = time.perf_counter()
+                    fcntl.flock(fd, fcntl.LOCK_EX)
+                    waited = time.perf_counter() - start
+                held.append(fd)
+                self._stats.record(waited)
+            yield
+        finally:
+            for fd in reversed(held):
+                fcntl.flock(fd, fcntl.LOCK_UN)
+                os.close(fd)
+
+    def stats(self):
+        return self._stats.snapshot()
+
+
+_manager = None
+_manager_lock = threading.Lock()
+
+def get_lock_manager():
+    """Returns the process-wide lock manager selected by LOCK_MODE."""
+    global _manager
+    with _manager_lock:
+        if _manager is None:
+            _manager = FileLockManager() if LOCK_MODE == "file" else AccountLockManager()
+        return _manager
@@ -0,0 +1,259 @@
+import bisect
+import contextlib
+import http.server
+import os
+import random
+import threading
+import time
+from concurrent.futures import Future
+
+ENABLED = os.environ.get("WALLET_METRICS", "1") != "0"
+SAMPLE_RATE = float(os.environ.get("WALLET_METRICS_SAMPLE", "1.0"))   # fraction of timings recorded
+EXPORT_FILE = os.environ.get("WALLET_METRICS_FILE")                   # Prometheus text dump, if set
+EXPORT_PORT = int(os.environ.get("WALLET_METRICS_PORT", "0"))         # serves /metrics, if set
+EXPORT_INTERVAL = 10       # seconds between rewrites of EXPORT_FILE
+BUCKETS = (0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10)
+
+_NULL = contextlib.nullcontext()
+
+
+class Histogram:
+    """Cumulative-bucket latency histogram in seconds, as Prometheus expects."""
+
+    def __init__(self, buckets=BUCKETS):
+        self.buckets = buckets
+        self.counts = [0] * (len(buckets) + 1)
+        self.sum = 0.0
+        self.count = 0
+
+    def observe(self, value):
+        self.counts[bisect.bisect_left(self.buckets, value)] += 1
+        self.sum += value
+        self.count += 1
+
+    def quantile(self, q):
+        """Upper bound of the bucket holding the q-th quantile (0-1)."""
+        rank, seen = q * self.count, 0
+        for bound, count in zip(self.buckets, self.counts):
+            seen += count
+            if seen >= rank:
+                return bound
+        return float("inf")
+
+
+class Registry:
+    """Counters, histograms and gauges keyed by name and label set."""
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self.counters = {}
+        self.histograms = {}
+        self.levels = {}
+        self.gauges = {}
+
+    def inc(self, name, labels, n=1):
+        key = (name, labels)
+        with self._lock:
+            self.counters[key] = self.counters.get(key, 0) + n
+
+    def add(self, name, labels, n):
+        """Moves a level (such as requests in flight) up or down by n."""
+        key = (name, labels)
+        with self._lock:
+            self.levels[key] = self.levels.get(key, 0) + n
+
+    def observe(self, name, labels, value):
+        key = (name, labels)
+        with self._lock:
+            histogram = self.histograms.get(key)
+            if histogram is None:
+                histogram = self.histograms[key] = Histogram()
+            histogram.observe(value)
+
+    def gauge(self, name, fn, labels=()):
+        """Registers fn() as the current value of a gauge, read at snapshot time."""
+        with self._lock:
+            self.gauges[(name, labels)] = fn
+
+    def _gauge_values(self):
+        with self._lock:
+            values = dict(self.levels)
+            gauges = list(self.gauges.items())
+        for key, fn in gauges:
+            try:
+                values[key] = fn()
+            except Exception:
+                continue
+        return values
+
+    def snapshot(self):
+        """Returns all metrics as a JSON-friendly dict."""
+        with self._lock:
+            counters = dict(self.counters)
+            histograms = {key: (h.count, h.sum, h.quantile(0.5), h.quantile(0.99))
+                          for key, h in self.histograms.items()}
+        return {
+            "enabled": ENABLED,
+            "sample_rate": SAMPLE_RATE,
+            "counters": {_series(name, labels): value for (name, labels), value in counters.items()},
+            "gauges": {_series(name, labels): value for (name, labels), value in self._gauge_values().items()},
+            "histograms": {_series(name, labels): {"count": count, "sum": total, "p50": p50, "p99": p99}
+                           for (name, labels), (count, total, p50, p99) in histograms.items()},
+        }
+
+    def render(self):
+        """Returns all metrics in the Prometheus text exposition format."""
+        lines = []
+        with self._lock:
+            counters = sorted(self.counters.items())
+            histograms = sorted((key, (list(h.counts), h.sum, h.count)) for key, h in self.histograms.items())
+        typed = set()
+
+        def declare(name, kind):
+            if name not in typed:
+                typed.add(name)
+                lines.append(f"# TYPE {name} {kind}")
+
+        for (name, labels), value in counters:
+            declare(name, "counter")
+            lines.append(f"{_series(name, labels)} {value}")
+        for (name, labels), value in sorted(self._gauge_values().items()):
+            declare(name, "gauge")
+            lines.append(f"{_series(name, labels)} {value}")
+        for (name, labels), (counts, total, count) in histograms:
+            declare(name, "histogram")
+            seen = 0
+            for bound, bucket_count in zip(BUCKETS + ("+Inf",), counts):
+                seen += bucket_count
+                lines.append(f"{_series(name + '_bucket', labels + (('le', str(bound)),))} {seen}")
+            lines.append(f"{_series(name + '_sum', labels)} {total}")
+            lines.append(f"{_series(name + '_count', labels)} {count}")
+        return "\n".join(lines) + "\n"
+
+
+def _series(name, labels):
+    if not labels:
+        return name
+    return name + "{" + ",".join(f'{k}="{v}"' for k, v in labels) + "}"
+
+
+_registry = Registry()
+
+def get_registry():
+    return _registry
+
+
+def sampled():
+    return ENABLED and (SAMPLE_RATE >= 1 or random.random() < SAMPLE_RATE)
+
+
+@contextlib.contextmanager
+def _timer(name, labels):
+    start = time.perf_counter()
+    try:
+        yield
+    finally:
+        _registry.observe(name, labels, time.perf_counter() - start)
+
+
+def timed(stage):
+    """Context manager timing one stage of request handling (paillier, pbkdf2, storage_write...).
+
+    Returns a shared no-op context when metrics are off or the call is not sampled.
+    """
+    if not sampled():
+        return _NULL
+    return _timer("wallet_stage_seconds", (("stage", stage),))
+
+
+def start_request(service):
+    """Marks a request as started; pass the result to finish_request()."""
+    if not ENABLED:
+        return None
+    _registry.add("wallet_requests_in_flight", (("service", service),), 1)
+    return time.perf_counter() if sampled() else 0.0
+
+
+def finish_request(service, kind, started, response):
+    """Counts a finished request and records its latency; a Future response is recorded once it completes."""
+    if started is None:
+        return
+    if isinstance(response, Future):
+        response.add_done_callback(lambda done: finish_request(
+            service, kind, started, done.result() if done.exception() is None else {"status": "error"}))
+        return
+    _registry.add("wallet_requests_in_flight", (("service", service),), -1)
+    status = response.get("status", "unknown") if isinstance(response, dict) else "unknown"
+    _registry.inc("wallet_requests_total", (("service", service), ("type", str(kind)), ("status", status)))
+    if started:
+        _registry.observe("wallet_request_seconds", (("service", service), ("type", str(kind))),
+                          time.perf_counter() - started)
+
+
+def gauge(name, fn, labels=()):
+    if ENABLED:
+        _registry.gauge(name, fn, labels)
+
+
+def inc(name, labels=(), n=1):
+    if ENABLED:
+        _registry.inc(name, labels, n)
+
+
+def observe(name, labels, value):
+    """Records a value (in seconds) in a histogram, subject to sampling."""
+    if sampled():
+        _registry.observe(name, labels, value)
+
+
+def snapshot():
+    return _registry.snapshot()
+
+
+def render():
+    return _registry.render()
+
+
+class _MetricsHandler(http.server.BaseHTTPRequestHandler):
+    def do_GET(self):
+        body = render().encode()
+        self.send_response(200)
+        self.send_header("Content-Type", "text/plain; version=0.0.4")
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, *args):
+        pass
+
+
+def _dump_loop(path, interval):
+    while True:
+        time.sleep(interval)
+        tmp_path = f"{path}.tmp"
+        try:
+            with open(tmp_path, "w") as f:
+                f.write(render())
+            os.replace(tmp_path, path)
+        except OSError as exc:
+            print(f"Metrics dump failed: {exc}")
+
+
+_exporting = False
+_export_lock = threading.Lock()
+
+def start_exporter(path=EXPORT_FILE, port=EXPORT_PORT, interval=EXPORT_INTERVAL):
+    """Periodically writes the Prometheus text to path and/or serves it on 127.0.0.1:port/metrics.
+
+    Only the first call in a process starts anything.
+    """
+    global _exporting
+    with _export_lock:
+        if _exporting or not ENABLED or not (path or port):
+            return
+        _exporting = True
+    if path:
+        threading.Thread(target=_dump_loop, args=(path, interval), daemon=True).start()
+    if port:
+        httpd = http.server.ThreadingHTTPServer(("127.0.0.1", port), _MetricsHandler)
+        threading.Thread(target=httpd.serve_forever, daemon=True).start()
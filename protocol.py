@@ -0,0 +1,143 @@
+import itertools
+import json
+import socket
+import struct
+import threading
+from concurrent.futures import Future
+
+HEADER = struct.Struct(">I")     # payload length, big-endian
+MAX_FRAME = 64 * 1024 * 1024
+FIRST_FRAME = (1 << 24) - 1      # largest opening frame: its prefix must start with 0 for accept_channel()
+LEGACY_BUFFER = 1024 * 20
+
+
+def recv_exact(sock, size):
+    """Reads exactly size bytes, or returns b"" if the peer closed first."""
+    chunks = []
+    while size:
+        chunk = sock.recv(min(size, 1 << 16))
+        if not chunk:
+            return b""
+        chunks.append(chunk)
+        size -= len(chunk)
+    return b"".join(chunks)
+
+
+class Channel:
+    """Message channel over a connected socket.
+
+    Framed mode sends each message as a 4-byte big-endian length followed by
+    a JSON payload. Legacy mode sends bare JSON and reads with a single
+    recv(), which is what clients from before framing expect. send() is
+    safe to call from several threads at once. first_frame caps the size
+    of the first message sent, for peers that negotiate the mode from it.
+    """
+
+    def __init__(self, sock, framed=True, first_frame=None):
+        self.sock = sock
+        self.framed = framed
+        self.first_frame = first_frame
+        self._send_lock = threading.Lock()
+
+    def send(self, message):
+        payload = json.dumps(message).encode()
+        with self._send_lock:
+            if self.framed:
+                if self.first_frame is not None and len(payload) > self.first_frame:
+                    raise ValueError(f"First frame of {len(payload)} bytes exceeds {self.first_frame}")
+                self.first_frame = None
+                self.sock.sendall(HEADER.pack(len(payload)) + payload)
+            else:
+                self.sock.sendall(payload)
+
+    def recv(self):
+        """Returns the next raw payload, or b"" when the peer has disconnected."""
+        if not self.framed:
+            return self.sock.recv(LEGACY_BUFFER)
+        header = recv_exact(self.sock, HEADER.size)
+        if not header:
+            return b""
+        (length,) = HEADER.unpack(header)
+        if length > MAX_FRAME:
+            raise ValueError(f"Frame of {length} bytes exceeds MAX_FRAME")
+        return recv_exact(self.sock, length)
+
+
+def accept_channel(conn):
+    """Negotiates the wire mode from the first byte a client sends.
+
+    Framed clients start with a length prefix, whose first byte is 0 because
+    their first frame is at most FIRST_FRAME bytes; legacy clients start
+    with "{" or "exit". Later frames may be up to MAX_FRAME.
+    """
+    first = conn.recv(1, socket.MSG_PEEK)
+    return Channel(conn, framed=(first == b"\x00"))
+
+
+def reply(channel, request, response):
+    """Sends a response, tagged with the request's id when it had one."""
+    if isinstance(request, dict) and "id" in request:
+        response = dict(response, id=request["id"])
+    channel.send(response)
+
+
+class Client:
+    """Framed client that can keep many requests in flight on one connection.
+
+    Every request gets an "id"; a reader thread matches responses, which the
+    server may send in any order, back to the Future returned by submit().
+    Fields in defaults (such as a session token) are added to every request.
+    """
+
+    def __init__(self, sock):
+        self.channel = Channel(sock, framed=True, first_frame=FIRST_FRAME)
+        self.defaults = {}
+        self._ids = itertools.count(1)
+        self._pending = {}
+        self._lock = threading.Lock()
+        self._reader = threading.Thread(target=self._read_loop, daemon=True)
+        self._reader.start()
+
+    def submit(self, request):
+        """Sends a request and returns a Future for its response."""
+        future = Future()
+        with self._lock:
+            request_id = next(self._ids)
+            self._pending[request_id] = future
+        try:
+            self.channel.send(dict(self.defaults, **request, id=request_id))
+        except ValueError:
+            with self._lock:
+                self._pending.pop(request_id, None)
+            raise
+        return future
+
+    def call(self, request, timeout=None):
+        """Sends a request and waits for its response."""
+        return self.submit(request).result(timeout)
+
+    def _read_loop(self):
+        error = ConnectionError("Connection closed by server")
+        try:
+            while True:
+                payload = self.channel.recv()
+                if not payload:
+                    break
+                response = json.loads(payload.decode())
+                with self._lock:
+                    future = self._pending.pop(response.pop("id", None), None)
+                if future is not None:
+                    future.set_result(response)
+        except (OSError, ValueError) as exc:
+            error = exc
+        with self._lock:
+            pending, self._pending = self._pending, {}
+        for future in pending.values():
+            future.set_exception(error)
+
+    def close(self):
+        try:
+            self.channel.sock.shutdown(socket.SHUT_RDWR)
+        except OSError:
+            pass
+        self.channel.sock.close()
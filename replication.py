@@ -0,0 +1,489 @@
+import atexit
+import hmac
+import json
+import multiprocessing
+import os
+import queue
+import secrets
+import socket
+import threading
+import time
+from bisect import bisect_left, bisect_right
+from collections import deque
+from concurrent.futures import Future
+import async_server
+import codec
+import history_log
+import metrics
+import protocol
+import sessions
+import storage
+import utils
+
+REPLICAS = int(os.environ.get("WALLET_REPLICAS", "0"))   # read replicas the primary starts; 0 disables replication
+FEED_PORT = 65450          # the primary streams its change log to replicas on this port
+REPLICA_BASE_PORT = 65460  # replica i answers reads on REPLICA_BASE_PORT + i
+MAX_LAG = float(os.environ.get("WALLET_REPLICA_MAX_LAG", "1.0"))   # seconds a replica may trail before refusing reads
+HEARTBEAT_INTERVAL = 0.1   # seconds between heartbeats on the change stream
+FEED_BACKLOG = 100000      # recent changes kept for replicas that reconnect
+SNAPSHOT_BATCH = 10000     # balances or history records per snapshot frame, to stay well under MAX_FRAME
+RECONNECT_DELAY = 0.5      # seconds between a replica's attempts to reach the primary
+
+READ_REQUESTS = ("balance", "balance_version", "history", "stats")
+
+
+class ChangeFeed:
+    """The primary's log of committed balance and history changes.
+
+    Every change gets the next log sequence number ("lsn"). LSNs start at
+    the feed's creation time in microseconds, so they keep growing across
+    primary restarts. Subscribers get a bounded queue of new changes; one
+    that falls FEED_BACKLOG changes behind is dropped and resyncs.
+    """
+
+    def __init__(self, backlog=FEED_BACKLOG):
+        self._lock = threading.Lock()
+        self._lsn = self._first = time.time_ns() // 1000
+        self._backlog = deque(maxlen=backlog)
+        self._subscribers = []
+
+    @property
+    def lsn(self):
+        return self._lsn
+
+    def publish(self, change):
+        """Assigns change the next lsn and hands it to every subscriber."""
+        with self._lock:
+            self._lsn += 1
+            change = dict(change, lsn=self._lsn, time=time.time())
+            self._backlog.append(change)
+            for subscriber in list(self._subscribers):
+                if subscriber.qsize() >= self._backlog.maxlen:
+                    self._subscribers.remove(subscriber)
+                    subscriber.put_nowait(None)
+                else:
+                    subscriber.put_nowait(change)
+            return self._lsn
+
+    def heartbeat(self):
+        with self._lock:
+            return {"op": "heartbeat", "lsn": self._lsn, "time": time.time()}
+
+    def subscribe(self, after):
+        """Registers a subscriber; returns (its queue, the lsn it starts after, missed changes).
+
+        The missed changes are the backlog past after, or None when after is
+        too old (or from another feed) and the subscriber needs a snapshot.
+        """
+        subscriber = queue.Queue(maxsize=self._backlog.maxlen + 1)   # room for the drop marker
+        with self._lock:
+            self._subscribers.append(subscriber)
+            first = self._backlog[0]["lsn"] if self._backlog else self._lsn + 1
+            if after is None or after < self._first or after > self._lsn or after < first - 1:
+                return subscriber, self._lsn, None
+            return subscriber, self._lsn, [c for c in self._backlog if c["lsn"] > after]
+
+    def unsubscribe(self, subscriber):
+        with self._lock:
+            if subscriber in self._subscribers:
+                self._subscribers.remove(subscriber)
+
+    def subscribers(self):
+        return len(self._subscribers)
+
+
+class ReplicatedStore(storage.AccountStore):
+    """Account store wrapper that publishes committed balances to the change feed.
+
+    Callers update an account under its lock-manager lock, so each account's
+    changes reach the feed in the order they were committed.
+    """
+
+    def __init__(self, store, feed):
+        self.store = store
+        self.feed = feed
+
+    def get(self, username):
+        return self.store.get(username)
+
+    def exists(self, username):
+        return self.store.exists(username)
+
+    def create(self, username, record):
+        if not self.store.create(username, record):
+            return False
+        self.feed.publish({"op": "balances", "balances": {username: record["balance"]}})
+        return True
+
+    def update_many(self, changes):
+        self.store.update_many(changes)
+        balances = {u: fields["balance"] for u, fields in changes.items() if "balance" in fields}
+        if balances:
+            self.feed.publish({"op": "balances", "balances": balances})
+
+    def usernames(self):
+        return self.store.usernames()
+
+    def checkpoint(self):
+        self.store.checkpoint()
+
+    def close(self):
+        self.store.close()
+
+
+class ReplicatedHistoryLog(history_log.HistoryLog):
+    """History log that publishes appends, and the rewritten log after a fold, to the change feed."""
+
+    def __init__(self, feed, directory=history_log.HISTORY_DIR):
+        super().__init__(directory)
+        self.feed = feed
+
+    def append(self, username, entry):
+        log = self._user(username)
+        with log.lock:
+            seq = log.append(entry)
+            self.feed.publish({"op": "history", "username": username, "records": [[seq, log.last_ts, entry]]})
+        return seq
+
+    def append_many(self, items):
+        by_user = {}
+        for username, entry in items:
+            by_user.setdefault(username, []).append(entry)
+        for username, entries in by_user.items():
+            log = self._user(username)
+            with log.lock:
+                records = [[log.append(entry), log.last_ts, entry] for entry in entries]
+                self.feed.publish({"op": "history", "username": username, "records": records})
+
+    def records(self, username):
+        """Returns all of a user's [seq, ts, entry] records."""
+        if not self.has_user(username):
+            return []
+        log = self._user(username)
+        with log.lock:
+            return [list(r) for segment in log.segments for r in segment.read_from(0)]
+
+    def fold(self, username, folder):
+        folded = []
+
+        def folding(records, total):
+            result = folder(records, total)
+            folded.append(result is not None)
+            return result
+
+        super().fold(username, folding)
+        if any(folded):
+            log = self._user(username)
+            with log.lock:
+                records = [list(r) for segment in log.segments for r in segment.read_from(0)]
+                # The first frame replaces the replica's copy and the rest extend it.
+                for i, batch in enumerate(batches(records) or [[]]):
+                    self.feed.publish({"op": "history_reset" if i == 0 else "history",
+                                       "username": username, "records": batch})
+
+
+def batches(items, size=None):
+    """Splits a list into consecutive slices of at most size (default SNAPSHOT_BATCH) items."""
+    size = size or SNAPSHOT_BATCH
+    return [items[i:i + size] for i in range(0, len(items), size)]
+
+
+def snapshot(store, history, lsn):
+    """Yields the frames of a full replica state as of lsn.
+
+    snapshot_start clears the replica, snapshot_balances and
+    snapshot_history frames carry at most SNAPSHOT_BATCH balances or one
+    user's records each, and snapshot_end sets the replica's lsn.
+    """
+    yield {"op": "snapshot_start"}
+    accounts = {}
+    for username in store.usernames():
+        account = store.get(username)
+        if account is not None:
+            accounts[username] = account["balance"]
+        if len(accounts) >= SNAPSHOT_BATCH:
+            yield {"op": "snapshot_balances", "balances": accounts}
+            accounts = {}
+    if accounts:
+        yield {"op": "snapshot_balances", "balances": accounts}
+    for username in history.usernames():
+        for records in batches(history.records(username)):
+            yield {"op": "snapshot_history", "username": username, "records": records}
+    yield {"op": "snapshot_end", "lsn": lsn}
+
+
+def serve_feed(feed, store, history, secret, host="127.0.0.1", port=FEED_PORT):
+    """Streams the change feed to replicas that connect with the replication secret."""
+    listener = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+    listener.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+    listener.bind((host, port))
+    listener.listen()
+
+    def stream(conn):
+        subscriber = None
+        with conn:
+            try:
+                channel = protocol.Channel(conn)
+                request = json.loads(channel.recv() or b"{}")
+                if not hmac.compare_digest(str(request.get("secret")), secret):
+                    channel.send({"op": "error", "message": "Invalid replication secret"})
+                    return
+                subscriber, start, missed = feed.subscribe(request.get("lsn"))
+                if missed is None:
+                    # Changes after start are queued as well, and applying them again is harmless.
+                    for frame in snapshot(store, history, start):
+                        channel.send(frame)
+                    missed = []
+                for change in missed:
+                    channel.send(change)
+                last_beat = 0
+                while True:
+                    try:
+                        change = subscriber.get(timeout=HEARTBEAT_INTERVAL)
+                    except queue.Empty:
+                        change = False
+                    if change is None:
+                        return
+                    if change:
+                        channel.send(change)
+                    if time.monotonic() - last_beat >= HEARTBEAT_INTERVAL:
+                        channel.send(feed.heartbeat())
+                        last_beat = time.monotonic()
+            except (OSError, ValueError) as exc:
+                print(f"Replica stream closed: {exc}")
+            finally:
+                if subscriber is not None:
+                    feed.unsubscribe(subscriber)
+
+    def accept_loop():
+        while True:
+            conn, _ = listener.accept()
+            threading.Thread(target=stream, args=(conn,), daemon=True).start()
+
+    threading.Thread(target=accept_loop, daemon=True).start()
+
+
+class ReplicaState:
+    """A replica's in-memory copy of balances and history, applied from the change stream.
+
+    complete_until is the primary's clock time up to which every change has
+    been applied: the time of the last applied change, or of a heartbeat
+    received once the replica had caught up. The lag is how far that trails
+    the present.
+    """
+
+    def __init__(self):
+        self.balances = {}
+        self.history = {}
+        self.lsn = 0
+        self.complete_until = 0.0
+        self._cond = threading.Condition()
+
+    def apply(self, change):
+        with self._cond:
+            op = change["op"]
+            if op == "snapshot_start":
+                # Until snapshot_end the replica is behind, so it refuses reads and resyncs if cut off.
+                self.balances, self.history = {}, {}
+                self.lsn, self.complete_until = 0, 0.0
+            elif op in ("balances", "snapshot_balances"):
+                self.balances.update(change["balances"])
+            elif op in ("history", "snapshot_history"):
+                self._add_history(change["username"], change["records"])
+            elif op == "history_reset":
+                self._reset_history(change["username"], change["records"])
+            if op in ("snapshot_start", "snapshot_balances", "snapshot_history"):
+                pass
+            elif op == "heartbeat":
+                if self.lsn >= change["lsn"]:
+                    self.complete_until = max(self.complete_until, change["time"])
+            else:
+                self.lsn = max(self.lsn, change["lsn"])
+                self.complete_until = max(self.complete_until, change.get("time", time.time()))
+            self._cond.notify_all()
+
+    def _reset_history(self, username, records):
+        records = sorted(records, key=lambda r: r[0])
+        self.history[username] = ([r[0] for r in records], [r[1] for r in records], [r[2] for r in records])
+
+    def _add_history(self, username, records):
+        seqs, times, entries = self.history.setdefault(username, ([], [], []))
+        for seq, ts, entry in records:
+            if seqs and seq <= seqs[-1]:
+                # A change already covered by the snapshot, or one that overtook an earlier append.
+                i = bisect_left(seqs, seq)
+                if i < len(seqs) and seqs[i] == seq:
+                    continue
+                seqs.insert(i, seq)
+                times.insert(i, ts)
+                entries.insert(i, entry)
+                continue
+            seqs.append(seq)
+            times.append(ts)
+            entries.append(entry)
+
+    def lag(self):
+        return max(0.0, time.time() - self.complete_until)
+
+    def wait_for(self, lsn, timeout):
+        """Waits until changes up to lsn are applied; returns False on timeout."""
+        deadline = time.monotonic() + timeout
+        with self._cond:
+            while self.lsn < lsn:
+                remaining = deadline - time.monotonic()
+                if remaining <= 0:
+                    return False
+                self._cond.wait(remaining)
+            return True
+
+    def balance(self, username):
+        with self._cond:
+            return self.balances.get(username), self.lsn
+
+    def read_history(self, username, cursor=None, limit=None, since=None, until=None):
+        """Same slice semantics as history_log.HistoryLog.read()."""
+        with self._cond:
+            if username not in self.history:
+                return [], None
+            seqs, times, entries = self.history[username]
+            start = bisect_left(seqs, cursor) if cursor else 0
+            if since is not None:
+                start = max(start, bisect_left(times, since))
+            end = bisect_right(times, until) if until is not None else len(seqs)
+            if limit is not None and end - start > limit:
+                return entries[start:start + limit], seqs[start + limit]
+            return entries[start:end], None
+
+
+class Replica:
+    """Read-only wallet server fed by the primary's change stream.
+
+    Answers balance, balance_version and history requests from memory.
+    Requests carrying min_lsn (the lsn of the client's last write, from the
+    primary's responses) wait for that change to arrive, which gives the
+    client read-your-writes consistency. A replica that trails by more than
+    max_lag seconds answers "lagging" so the client reads from the primary.
+    """
+
+    def __init__(self, primary_port, secret, session_secret, max_lag=MAX_LAG):
+        self.primary_port = primary_port
+        self.secret = secret
+        self.sessions = sessions.SessionManager(session_secret)
+        self.max_lag = max_lag
+        self.state = ReplicaState()
+
+    def _follow(self):
+        while True:
+            try:
+                with socket.create_connection(("127.0.0.1", self.primary_port)) as sock:
+                    channel = protocol.Channel(sock)
+                    channel.send({"secret": self.secret, "lsn": self.state.lsn or None})
+                    while True:
+                        payload = channel.recv()
+                        if not payload:
+                            break
+                        change = json.loads(payload)
+                        if change["op"] == "error":
+                            print(f"❌ Primary refused replication: {change['message']}")
+                            return
+                        self.state.apply(change)
+            except (OSError, ValueError) as exc:
+                print(f"Lost the primary's change stream: {exc}")
+            time.sleep(RECONNECT_DELAY)
+
+    def start(self):
+        threading.Thread(target=self._follow, daemon=True).start()
+        metrics.gauge("wallet_replica_lag_seconds", self.state.lag)
+        metrics.gauge("wallet_replica_lsn", lambda: self.state.lsn)
+
+    def handle(self, request):
+        started = metrics.start_request("replica")
+        try:
+            response = self._read(request)
+        except (KeyError, TypeError, ValueError, AttributeError):
+            response = {"status": "error", "message": "Invalid request format"}
+        metrics.finish_request("replica", request.get("request") if isinstance(request, dict) else None,
+                               started, response)
+        return response
+
+    def _read(self, request):
+        kind = request["request"]
+        if kind not in READ_REQUESTS:
+            return {"status": "error", "message": "Replicas only serve reads, send this to the primary"}
+        if kind == "stats":
+            return {"status": "success", "stats": metrics.snapshot(), "lsn": self.state.lsn, "lag": self.state.lag()}
+        username = request["username"]
+        if sessions.REQUIRE_SESSION and self.sessions.verify_signature(request.get("token")) != username:
+            return {"status": "error", "message": "Not logged in or session expired"}
+        if not self.state.wait_for(int(request.get("min_lsn") or 0), self.max_lag) or \
+                self.state.lag() > self.max_lag:
+            return {"status": "lagging", "message": "Replica is behind, read from the primary",
+                    "lag": self.state.lag()}
+
+        version = codec.negotiate(request)
+        if kind == "history":
+            entries, next_cursor = self.state.read_history(username, request.get("cursor"), request.get("limit"),
+                                                           request.get("since"), request.get("until"))
+            response = {"status": "success", "transactions": [codec.entry_for_wire(e, version) for e in entries],
+                        "next_cursor": next_cursor}
+            if request.get("compress", False) and version >= codec.VERSION:
+                response["transactions_zlib"] = codec.compress(response.pop("transactions"))
+            return response
+        balance, lsn = self.state.balance(username)
+        if balance is None:
+            return {"status": "error", "message": "User not found"}
+        response = {"status": "success", "version": utils.balance_version(balance), "lsn": lsn}
+        if kind == "balance":
+            response["balance"] = codec.for_wire(balance, version)
+        return response
+
+
+def run_replica(index, port, primary_port, secret, session_secret, max_lag):
+    """Entry point of one replica process."""
+    replica = Replica(primary_port, secret, session_secret, max_lag)
+    replica.start()
+    print(f"Replica {index} listening on 127.0.0.1:{port} (max lag {max_lag}s)")
+    async_server.run(replica.handle, "127.0.0.1", port)
+
+
+_feed = None
+
+def get_feed():
+    """Returns the primary's change feed, or None when replication is off."""
+    return _feed
+
+def stamp(response):
+    """Adds the feed position to a response (or a Future's), so clients can ask replicas for their writes."""
+    if _feed is None:
+        return response
+    if isinstance(response, dict):
+        return dict(response, lsn=_feed.lsn)
+    stamped = Future()
+    response.add_done_callback(lambda done: stamped.set_exception(done.exception()) if done.exception()
+                               else stamped.set_result(stamp(done.result())))
+    return stamped
+
+def start_primary(replicas=REPLICAS, feed_port=FEED_PORT, base_port=REPLICA_BASE_PORT, max_lag=MAX_LAG):
+    """Publishes this server's changes and starts replica processes reading them.
+
+    Must run before the server handles requests, as it swaps in the
+    publishing account store and history log.
+    """
+    global _feed
+    _feed = ChangeFeed()
+    store = ReplicatedStore(storage.get_store(), _feed)
+    history = ReplicatedHistoryLog(_feed, history_log.get_log().directory)
+    storage.set_store(store)
+    history_log.set_log(history)
+    secret = os.environ.setdefault("WALLET_REPLICATION_SECRET", secrets.token_hex(16))
+    serve_feed(_feed, store, history, secret, port=feed_port)
+    metrics.gauge("wallet_replication_lsn", lambda: _feed.lsn)
+    metrics.gauge("wallet_replication_subscribers", _feed.subscribers)
+
+    context = multiprocessing.get_context("spawn")
+    for index in range(replicas):
+        process = context.Process(target=run_replica, args=(index, base_port + index, feed_port, secret,
+                                                            sessions.get_sessions().secret, max_lag))
+        process.start()
+        atexit.register(process.terminate)
+    return [base_port + i for i in range(replicas)]
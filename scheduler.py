@@ -0,0 +1,167 @@
+import os
+import queue
+import threading
+import time
+from concurrent.futures import Future
+import metrics
+
+# The lane each request type waits in; other types share the "balance" lane, where they fail fast.
+REQUEST_LANES = {
+    "signup": "auth", "login": "auth",
+    "transfer": "transfer", "batch_transfer": "transfer",
+    "prepare_debit": "transfer", "prepare_credit": "transfer",
+    "commit_transfer": "transfer", "abort_transfer": "transfer",
+    "balance": "balance", "balance_version": "balance", "stats": "balance",
+    "history": "history",
+    "bulk_adjust": "admin", "bulk_status": "admin",
+}
+DEFAULT_LANE = "balance"
+
+# Per lane: worker threads, queue capacity, and the longest a request may wait (seconds) before it is shed.
+LANES = {
+    "auth": (2, 256, 5.0),
+    "transfer": (4, 1024, 2.0),
+    "balance": (4, 1024, 1.0),
+    "history": (2, 128, 5.0),
+    "admin": (1, 16, 30.0),
+}
+MAX_IN_FLIGHT = int(os.environ.get("WALLET_MAX_IN_FLIGHT", "64"))   # queued or running requests per client
+SERVICE_TIME_WEIGHT = 0.1   # weight of the newest sample in a lane's moving average of service time
+
+BUSY = {"status": "busy", "message": "Server busy, retry later"}
+
+
+def lane_config(spec=os.environ.get("WALLET_LANES")):
+    """Returns LANES with overrides from a spec like "auth=4:512:5,history=1:64:10".
+
+    Each override is lane=workers:capacity:max_wait.
+    """
+    lanes = dict(LANES)
+    for item in (spec or "").split(","):
+        if not item.strip():
+            continue
+        name, values = item.split("=")
+        workers, capacity, max_wait = values.split(":")
+        lanes[name.strip()] = (int(workers), int(capacity), float(max_wait))
+    return lanes
+
+
+class Lane:
+    """A bounded queue of one class of requests and the threads that serve it."""
+
+    def __init__(self, name, workers, capacity, max_wait):
+        self.name = name
+        self.workers = workers
+        self.max_wait = max_wait
+        self.queue = queue.Queue(maxsize=capacity)
+        self.lock = threading.Lock()
+        self.busy = 0
+        self.service_time = 0.0
+
+    def expected_wait(self):
+        """Estimated seconds a request joining the queue now waits for a worker."""
+        return (self.queue.qsize() + self.busy) * self.service_time / self.workers
+
+    def record(self, seconds):
+        if not self.service_time:
+            self.service_time = seconds
+        self.service_time += SERVICE_TIME_WEIGHT * (seconds - self.service_time)
+
+
+class Scheduler:
+    """Admission control and priority lanes in front of a request handler.
+
+    Each request class waits in its own bounded lane with its own workers,
+    so a burst of logins or history pages cannot hold up balance checks.
+    A request is answered "busy" at once, without running, when its client
+    already has max_in_flight requests outstanding, when its lane is full,
+    or when the lane's expected wait exceeds its deadline: the lane's
+    max_wait, or the request's own "max_wait" in seconds if shorter. One
+    that is still queued when its deadline passes is dropped the same way.
+    """
+
+    def __init__(self, handle, lanes=None, max_in_flight=MAX_IN_FLIGHT):
+        self.handle = handle
+        self.max_in_flight = max_in_flight
+        self.lanes = {name: Lane(name, *config) for name, config in (lanes or lane_config()).items()}
+        self._in_flight = {}
+        self._lock = threading.Lock()
+
+    def start(self):
+        for lane in self.lanes.values():
+            for _ in range(lane.workers):
+                threading.Thread(target=self._work, args=(lane,), daemon=True).start()
+            labels = (("lane", lane.name),)
+            metrics.gauge("wallet_lane_queue_depth", lane.queue.qsize, labels)
+            metrics.gauge("wallet_lane_workers", lambda lane=lane: lane.workers, labels)
+            metrics.gauge("wallet_lane_workers_busy", lambda lane=lane: lane.busy, labels)
+            metrics.gauge("wallet_lane_service_seconds", lambda lane=lane: lane.service_time, labels)
+        metrics.gauge("wallet_clients_in_flight", lambda: len(self._in_flight))
+        return self
+
+    def _shed(self, lane, reason, future):
+        metrics.inc("wallet_lane_shed_total", (("lane", lane.name), ("reason", reason)))
+        future.set_result(dict(BUSY, retry_after=round(lane.expected_wait(), 3)))
+        return future
+
+    def _release(self, client):
+        with self._lock:
+            count = self._in_flight[client] - 1
+            if count:
+                self._in_flight[client] = count
+            else:
+                del self._in_flight[client]
+
+    def submit(self, request, client=None):
+        """Queues a request; returns a Future for its response, which is "busy" if it was shed."""
+        future = Future()
+        kind = request.get("request") if isinstance(request, dict) else None
+        lane = self.lanes[REQUEST_LANES.get(kind, DEFAULT_LANE)]
+        max_wait = lane.max_wait
+        if isinstance(request, dict) and isinstance(request.get("max_wait"), (int, float)):
+            max_wait = min(max_wait, request["max_wait"])
+        if lane.expected_wait() > max_wait:
+            return self._shed(lane, "deadline", future)
+
+        if client is not None:
+            with self._lock:
+                if self._in_flight.get(client, 0) >= self.max_in_flight:
+                    return self._shed(lane, "client_limit", future)
+                self._in_flight[client] = self._in_flight.get(client, 0) + 1
+            future.add_done_callback(lambda _: self._release(client))
+        try:
+            lane.queue.put_nowait((request, future, time.monotonic(), time.monotonic() + max_wait))
+        except queue.Full:
+            return self._shed(lane, "full", future)
+        metrics.inc("wallet_lane_admitted_total", (("lane", lane.name),))
+        return future
+
+    def _work(self, lane):
+        while True:
+            request, future, queued, deadline = lane.queue.get()
+            started = time.monotonic()
+            metrics.observe("wallet_lane_wait_seconds", (("lane", lane.name),), started - queued)
+            if started > deadline:
+                self._shed(lane, "expired", future)
+                continue
+            with lane.lock:
+                lane.busy += 1
+            try:
+                response = self.handle(request)
+            except Exception as exc:
+                future.set_exception(exc)
+                response = None
+            with lane.lock:
+                lane.busy -= 1
+                lane.record(time.monotonic() - started)
+            if isinstance(response, Future):
+                response.add_done_callback(lambda done, future=future: _copy(done, future))
+            elif response is not None:
+                future.set_result(response)
+
+
+def _copy(source, target):
+    if source.exception() is not None:
+        target.set_exception(source.exception())
+    else:
+        target.set_result(source.result())
@@ -1,16 +1,36 @@
+import os
+import sys
 import socket
 import threading
+import time
 import json
-import queue
+import hmac
 import utils
 import auth
 import homomorphic
+import storage
+import history_log
+import protocol
+import workers
+import locks
+import async_server
+import checkpoints
+import sessions
+import metrics
+import codec
+import replication
+import scheduler
+import bulk
+from concurrent.futures import Future
 from datetime import datetime
 
 clients_active = 0
 clients_lock = threading.Lock()  
-request_queue = queue.Queue()
-phe = homomorphic.Paillier()
+CHECKPOINT_HISTORY = True   # fold old history into encrypted checkpoints in the background
+SHARD_SECRET = os.environ.get("WALLET_SHARD_SECRET")   # set when running as a shard behind shards.py
+ADMIN_SECRET = os.environ.get("WALLET_ADMIN_SECRET")   # enables the bulk_adjust/bulk_status admin requests
+PENDING_TIMEOUT = 3600      # seconds before a shard aborts a cross-shard step the router never finished
+EXPIRY_INTERVAL = 60        # seconds between a shard's scans for expired steps
 
 def client_handler(conn, addr):
     """Handles a new client connection."""
@@ -21,153 +41,549 @@ def client_handler(conn, addr):
 
     with conn:
         print(f"Connected by {addr}")
-        while True:
-            try:
-                data = conn.recv(1024 * 20)
-                request = json.loads(data.decode())  
-                
-                if not data or data.decode() == 'exit':
-                    with clients_lock:
-                        clients_active -= 1
-                    print(f'Client {addr} disconnected. Active clients = {clients_active}')
+        try:
+            channel = protocol.accept_channel(conn)
+            while True:
+                data = channel.recv()
+                if not data or data == b'exit':
                     break
-                
-                request = json.loads(data.decode())  
-                request_queue.put((conn, request))  
-
-            except json.JSONDecodeError:
-                print("__________Received malformed JSON data___________")
-                conn.sendall(json.dumps({"status": "error", "message": "Invalid request format"}).encode())
-       
-def process_request():
-    """Processes requests from clients."""
-    while True:
-        conn, request = request_queue.get()
-        response = {}
-        now = datetime.now()
-        current_time = now.strftime("%H:%M:%S")
-
-        if request["request"] == "signup" or request["request"] == "login":
-            response = handle_authentication(request)
-            utils.update_user_history(request["username"], {"time": current_time, "type": request["request"]})
-
-        elif request["request"] == "transfer":
-            response = handle_transfer(request)
-            if response["status"] == "success":
-                sender, receiver = request["sender"], request["receiver"]
-                utils.update_user_history(sender, {"time": current_time, "type": "send money", 
-                                                   "amount": request["sender_encrypted_amount"],
-                                                   "receiver": receiver})
-                utils.update_user_history(receiver, {"time": current_time, "type": "receive money",
-                                                    "amount": request["receiver_encrypted_amount"],
-                                                    "sender": sender})
-
-        elif request["request"] == "balance":
-            balance_info = handle_balance(request["username"])
-            if balance_info["status"] == "success":
-                utils.update_user_history(request["username"], {"time": current_time, "type": "balance_check",
-                                                                "balance": balance_info["balance"]})
-            response = balance_info
-
-        elif request["request"] == "history":
-            response = fetch_history(request["username"])
+                try:
+                    request = json.loads(data.decode())
+                except (json.JSONDecodeError, UnicodeDecodeError):
+                    print("__________Received malformed JSON data___________")
+                    channel.send({"status": "error", "message": "Invalid request format"})
+                    continue
+                send_response(channel, request, get_scheduler().submit(request, channel))
+        except (OSError, ValueError) as exc:
+            print(f"Connection error from {addr}: {exc}")
+        finally:
+            with clients_lock:
+                clients_active -= 1
+            print(f'Client {addr} disconnected. Active clients = {clients_active}')
 
-        else:
-            response = {"status": "error", "message": "Invalid request type"}
+def send_response(channel, request, response):
+    """Replies to a request; a Future response is sent once it completes."""
+    if isinstance(response, Future):
+        response.add_done_callback(lambda done: send_response(channel, request, result_of(done)))
+        return
+    try:
+        protocol.reply(channel, request, response)
+    except OSError:
+        print("Client disconnected before its response was sent")
+
+def result_of(future):
+    """Returns a finished Future's response, turning a failure into an error response."""
+    try:
+        return future.result()
+    except Exception as exc:
+        print(f"Request failed: {exc!r}")
+        return {"status": "error", "message": "Internal server error"}
+
+def dispatch(request):
+    """Handles one decoded request and returns its response (or a Future for it)."""
+    started = metrics.start_request("wallet")
+    try:
+        response = handle_request(request)
+    except (KeyError, TypeError, ValueError) as exc:
+        print(f"Malformed request: {exc!r}")
+        response = {"status": "error", "message": "Invalid request format"}
+    metrics.finish_request("wallet", request.get("request") if isinstance(request, dict) else None,
+                           started, response)
+    return replication.stamp(response)
+
+# The account a request acts on, which its session token must belong to.
+SESSION_FIELDS = {"balance": "username", "balance_version": "username", "history": "username",
+                  "transfer": "sender", "batch_transfer": "sender", "prepare_debit": "sender",
+                  "logout": "username"}
+
+# Steps of a cross-shard transfer, only accepted from the shard router.
+SHARD_REQUESTS = ("prepare_debit", "prepare_credit", "commit_transfer", "abort_transfer")
+
+# Operations-team requests, only accepted with the admin secret.
+ADMIN_REQUESTS = ("bulk_adjust", "bulk_status")
+
+_auth_pipeline = None
+_auth_pipeline_lock = threading.Lock()
+
+def get_auth_pipeline():
+    """Returns the login/signup pipeline, starting it on first use."""
+    global _auth_pipeline
+    with _auth_pipeline_lock:
+        if _auth_pipeline is None:
+            _auth_pipeline = sessions.AuthPipeline(authenticate)
+        return _auth_pipeline
+
+def handle_request(request):
+    """Routes a request to its handler and records it in the user's history."""
+    response = {}
+    now = datetime.now()
+    current_time = now.strftime("%H:%M:%S")
+
+    history = history_log.get_log()
+
+    if request["request"] in SHARD_REQUESTS and not (
+            SHARD_SECRET and hmac.compare_digest(str(request.get("shard_secret")), SHARD_SECRET)):
+        return {"status": "error", "message": "Invalid request type"}
+
+    if request["request"] in ADMIN_REQUESTS and not (
+            ADMIN_SECRET and hmac.compare_digest(str(request.get("admin_secret")), ADMIN_SECRET)):
+        return {"status": "error", "message": "Invalid request type"}
+
+    field = SESSION_FIELDS.get(request["request"])
+    if field and sessions.REQUIRE_SESSION and \
+            not sessions.get_sessions().validate(request.get("token"), request[field]):
+        return {"status": "error", "message": "Not logged in or session expired"}
+
+    if request["request"] == "stats":
+        response = {"status": "success", "stats": metrics.snapshot()}
 
-        conn.sendall(json.dumps(response).encode())
-        request_queue.task_done()
+    elif request["request"] == "logout":
+        sessions.get_sessions().revoke(request.get("token"))
+        response = {"status": "success", "message": "Logged out"}
+
+    elif request["request"] == "signup" or request["request"] == "login":
+        if not sessions.get_rate_limiter().allow(request["username"]):
+            return {"status": "error", "message": "Too many attempts, retry later"}
+        response = get_auth_pipeline().submit(request)
+        if response is None:
+            return {"status": "error", "message": "Server busy, retry later"}
+
+    elif request["request"] == "transfer":
+        response = handle_transfer(request)
+        if response["status"] == "success":
+            sender, receiver = request["sender"], request["receiver"]
+            with metrics.timed("history_write"):
+                history.append_many([(sender, {"time": current_time, "type": "send money", 
+                                               "amount": codec.for_wire(request["sender_encrypted_amount"], codec.VERSION),
+                                               "receiver": receiver}),
+                                     (receiver, {"time": current_time, "type": "receive money",
+                                                 "amount": codec.for_wire(request["receiver_encrypted_amount"], codec.VERSION),
+                                                 "sender": sender})])
+
+    elif request["request"] == "batch_transfer":
+        response = handle_batch_transfer(request)
+        if response["status"] == "success":
+            sender = request["sender"]
+            entries = []
+            for transfer in request["transfers"]:
+                receiver = transfer["receiver"]
+                entries.append((sender, {"time": current_time, "type": "send money",
+                                         "amount": codec.for_wire(transfer["sender_encrypted_amount"], codec.VERSION),
+                                         "receiver": receiver}))
+                entries.append((receiver, {"time": current_time, "type": "receive money",
+                                           "amount": codec.for_wire(transfer["receiver_encrypted_amount"], codec.VERSION),
+                                           "sender": sender}))
+            with metrics.timed("history_write"):
+                history.append_many(entries)
+
+    elif request["request"] == "balance":
+        balance_info = handle_balance(request["username"], codec.negotiate(request))
+        if balance_info["status"] == "success":
+            with metrics.timed("history_write"):
+                history.append(request["username"], {"time": current_time, "type": "balance_check",
+                                                     "balance": codec.for_wire(balance_info["balance"], codec.VERSION)})
+        response = balance_info
+
+    elif request["request"] == "balance_version":
+        response = handle_balance_version(request["username"])
+
+    elif request["request"] in ("prepare_debit", "prepare_credit"):
+        response = handle_prepare(request)
+
+    elif request["request"] in ("commit_transfer", "abort_transfer"):
+        response = handle_finish(request, current_time)
+
+    elif request["request"] == "bulk_adjust":
+        response = handle_bulk_adjust(request)
+
+    elif request["request"] == "bulk_status":
+        response = handle_bulk_status(request)
+
+    elif request["request"] == "history":
+        response = fetch_history(request["username"], request.get("cursor"), request.get("limit"),
+                                 request.get("since"), request.get("until"),
+                                 codec.negotiate(request), request.get("compress", False))
+
+    else:
+        response = {"status": "error", "message": "Invalid request type"}
+
+    return response
 
 
 def handle_transfer(request):
-    """Handles secure transfer using homomorphic encryption."""
+    """Handles secure transfer using homomorphic encryption.
+
+    Both accounts stay locked from the balance read to the write, so
+    concurrent transfers touching either account cannot lose this update.
+    """
     sender = request["sender"]
     receiver = request["receiver"]
-    
-    users = utils.load_credentials()
-    if sender not in users or receiver not in users:
+    if sender == receiver:
         return {"status": "error", "message": "Invalid sender or receiver"}
 
-    recv_enc_amount = request["receiver_encrypted_amount"]
-    send_enc_amount = request["sender_encrypted_amount"]
+    recv_enc_amount = codec.decode(request["receiver_encrypted_amount"])
+    send_enc_amount = codec.decode(request["sender_encrypted_amount"])
+    expected_version = request.get("expected_version")
 
-    sender_enc_balance = int(users[sender]["balance"])
-    receiver_enc_balance = int(users[receiver]["balance"])
-    sender_public_key = tuple(map(int, users[sender]["public_key"]))
-    receiver_public_key = tuple(map(int, users[receiver]["public_key"]))
-    
-    new_enc_sender_balance = phe.homomorphic_subtraction(sender_enc_balance, send_enc_amount, sender_public_key)
-    new_enc_receiver_balance = phe.homomorphic_addition(receiver_enc_balance, recv_enc_amount, receiver_public_key)
-    users[sender]["balance"] = int(new_enc_sender_balance)
-    users[receiver]["balance"] = int(new_enc_receiver_balance)
-    utils.save_credentials(users)
-    print('saved creds')
-    return {"status": "success", "message": "Transfer completed"}
-
-def handle_balance(username):
-    """Handles balance requests."""
-    users = utils.load_credentials()
+    store = storage.get_store()
+    with locks.get_lock_manager().locked(sender, receiver):
+        with metrics.timed("storage_read"):
+            sender_account = store.get(sender)
+            receiver_account = store.get(receiver)
+        if sender_account is None or receiver_account is None:
+            return {"status": "error", "message": "Invalid sender or receiver"}
+        stale = check_version(sender_account, expected_version)
+        if stale:
+            return stale
+
+        sender_enc_balance = codec.decode(sender_account["balance"])
+        receiver_enc_balance = codec.decode(receiver_account["balance"])
+        
+        with metrics.timed("paillier"):
+            new_enc_sender_balance, new_enc_receiver_balance = workers.run(
+                homomorphic.apply_transfer,
+                sender_account["public_key"], sender_enc_balance, send_enc_amount,
+                receiver_account["public_key"], receiver_enc_balance, recv_enc_amount)
+        with metrics.timed("storage_write"):
+            store.update_many({sender: {"balance": codec.encode(new_enc_sender_balance, sender_account["public_key"])},
+                               receiver: {"balance": codec.encode(new_enc_receiver_balance, receiver_account["public_key"])}})
+    return {"status": "success", "message": "Transfer completed",
+            "version": utils.balance_version(new_enc_sender_balance)}
+
+def handle_batch_transfer(request):
+    """Applies many transfers from one sender as a single atomic update.
+
+    The sender's encrypted debits are combined into one ciphertext and
+    inverted once. Each receiver's credits are applied to its balance. All
+    new balances are committed in a single store write.
+    """
+    sender = request["sender"]
+    transfers = request["transfers"]
+    receivers = {t["receiver"] for t in transfers}
+    if not transfers or sender in receivers:
+        return {"status": "error", "message": "Invalid batch"}
+
+    store = storage.get_store()
+    with locks.get_lock_manager().locked(sender, *receivers):
+        with metrics.timed("storage_read"):
+            sender_account = store.get(sender)
+            receiver_accounts = {r: store.get(r) for r in receivers}
+        unknown = sorted(r for r, account in receiver_accounts.items() if account is None)
+        if sender_account is None or unknown:
+            return {"status": "error", "message": "Invalid sender or receiver", "unknown": unknown}
+        stale = check_version(sender_account, request.get("expected_version"))
+        if stale:
+            return stale
+
+        credits = {r: (a["public_key"], codec.decode(a["balance"]), []) for r, a in receiver_accounts.items()}
+        for transfer in transfers:
+            credits[transfer["receiver"]][2].append(codec.decode(transfer["receiver_encrypted_amount"]))
+        debits = [codec.decode(transfer["sender_encrypted_amount"]) for transfer in transfers]
+
+        with metrics.timed("paillier"):
+            new_sender_balance, new_receiver_balances = workers.run(
+                homomorphic.apply_batch_transfer,
+                sender_account["public_key"], codec.decode(sender_account["balance"]), debits, credits)
+        changes = {r: {"balance": codec.encode(balance, receiver_accounts[r]["public_key"])}
+                   for r, balance in new_receiver_balances.items()}
+        changes[sender] = {"balance": codec.encode(new_sender_balance, sender_account["public_key"])}
+        with metrics.timed("storage_write"):
+            store.update_many(changes)
+    return {"status": "success", "message": "Batch transfer completed", "count": len(transfers),
+            "version": utils.balance_version(new_sender_balance)}
+
+def handle_prepare(request):
+    """First phase of a cross-shard transfer, run on each side's shard.
+
+    prepare_debit takes the amount off the sender's balance at once, and
+    prepare_credit only records the pending credit. Either way the pending
+    step is stored in the account record ("pending", keyed by txid) in the
+    same write, so it survives a crash. Repeating a prepare is harmless,
+    and a prepare arriving after its transfer was finished is refused.
+    """
+    txid = request["txid"]
+    debit = request["request"] == "prepare_debit"
+    username = request["sender"] if debit else request["receiver"]
+    amount = request["sender_encrypted_amount"] if debit else request["receiver_encrypted_amount"]
+
+    store = storage.get_store()
+    with locks.get_lock_manager().locked(username):
+        account = store.get(username)
+        if account is None:
+            return {"status": "error", "message": "Invalid sender or receiver"}
+        pending = dict(account.get("pending", {}))
+        if txid in pending:
+            return {"status": "success", "message": "Prepared", "version": utils.balance_version(account["balance"])}
+        if txid in account.get("finished", {}):
+            return {"status": "error", "message": "Transfer already finished"}
+        pending[txid] = {"op": "debit" if debit else "credit", "amount": codec.for_wire(amount, codec.VERSION),
+                         "peer": request["receiver"] if debit else request["sender"], "time": time.time()}
+        changes = {"pending": pending}
+        if debit:
+            stale = check_version(account, request.get("expected_version"))
+            if stale:
+                return stale
+            with metrics.timed("paillier"):
+                balance = homomorphic.as_public_key(account["public_key"]).subtract(
+                    codec.decode(account["balance"]), codec.decode(amount))
+            changes["balance"] = codec.encode(balance, account["public_key"])
+        with metrics.timed("storage_write"):
+            store.update(username, **changes)
+    return {"status": "success", "message": "Prepared",
+            "version": utils.balance_version(changes.get("balance", account["balance"]))}
+
+def handle_finish(request, current_time):
+    """Second phase of a cross-shard transfer: commits or aborts one side's pending step.
+
+    Committing a credit adds it to the balance; aborting a debit adds the
+    amount back. Both only touch the balance homomorphically, so they are
+    correct whatever happened to the account in between. Finishing an
+    unknown txid succeeds, which makes retries after a crash safe, except
+    committing one that expired. Finished txids are kept ("finished") for
+    PENDING_TIMEOUT so that a prepare delayed past its abort is refused.
+    """
+    txid, username = request["txid"], request["username"]
+    commit = request["request"] == "commit_transfer"
+
+    store = storage.get_store()
+    with locks.get_lock_manager().locked(username):
+        account = store.get(username)
+        if account is None:
+            return {"status": "error", "message": "User not found"}
+        pending = dict(account.get("pending", {}))
+        finished = _recently_finished(account)
+        step = pending.pop(txid, None)
+        if step is None:
+            if txid in finished:
+                if commit and finished[txid][0] == "expired":
+                    return {"status": "error", "message": "Transfer expired"}
+            elif not commit:
+                # The abort overtook its prepare: remember it so the prepare is refused.
+                finished[txid] = ["abort", time.time()]
+                with metrics.timed("storage_write"):
+                    store.update(username, finished=finished)
+            return {"status": "success", "message": "Already finished"}
+        finished[txid] = ["commit" if commit else "abort", time.time()]
+        changes = {"pending": pending, "finished": finished}
+        if (step["op"] == "credit" and commit) or (step["op"] == "debit" and not commit):
+            with metrics.timed("paillier"):
+                balance = homomorphic.as_public_key(account["public_key"]).add(
+                    codec.decode(account["balance"]), codec.decode(step["amount"]))
+            changes["balance"] = codec.encode(balance, account["public_key"])
+        with metrics.timed("storage_write"):
+            store.update(username, **changes)
+    if commit:
+        entry = {"time": current_time, "amount": step["amount"]}
+        if step["op"] == "debit":
+            entry.update(type="send money", receiver=step["peer"])
+        else:
+            entry.update(type="receive money", sender=step["peer"])
+        with metrics.timed("history_write"):
+            history_log.get_log().append(username, entry)
+    return {"status": "success", "message": "Committed" if commit else "Aborted"}
+
+def _recently_finished(account):
+    """Returns the account's finished txids, without those older than PENDING_TIMEOUT."""
+    now = time.time()
+    return {txid: f for txid, f in account.get("finished", {}).items() if now - f[1] < PENDING_TIMEOUT}
+
+def expire_pending():
+    """Aborts cross-shard steps pending longer than PENDING_TIMEOUT; returns how many.
+
+    A step the router never finished (its log was lost, or a prepare was
+    still in flight when the transfer aborted) would otherwise hold a
+    debited amount forever. Expired debits are refunded, and a commit sent
+    later is refused rather than silently applied to one side only.
+    """
+    store = storage.get_store()
+    expired = 0
+    for username in store.usernames():
+        with locks.get_lock_manager().locked(username):
+            account = store.get(username)
+            now = time.time()
+            stale = {txid: step for txid, step in account.get("pending", {}).items()
+                     if now - step["time"] >= PENDING_TIMEOUT} if account else {}
+            if not stale:
+                continue
+            pending = {txid: step for txid, step in account["pending"].items() if txid not in stale}
+            finished = dict(_recently_finished(account), **{txid: ["expired", now] for txid in stale})
+            changes = {"pending": pending, "finished": finished}
+            refunds = [codec.decode(step["amount"]) for step in stale.values() if step["op"] == "debit"]
+            if refunds:
+                with metrics.timed("paillier"):
+                    key = homomorphic.as_public_key(account["public_key"])
+                    balance = key.add(codec.decode(account["balance"]), homomorphic.sum_ciphertexts(key, refunds))
+                changes["balance"] = codec.encode(balance, account["public_key"])
+            with metrics.timed("storage_write"):
+                store.update(username, **changes)
+        expired += len(stale)
+    return expired
+
+def _expiry_loop():
+    while True:
+        time.sleep(EXPIRY_INTERVAL)
+        try:
+            expired = expire_pending()
+        except (OSError, KeyError, ValueError) as exc:
+            print(f"Expiring pending transfers failed: {exc}")
+            continue
+        if expired:
+            print(f"Aborted {expired} expired cross-shard transfer steps")
+
+def handle_bulk_adjust(request):
+    """Starts a bulk adjustment of every account (or of those in "amounts"); see bulk.BulkJob."""
+    try:
+        job_id = bulk.get_engine().submit(request["op"], request.get("amount"), request.get("amounts"),
+                                          request.get("job"))
+    except ValueError as exc:
+        return {"status": "error", "message": str(exc)}
+    return {"status": "success", "message": "Bulk job started", "job": job_id}
+
+def handle_bulk_status(request):
+    """Reports how far a bulk job got."""
+    try:
+        status = bulk.get_engine().status(request["job"])
+    except ValueError as exc:
+        return {"status": "error", "message": str(exc)}
+    if status is None:
+        return {"status": "error", "message": "Unknown job"}
+    return {"status": "success", "job": status}
+
+def check_version(account, expected_version):
+    """Returns a "stale" response if the client's cached balance is out of date, else None.
+
+    Clients that track their balance locally send the version it was read
+    at; a transfer against a balance that has since changed is refused so
+    the client can resync and retry. Requests without a version are not checked.
+    """
+    if expected_version is None:
+        return None
+    version = utils.balance_version(account["balance"])
+    if version == expected_version:
+        return None
+    return {"status": "stale", "message": "Balance changed, resync and retry", "version": version}
+
+def handle_balance(username, version=codec.LEGACY):
+    """Handles balance requests, answering in the client's negotiated ciphertext encoding."""
+    with metrics.timed("storage_read"):
+        account = storage.get_store().get(username)
     
-    if username not in users:
+    if account is None:
         return {"status": "error", "message": "User not found"}
     
-    return {"status": "success", "balance": users[username]["balance"]}
+    return {"status": "success", "balance": codec.for_wire(account["balance"], version),
+            "version": utils.balance_version(account["balance"])}
 
-def fetch_history(username):
-    """Fetches transaction history for a user and sends it to the client."""
-    try:
-        with open(utils.HISTORY_PATH, "r") as history_file:
-            history_data = json.load(history_file)
+def handle_balance_version(username):
+    """Returns only the version of a user's balance, so clients can validate a cached balance."""
+    account = storage.get_store().get(username)
 
-        user_history = history_data.get(username, [])
-        
-        response = {
-            "status": "success",
-            "transactions": user_history
-        }
-        return response
+    if account is None:
+        return {"status": "error", "message": "User not found"}
+
+    return {"status": "success", "version": utils.balance_version(account["balance"])}
 
-    except (FileNotFoundError, json.JSONDecodeError):
+def fetch_history(username, cursor=None, limit=None, since=None, until=None,
+                  version=codec.LEGACY, compress=False):
+    """Fetches a slice of a user's transaction history.
+
+    cursor is the sequence number to resume from (next_cursor of the previous
+    page), limit caps the number of entries and since/until bound the entry
+    timestamps (Unix seconds). next_cursor is None once the slice is exhausted.
+    Ciphertexts use the negotiated encoding; with compress (codec 2 clients
+    only) the page is sent zlib-compressed as "transactions_zlib".
+    """
+    try:
+        user_history, next_cursor = history_log.get_log().read(username, cursor, limit, since, until)
+    except (OSError, ValueError):
         return {"status": "error", "message": "Transaction history not available."}
 
+    user_history = [codec.entry_for_wire(entry, version) for entry in user_history]
+    response = {
+        "status": "success",
+        "transactions": user_history,
+        "next_cursor": next_cursor
+    }
+    if compress and version >= codec.VERSION:
+        response["transactions_zlib"] = codec.compress(response.pop("transactions"))
+    return response
+
+
+_scheduler = None
+_scheduler_lock = threading.Lock()
+
+def get_scheduler():
+    """Returns the request scheduler, starting its lanes on first use."""
+    global _scheduler
+    with _scheduler_lock:
+        if _scheduler is None:
+            _scheduler = scheduler.Scheduler(dispatch).start()
+        return _scheduler
 
-def start_request_workers(num_threads=4):
-    """Starts multiple worker threads to process client requests."""
-    for _ in range(num_threads):
-        threading.Thread(target=process_request, daemon=True).start()
+def authenticate(request, executor=None):
+    """Runs a login or signup on the auth pipeline and opens a session on success."""
+    response = handle_authentication(request, executor)
+    now = datetime.now()
+    history_log.get_log().append(request["username"], {"time": now.strftime("%H:%M:%S"), "type": request["request"]})
+    if response["status"] == "success":
+        response["token"] = sessions.get_sessions().issue(request["username"])
+    return response
 
-def handle_authentication(request):
+def handle_authentication(request, executor=None):
     """Handles login and signup requests."""
-    users = utils.load_credentials()  
+    store = storage.get_store()
     username = request.get("username")
     password = request.get("password")
 
     if request["request"] == "signup":
-        balance = request.get("balance", 0.0)
         public_key = request.get("public_key")
+        balance = codec.encode(codec.decode(request.get("balance", 0)), public_key)
 
-        if username in users:
+        if store.exists(username):
             return {"status": "error", "message": "Username already exists"}
         
-        auth.store_credentials(username, password, balance, public_key)
+        if not auth.store_credentials(username, password, balance, public_key, executor):
+            return {"status": "error", "message": "Username already exists"}
         return {"status": "success", "message": "Sign up successful"}
 
     elif request["request"] == "login":
-        if username not in users:
+        if not store.exists(username):
             return {"status": "error", "message": "Username does not exist"}
         
-        if auth.verify_credentials(username, password):
+        if auth.verify_credentials(username, password, executor):
             return {"status": "success", "message": "Login successful"}
         else:
             return {"status": "error", "message": "Wrong password"}
 
     return {"status": "error", "message": "Invalid request type"}
 
-def start_server(host="127.0.0.1", port=65432):
-    """Starts the server."""
+def prepare_storage():
+    """Creates or migrates the server's data files."""
     utils.initialize_json(utils.FILE_PATH) 
     utils.initialize_json(utils.KEYS_FILE)
-    utils.initialize_json(utils.HISTORY_PATH)
+    history_log.get_log().import_legacy(utils.HISTORY_PATH)
+
+def start_background_jobs():
+    """Starts the server's maintenance threads."""
+    if replication.REPLICAS:
+        replication.start_primary()
+    if CHECKPOINT_HISTORY:
+        checkpoints.CheckpointJob().start()
+    bulk.get_engine().resume()
+    if SHARD_SECRET:
+        threading.Thread(target=_expiry_loop, daemon=True).start()
+    metrics.gauge("wallet_clients_active", lambda: clients_active)
+    metrics.gauge("wallet_auth_queue_depth", lambda: _auth_pipeline.queue.qsize() if _auth_pipeline else 0)
+    lock_manager = locks.get_lock_manager()
+    for key in lock_manager.stats():
+        metrics.gauge(f"wallet_locks_{key}", lambda key=key: lock_manager.stats()[key])
+    metrics.start_exporter()
+
+def start_server(host="127.0.0.1", port=65432, cpu_workers=workers.PROCESSES):
+    """Starts the server; cpu_workers sizes the process pool for PBKDF2 and Paillier work."""
+    workers.configure(cpu_workers)
+    prepare_storage()
+    start_background_jobs()
    
     with socket.socket(socket.AF_INET, socket.SOCK_STREAM) as sfd:
         sfd.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
@@ -175,11 +591,21 @@ def start_server(host="127.0.0.1", port=65432):
         sfd.listen()
         print(f"Server listening on {host}:{port}")
 
-        start_request_workers()  
+        get_scheduler()
 
         while True:
             conn, addr = sfd.accept()
             threading.Thread(target=client_handler, args=(conn, addr)).start()
 
+def start_async_server(host="127.0.0.1", port=65432, cpu_workers=workers.PROCESSES):
+    """Starts the server on an asyncio event loop with a process pool for CPU-bound work."""
+    prepare_storage()
+    start_background_jobs()
+    print(f"Server listening on {host}:{port} (asyncio, {cpu_workers} CPU workers)")
+    async_server.run(dispatch, host, port, cpu_workers=cpu_workers, scheduler=get_scheduler())
+
 if __name__ == "__main__":
-    start_server()
+    if "--async" in sys.argv:
+        start_async_server()
+    else:
+        start_server()
@@ -0,0 +1,149 @@
+import base64
+import hashlib
+import hmac
+import multiprocessing
+import os
+import queue
+import secrets
+import threading
+import time
+from concurrent.futures import Future, ProcessPoolExecutor
+
+SESSION_TTL = 3600          # seconds a session token stays valid
+REQUIRE_SESSION = True      # balance/transfer/history need a token from login
+LOGIN_BURST = 5             # login/signup attempts a user may make back to back
+LOGIN_REFILL_SECONDS = 10   # one more attempt is allowed every this many seconds
+AUTH_QUEUE_SIZE = 256       # queued logins/signups before new ones are refused
+AUTH_THREADS = 8            # threads driving the authentication pipeline
+AUTH_PROCESSES = int(os.environ.get("WALLET_AUTH_WORKERS", os.cpu_count() or 1))   # 0 hashes inline
+
+
+def _b64(data):
+    return base64.urlsafe_b64encode(data).rstrip(b"=").decode()
+
+
+class SessionManager:
+    """Issues signed, expiring session tokens and checks them against a table.
+
+    A token is "<username>.<expiry>.<nonce>.<HMAC-SHA256>" (URL-safe base64
+    fields). validate() is a dictionary lookup; verify_signature() checks a
+    token without the table, for processes that only share the secret.
+    """
+
+    def __init__(self, secret=None, ttl=SESSION_TTL):
+        self.secret = secret or secrets.token_bytes(32)
+        self.ttl = ttl
+        self._sessions = {}
+        self._lock = threading.Lock()
+        self._next_purge = time.time() + ttl
+
+    def _sign(self, body):
+        return _b64(hmac.new(self.secret, body.encode(), hashlib.sha256).digest())
+
+    def issue(self, username):
+        expiry = int(time.time() + self.ttl)
+        body = f"{_b64(username.encode())}.{expiry}.{_b64(secrets.token_bytes(12))}"
+        token = f"{body}.{self._sign(body)}"
+        with self._lock:
+            self._sessions[token] = (username, expiry)
+            if time.time() >= self._next_purge:
+                self._purge_locked()
+        return token
+
+    def validate(self, token, username):
+        """Returns True if token is a live session of username."""
+        with self._lock:
+            session = self._sessions.get(token)
+        return session is not None and session[0] == username and session[1] > time.time()
+
+    def verify_signature(self, token):
+        """Returns the username a token was signed for, or None if it is forged or expired."""
+        try:
+            body, signature = token.rsplit(".", 1)
+            user_field, expiry, _ = body.split(".")
+            username = base64.urlsafe_b64decode(user_field + "=" * (-len(user_field) % 4)).decode()
+        except (AttributeError, ValueError):
+            return None
+        if not hmac.compare_digest(signature, self._sign(body)) or int(expiry) <= time.time():
+            return None
+        return username
+
+    def revoke(self, token):
+        """Ends a session at logout. Replicas, which only check signatures, accept it until it expires."""
+        with self._lock:
+            self._sessions.pop(token, None)
+
+    def _purge_locked(self):
+        now = time.time()
+        self._sessions = {t: s for t, s in self._sessions.items() if s[1] > now}
+        self._next_purge = now + self.ttl
+
+
+class LoginRateLimiter:
+    """Per-user token bucket limiting how often PBKDF2 runs for one username."""
+
+    def __init__(self, burst=LOGIN_BURST, refill_seconds=LOGIN_REFILL_SECONDS):
+        self.burst = burst
+        self.refill_seconds = refill_seconds
+        self._buckets = {}
+        self._lock = threading.Lock()
+
+    def allow(self, username):
+        now = time.monotonic()
+        with self._lock:
+            tokens, last = self._buckets.get(username, (self.burst, now))
+            tokens = min(self.burst, tokens + (now - last) / self.refill_seconds)
+            if tokens < 1:
+                self._buckets[username] = (tokens, now)
+                return False
+            self._buckets[username] = (tokens - 1, now)
+            if len(self._buckets) > 100000:
+                self._buckets = {u: b for u, b in self._buckets.items()
+                                 if b[0] + (now - b[1]) / self.refill_seconds < self.burst}
+            return True
+
+
+class AuthPipeline:
+    """Runs logins and signups apart from the general request workers.
+
+    Requests wait in a bounded queue for one of the pipeline's threads, which
+    call handler(request, executor) with the pipeline's own PBKDF2 process
+    pool. submit() returns None instead of queueing once the queue is full.
+    """
+
+    def __init__(self, handler, threads=AUTH_THREADS, queue_size=AUTH_QUEUE_SIZE, processes=AUTH_PROCESSES):
+        self.handler = handler
+        self.queue = queue.Queue(maxsize=queue_size)
+        self.executor = None
+        if processes:
+            self.executor = ProcessPoolExecutor(processes, mp_context=multiprocessing.get_context("spawn"))
+        for _ in range(threads):
+            threading.Thread(target=self._run, daemon=True).start()
+
+    def submit(self, request):
+        """Queues a request; returns a Future for its response, or None if the pipeline is full."""
+        future = Future()
+        try:
+            self.queue.put_nowait((request, future))
+        except queue.Full:
+            return None
+        return future
+
+    def _run(self):
+        while True:
+            request, future = self.queue.get()
+            try:
+                future.set_result(self.handler(request, self.executor))
+            except Exception as exc:
+                future.set_exception(exc)
+            self.queue.task_done()
+
+
+_sessions = SessionManager()
+_rate_limiter = LoginRateLimiter()
+
+def get_sessions():
+    return _sessions
+
+def get_rate_limiter():
+    return _rate_limiter
@@ -0,0 +1,295 @@
+import atexit
+import hashlib
+import multiprocessing
+import os
+import secrets
+import socket
+import sys
+import threading
+import time
+from concurrent.futures import Future
+import async_server
+import metrics
+import protocol
+import storage
+
+SHARDS = int(os.environ.get("WALLET_SHARDS", os.cpu_count() or 1))
+BASE_PORT = 65440          # shard i listens on BASE_PORT + i
+SHARD_DIR = "shards"       # shard i keeps its data files in shards/<i>
+TX_LOG = "router.txlog"    # the router's log of cross-shard transfer decisions
+RECOVERY_INTERVAL = 5      # seconds between retries of unfinished cross-shard transfers
+TRUNCATE_EVERY = 1000      # finished transfers between truncations of the router log
+
+# The field naming the account a request belongs to, which decides its shard.
+ROUTE_FIELDS = {"signup": "username", "login": "username", "logout": "username", "balance": "username",
+                "balance_version": "username", "history": "username",
+                "transfer": "sender", "batch_transfer": "sender"}
+
+
+def shard_of(username, shards):
+    """Returns the shard index owning username."""
+    digest = hashlib.blake2b(username.encode(), digest_size=8).digest()
+    return int.from_bytes(digest, "big") % shards
+
+
+class Router:
+    """Forwards each request to the shard owning its account.
+
+    Transfers whose sender and receiver live on different shards are run
+    here as a two-phase commit: prepare_debit on the sender's shard and
+    prepare_credit on the receiver's, then commit_transfer or
+    abort_transfer on both. Every decision is logged before it is sent,
+    and unfinished transfers are retried on startup and every
+    RECOVERY_INTERVAL seconds (no commit logged means abort). Bulk
+    adjustments run as one job, under one id, on every shard.
+    """
+
+    def __init__(self, ports, secret, log_path=TX_LOG):
+        self.ports = ports
+        self.secret = secret
+        self._clients = [None] * len(ports)
+        self._clients_lock = threading.Lock()
+        self._log = storage.WriteAheadLog(log_path)
+        self._tx_lock = threading.Lock()
+        self._unfinished = {}
+        self._finished = 0
+        # Replayed transfers without a logged decision were cut off mid-prepare: presume abort.
+        for record in self._log.replay():
+            if record["state"] == "begin":
+                self._unfinished[record["txid"]] = dict(record, state="abort", decided=False)
+            elif record["txid"] in self._unfinished:
+                if record["state"] == "done":
+                    del self._unfinished[record["txid"]]
+                else:
+                    self._unfinished[record["txid"]].update(state=record["state"], decided=True)
+        for record in self._unfinished.values():
+            if not record["decided"]:
+                self._log.append({"txid": record["txid"], "state": "abort"})
+                record["decided"] = True
+
+    def _client(self, shard):
+        with self._clients_lock:
+            client = self._clients[shard]
+            if client is None:
+                sock = socket.create_connection(("127.0.0.1", self.ports[shard]))
+                client = self._clients[shard] = protocol.Client(sock)
+            return client
+
+    def _submit(self, shard, request):
+        """Sends a request to a shard; returns a Future, failed if the shard is unreachable."""
+        request = {k: v for k, v in request.items() if k != "id"}
+        try:
+            return self._client(shard).submit(request)
+        except OSError as exc:
+            with self._clients_lock:
+                self._clients[shard] = None
+            future = Future()
+            future.set_exception(exc)
+            return future
+
+    def _call(self, shard, request):
+        try:
+            return self._submit(shard, request).result()
+        except (OSError, ConnectionError) as exc:
+            with self._clients_lock:
+                self._clients[shard] = None
+            return {"status": "error", "message": f"Shard {shard} unavailable: {exc}"}
+
+    def handle(self, request):
+        started = metrics.start_request("router")
+        try:
+            response = self._route(request)
+        except (KeyError, TypeError, ValueError, AttributeError):
+            response = {"status": "error", "message": "Invalid request format"}
+        metrics.finish_request("router", request.get("request") if isinstance(request, dict) else None,
+                               started, response)
+        return response
+
+    def _route(self, request):
+        kind = request["request"]
+        if kind == "stats":
+            return {"status": "success", "stats": metrics.snapshot(),
+                    "shards": [self._call(i, request).get("stats") for i in range(len(self.ports))]}
+        if kind == "bulk_adjust":
+            return self.bulk_adjust(request)
+        if kind == "bulk_status":
+            return self.bulk_status(request)
+        field = ROUTE_FIELDS.get(kind)
+        if field is None:
+            return {"status": "error", "message": "Invalid request type"}
+        shard = shard_of(request[field], len(self.ports))
+        if kind == "transfer" and shard_of(request["receiver"], len(self.ports)) != shard:
+            return self.cross_shard_transfer(request, shard)
+        if kind == "batch_transfer" and any(shard_of(t["receiver"], len(self.ports)) != shard
+                                            for t in request["transfers"]):
+            return {"status": "error", "message": "Batch receivers must be on the sender's shard"}
+        return self._submit(shard, request)
+
+    def _broadcast(self, requests):
+        """Sends {shard: request} to the shards at once; returns {shard: response}."""
+        futures = {shard: self._submit(shard, r) for shard, r in requests.items()}
+        results = {}
+        for shard, future in futures.items():
+            try:
+                results[shard] = future.result()
+            except (OSError, ConnectionError) as exc:
+                results[shard] = {"status": "error", "message": f"Shard {shard} unavailable: {exc}"}
+        return results
+
+    def bulk_adjust(self, request):
+        """Starts the same bulk job on every shard, each adjusting the accounts it owns.
+
+        Per-account "amounts" are split by owner, and shards owning none of
+        them are skipped. The shards check the admin secret themselves.
+        """
+        job_id = secrets.token_hex(8)
+        requests = {}
+        for shard in range(len(self.ports)):
+            shard_request = dict(request, job=job_id)
+            if "amounts" in request:
+                shard_request["amounts"] = {u: c for u, c in request["amounts"].items()
+                                            if shard_of(u, len(self.ports)) == shard}
+                if not shard_request["amounts"]:
+                    continue
+            requests[shard] = shard_request
+        results = self._broadcast(requests)
+        failed = [r for r in results.values() if r["status"] != "success"]
+        if failed:
+            # Validation fails alike on every shard; a partial start means a shard was down.
+            return dict(failed[0], job=job_id) if len(failed) < len(results) else failed[0]
+        return {"status": "success", "message": "Bulk job started", "job": job_id}
+
+    def bulk_status(self, request):
+        """Adds up a bulk job's progress over the shards running it."""
+        results = self._broadcast({shard: request for shard in range(len(self.ports))})
+        jobs = [r["job"] for r in results.values() if r["status"] == "success"]
+        errors = [r for r in results.values() if r["status"] != "success" and r.get("message") != "Unknown job"]
+        if errors or not jobs:
+            return errors[0] if errors else {"status": "error", "message": "Unknown job"}
+        status = {"job": request["job"], "op": jobs[0]["op"], "finished": all(j["finished"] for j in jobs)}
+        for field in ("total", "done", "adjusted"):
+            status[field] = sum(j[field] for j in jobs)
+        return {"status": "success", "job": status}
+
+    def cross_shard_transfer(self, request, sender_shard):
+        sender, receiver = request["sender"], request["receiver"]
+        receiver_shard = shard_of(receiver, len(self.ports))
+        txid = secrets.token_hex(12)
+        record = {"txid": txid, "sender": sender, "receiver": receiver,
+                  "shards": [sender_shard, receiver_shard], "state": "abort", "decided": False}
+        with self._tx_lock:
+            self._unfinished[txid] = record
+            self._log.append({k: v for k, v in record.items() if k != "decided"} | {"state": "begin"})
+
+        base = {"txid": txid, "sender": sender, "receiver": receiver, "shard_secret": self.secret}
+        debit = self._submit(sender_shard, dict(
+            base, request="prepare_debit", sender_encrypted_amount=request["sender_encrypted_amount"],
+            expected_version=request.get("expected_version"), token=request.get("token")))
+        credit = self._submit(receiver_shard, dict(
+            base, request="prepare_credit", receiver_encrypted_amount=request["receiver_encrypted_amount"]))
+        results = []
+        for future in (debit, credit):
+            try:
+                results.append(future.result())
+            except (OSError, ConnectionError) as exc:
+                results.append({"status": "error", "message": f"Shard unavailable: {exc}"})
+
+        state = "commit" if all(r["status"] == "success" for r in results) else "abort"
+        with self._tx_lock:
+            self._log.append({"txid": txid, "state": state})
+            record.update(state=state, decided=True)
+        self._finish(record)
+        if state == "commit":
+            return {"status": "success", "message": "Transfer completed", "version": results[0].get("version")}
+        return next(r for r in results if r["status"] != "success")
+
+    def _finish(self, record):
+        """Sends the logged decision to both shards; returns True once both have applied it."""
+        kind = "commit_transfer" if record["state"] == "commit" else "abort_transfer"
+        sender_shard, receiver_shard = record["shards"]
+        replies = [self._call(sender_shard, {"request": kind, "txid": record["txid"],
+                                             "username": record["sender"], "shard_secret": self.secret}),
+                   self._call(receiver_shard, {"request": kind, "txid": record["txid"],
+                                               "username": record["receiver"], "shard_secret": self.secret})]
+        if any(r["status"] != "success" for r in replies):
+            return False
+        with self._tx_lock:
+            self._unfinished.pop(record["txid"], None)
+            self._log.enqueue({"txid": record["txid"], "state": "done"})
+            self._finished += 1
+            if not self._unfinished and self._finished >= TRUNCATE_EVERY:
+                self._log.truncate()
+                self._finished = 0
+        return True
+
+    def recover(self):
+        """Re-sends the decision of every decided but unfinished cross-shard transfer."""
+        with self._tx_lock:
+            unfinished = [r for r in self._unfinished.values() if r["decided"]]
+        for record in unfinished:
+            self._finish(record)
+
+    def _recovery_loop(self):
+        while True:
+            self.recover()
+            time.sleep(RECOVERY_INTERVAL)
+
+    def start_recovery(self):
+        threading.Thread(target=self._recovery_loop, daemon=True).start()
+
+
+def run_shard(index, port, cpu_workers):
+    """Entry point of one shard process: a full wallet server in its own data directory."""
+    import server
+    directory = os.path.join(SHARD_DIR, str(index))
+    os.makedirs(directory, exist_ok=True)
+    os.chdir(directory)
+    server.start_async_server(port=port, cpu_workers=cpu_workers)
+
+
+def wait_for_port(port, timeout=30):
+    deadline = time.monotonic() + timeout
+    while True:
+        try:
+            socket.create_connection(("127.0.0.1", port)).close()
+            return
+        except ConnectionRefusedError:
+            if time.monotonic() > deadline:
+                raise
+            time.sleep(0.1)
+
+
+def start_cluster(shards=SHARDS, host="127.0.0.1", port=65432, base_port=BASE_PORT, cpu_workers=0,
+                  with_vault=True):
+    """Starts shard processes and the key vault, then serves the router on host:port.
+
+    cpu_workers is the process pool size inside each shard; with one shard
+    per core the default of 0 keeps Paillier math inline in the shard.
+    """
+    secret = os.environ.setdefault("WALLET_SHARD_SECRET", secrets.token_hex(16))
+    context = multiprocessing.get_context("spawn")
+    ports = [base_port + i for i in range(shards)]
+    # Shards start their own worker pools, so they cannot be daemonic; stop them on exit instead.
+    processes = [context.Process(target=run_shard, args=(index, shard_port, cpu_workers))
+                 for index, shard_port in enumerate(ports)]
+    for process in processes:
+        process.start()
+        atexit.register(process.terminate)
+    if with_vault:
+        import third_party
+        threading.Thread(target=third_party.start_async_server, kwargs={"host": host, "port": port - 1},
+                         daemon=True).start()
+    for shard_port in ports:
+        wait_for_port(shard_port)
+
+    router = Router(ports, secret)
+    router.recover()
+    router.start_recovery()
+    metrics.start_exporter()
+    print(f"Router listening on {host}:{port} ({shards} shards on ports {ports[0]}-{ports[-1]})")
+    async_server.run(router.handle, host, port)
+
+
+if __name__ == "__main__":
+    count = int(sys.argv[sys.argv.index("--shards") + 1]) if "--shards" in sys.argv else SHARDS
+    start_cluster(count)
@@ -0,0 +1,327 @@
+import json
+import os
+import sqlite3
+import threading
+import utils
+import metrics
+
+BACKEND = os.environ.get("WALLET_STORE", "memory")   # "memory", "sqlite" or "sqlite-shared"
+DB_PATH = "wallet.db"
+WAL_SUFFIX = ".wal"
+CHECKPOINT_EVERY = 1000   # WAL records between checkpoints of the memory store
+
+
+class WriteAheadLog:
+    """Append-only JSON-lines log with group commit.
+
+    Records are queued with enqueue() and made durable with wait(). Whoever
+    finds no flush in progress writes and fsyncs every queued record at once,
+    so concurrent writers share a single fsync.
+    """
+
+    def __init__(self, path):
+        self.path = path
+        self._file = open(path, "a", encoding="utf-8")
+        self._cond = threading.Condition()
+        self._pending = []
+        self._queued = 0
+        self._durable = 0
+        self._flushing = False
+
+    def enqueue(self, record):
+        """Queues a record and returns the ticket to pass to wait()."""
+        with self._cond:
+            self._pending.append(json.dumps(record) + "\n")
+            self._queued += 1
+            return self._queued
+
+    def wait(self, ticket):
+        """Blocks until the record with this ticket has been fsynced."""
+        with self._cond:
+            while self._durable < ticket:
+                if self._flushing:
+                    self._cond.wait()
+                    continue
+                self._flushing = True
+                batch, self._pending = self._pending, []
+                upto = self._queued
+                self._cond.release()
+                try:
+                    with metrics.timed("wal_fsync"):
+                        self._file.write("".join(batch))
+                        self._file.flush()
+                        os.fsync(self._file.fileno())
+                except OSError:
+                    self._cond.acquire()
+                    self._pending[:0] = batch
+                    self._flushing = False
+                    self._cond.notify_all()
+                    raise
+                self._cond.acquire()
+                self._flushing = False
+                self._durable = upto
+                self._cond.notify_all()
+
+    def append(self, record):
+        self.wait(self.enqueue(record))
+
+    def sync(self):
+        """Makes every queued record durable."""
+        with self._cond:
+            ticket = self._queued
+        self.wait(ticket)
+
+    def replay(self):
+        """Returns the logged records, ignoring a torn last line left by a crash."""
+        records = []
+        with open(self.path, "r", encoding="utf-8") as f:
+            for line in f:
+                try:
+                    records.append(json.loads(line))
+                except json.JSONDecodeError:
+                    break
+        return records
+
+    def truncate(self):
+        self.sync()
+        with self._cond:
+            self._file.truncate(0)
+            self._file.flush()
+            os.fsync(self._file.fileno())
+
+    def close(self):
+        self.sync()
+        self._file.close()
+
+
+class AccountStore:
+    """Interface shared by the account-store backends.
+
+    Records are dicts with "pwd", "balance" and "public_key" fields, keyed
+    by username. Updates are per record and update_many() is atomic.
+    """
+
+    def get(self, username):
+        raise NotImplementedError
+
+    def exists(self, username):
+        return self.get(username) is not None
+
+    def create(self, username, record):
+        """Adds a new account; returns False if the username is taken."""
+        raise NotImplementedError
+
+    def update_many(self, changes):
+        """Atomically applies {username: {field: value}} to existing accounts."""
+        raise NotImplementedError
+
+    def update(self, username, **fields):
+        self.update_many({username: fields})
+
+    def usernames(self):
+        raise NotImplementedError
+
+    def checkpoint(self):
+        pass
+
+    def close(self):
+        pass
+
+
+class MemoryAccountStore(AccountStore):
+    """In-memory account index with an optional WAL and checkpoint file.
+
+    With a path, the checkpoint is the legacy credentials.json layout and
+    every change is logged to <path>.wal before it is acknowledged. The
+    checkpoint is rewritten atomically every CHECKPOINT_EVERY records.
+    Without a path nothing is persisted.
+    """
+
+    def __init__(self, path=None, checkpoint_every=CHECKPOINT_EVERY):
+        self.path = path
+        self.checkpoint_every = checkpoint_every
+        self._lock = threading.Lock()
+        self._accounts = {}
+        self._wal = None
+        self._since_checkpoint = 0
+        if path is None:
+            return
+        try:
+            with open(path, "r") as f:
+                self._accounts = json.load(f)
+        except (FileNotFoundError, json.JSONDecodeError):
+            self._accounts = {}
+        self._wal = WriteAheadLog(path + WAL_SUFFIX)
+        records = self._wal.replay()
+        for record in records:
+            self._apply(record)
+        self._since_checkpoint = len(records)
+
+    def _apply(self, record):
+        if record["op"] == "create":
+            self._accounts[record["username"]] = record["record"]
+        else:
+            for username, fields in record["changes"].items():
+                self._accounts[username].update(fields)
+
+    def _commit_locked(self, record):
+        """Applies and logs a record; returns a WAL ticket to wait on, if any."""
+        self._apply(record)
+        if self._wal is None:
+            return None
+        ticket = self._wal.enqueue(record)
+        self._since_checkpoint += 1
+        if self._since_checkpoint >= self.checkpoint_every:
+            self._checkpoint_locked()
+            return None
+        return ticket
+
+    def _wait(self, ticket):
+        if ticket is not None:
+            self._wal.wait(ticket)
+
+    def get(self, username):
+        with self._lock:
+            record = self._accounts.get(username)
+            return dict(record) if record is not None else None
+
+    def create(self, username, record):
+        with self._lock:
+            if username in self._accounts:
+                return False
+            ticket = self._commit_locked({"op": "create", "username": username, "record": dict(record)})
+        self._wait(ticket)
+        return True
+
+    def update_many(self, changes):
+        with self._lock:
+            missing = [u for u in changes if u not in self._accounts]
+            if missing:
+                raise KeyError(missing[0])
+            ticket = self._commit_locked({"op": "update", "changes": changes})
+        self._wait(ticket)
+
+    def usernames(self):
+        with self._lock:
+            return list(self._accounts)
+
+    def _checkpoint_locked(self):
+        self._wal.sync()
+        utils.atomic_write_json(self.path, self._accounts)
+        self._wal.truncate()
+        self._since_checkpoint = 0
+
+    def checkpoint(self):
+        if self._wal is not None:
+            with self._lock:
+                self._checkpoint_locked()
+
+    def close(self):
+        if self._wal is not None:
+            self.checkpoint()
+            self._wal.close()
+
+
+class SQLiteAccountStore(AccountStore):
+    """SQLite-backed account store with an in-memory read index.
+
+    SQLite runs in WAL journal mode, so each update is an append to its log
+    and checkpoint() folds the log back into the database file. Accounts
+    found in a legacy credentials.json are imported on first open. With
+    shared=True the index is bypassed and every read goes to the database,
+    so several server processes can share one file.
+    """
+
+    def __init__(self, path=DB_PATH, legacy_path=utils.FILE_PATH, shared=False):
+        self.path = path
+        self.shared = shared
+        self._lock = threading.Lock()
+        self._db = sqlite3.connect(path, check_same_thread=False, isolation_level=None)
+        self._db.execute("PRAGMA journal_mode=WAL")
+        self._db.execute("PRAGMA synchronous=NORMAL")
+        self._db.execute("CREATE TABLE IF NOT EXISTS accounts (username TEXT PRIMARY KEY, data TEXT NOT NULL)")
+        self._accounts = {u: json.loads(d) for u, d in self._db.execute("SELECT username, data FROM accounts")}
+        if not self._accounts and legacy_path and os.path.exists(legacy_path):
+            try:
+                with open(legacy_path, "r") as f:
+                    legacy = json.load(f)
+            except json.JSONDecodeError:
+                legacy = {}
+            for username, record in legacy.items():
+                self.create(username, record)
+
+    def _read(self, username):
+        if not self.shared:
+            return self._accounts.get(username)
+        row = self._db.execute("SELECT data FROM accounts WHERE username = ?", (username,)).fetchone()
+        return json.loads(row[0]) if row else None
+
+    def get(self, username):
+        with self._lock:
+            record = self._read(username)
+            return dict(record) if record is not None else None
+
+    def create(self, username, record):
+        with self._lock:
+            try:
+                self._db.execute("INSERT INTO accounts VALUES (?, ?)", (username, json.dumps(record)))
+            except sqlite3.IntegrityError:
+                return False
+            self._accounts[username] = dict(record)
+            return True
+
+    def update_many(self, changes):
+        with self._lock:
+            with self._db:
+                self._db.execute("BEGIN IMMEDIATE")
+                current = {u: self._read(u) for u in changes}
+                missing = [u for u, r in current.items() if r is None]
+                if missing:
+                    raise KeyError(missing[0])
+                updated = {u: dict(current[u], **fields) for u, fields in changes.items()}
+                self._db.executemany("UPDATE accounts SET data = ? WHERE username = ?",
+                                     [(json.dumps(r), u) for u, r in updated.items()])
+            self._accounts.update(updated)
+
+    def usernames(self):
+        with self._lock:
+            if self.shared:
+                return [u for (u,) in self._db.execute("SELECT username FROM accounts")]
+            return list(self._accounts)
+
+    def checkpoint(self):
+        with self._lock:
+            self._db.execute("PRAGMA wal_checkpoint(TRUNCATE)")
+
+    def close(self):
+        self.checkpoint()
+        self._db.close()
+
+
+_store = None
+_store_lock = threading.Lock()
+
+def open_store(backend=None, path=None):
+    """Builds an account store for the given backend name."""
+    backend = backend or BACKEND
+    if backend == "memory":
+        return MemoryAccountStore(path if path is not None else utils.FILE_PATH)
+    if backend == "sqlite":
+        return SQLiteAccountStore(path or DB_PATH)
+    if backend == "sqlite-shared":
+        return SQLiteAccountStore(path or DB_PATH, shared=True)
+    raise ValueError(f"Unknown account store backend: {backend}")
+
+def get_store():
+    """Returns the process-wide account store, opening it on first use."""
+    global _store
+    with _store_lock:
+        if _store is None:
+            _store = open_store()
+        return _store
+
+def set_store(store):
+    """Replaces the process-wide account store (e.g. with MemoryAccountStore())."""
+    global _store
+    with _store_lock:
+        _store = store
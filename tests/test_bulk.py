@@ -0,0 +1,160 @@
+import time
+from concurrent.futures import Future
+
+import pytest
+
+import bulk
+import checkpoints
+import codec
+import history_log
+import homomorphic
+import shards
+import storage
+import utils
+
+
+@pytest.fixture
+def wallet(monkeypatch):
+    """Ten accounts holding 100 each, in a fresh store and history log."""
+    monkeypatch.setattr(storage, "_store", storage.MemoryAccountStore("credentials.json"))
+    monkeypatch.setattr(history_log, "_log", history_log.HistoryLog())
+    public_key, private_key = homomorphic.generate_keypair()
+    wire_key = utils.serialize_key(public_key)
+    for i in range(10):
+        storage.get_store().create(f"user{i}", {"pwd": "x", "public_key": wire_key,
+                                                "balance": codec.encode(public_key.encrypt(100), wire_key)})
+    return public_key, private_key
+
+
+def balance(private_key, username):
+    return private_key.decrypt(codec.decode(storage.get_store().get(username)["balance"]))
+
+
+def adjustments(username):
+    return [e for e in history_log.get_log().read(username)[0] if e["type"] == "adjustment"]
+
+
+def wait(engine, job_id):
+    deadline = time.monotonic() + 10
+    while not engine.status(job_id)["finished"]:
+        assert time.monotonic() < deadline
+        time.sleep(0.01)
+    return engine.status(job_id)
+
+
+def test_credit_reaches_every_account_once(wallet):
+    _, private_key = wallet
+    engine = bulk.BulkEngine(batch_size=3)
+    status = wait(engine, engine.submit("credit", amount=5))
+    assert (status["total"], status["done"], status["adjusted"]) == (10, 10, 10)
+    assert {balance(private_key, f"user{i}") for i in range(10)} == {105}
+    assert [e["op"] for e in adjustments("user7")] == ["credit"]
+
+
+def test_job_resumed_after_crash_mid_batch_applies_once(wallet):
+    _, private_key = wallet
+    engine = bulk.BulkEngine(batch_size=4)
+    spec = {"op": "credit", "amount": 1, "started": time.time(), "usernames": sorted(storage.get_store().usernames())}
+    utils.atomic_write_json(f"{bulk.JOB_DIR}/0b1.json", spec)
+    job = bulk.BulkJob("0b1", spec, bulk.JOB_DIR, 4)
+    job.run_batch(spec["usernames"][:4])
+    utils.atomic_write_json(job.progress_path, dict(job.progress, done=4, adjusted=4))
+    job.run_batch(spec["usernames"][4:6])   # died before the batch's progress was saved
+
+    engine.resume()
+    status = wait(engine, "0b1")
+    assert status["adjusted"] == 10 - 2
+    for username in spec["usernames"]:
+        assert balance(private_key, username) == 101
+        assert len(adjustments(username)) == 1
+
+
+def test_interrupted_job_keeps_its_markers_while_a_later_job_runs(wallet):
+    _, private_key = wallet
+    engine = bulk.BulkEngine(batch_size=4)
+    usernames = sorted(storage.get_store().usernames())
+    first = {"op": "credit", "amount": 1, "started": time.time() - 1, "usernames": usernames}
+    second = {"op": "credit", "amount": 10, "started": time.time(), "usernames": usernames}
+    utils.atomic_write_json(f"{bulk.JOB_DIR}/b1.json", first)
+    utils.atomic_write_json(f"{bulk.JOB_DIR}/a1.json", second)
+    bulk.BulkJob("b1", first, bulk.JOB_DIR, 4).run_batch(usernames[:2])   # died before saving progress
+
+    engine.resume()
+    wait(engine, "b1")
+    wait(engine, "a1")
+    assert {balance(private_key, u) for u in usernames} == {111}
+    assert all(len(adjustments(u)) == 2 for u in usernames)
+
+
+def test_debit_past_zero_reads_as_negative(wallet):
+    _, private_key = wallet
+    engine = bulk.BulkEngine()
+    wait(engine, engine.submit("debit", amount=130))
+    assert balance(private_key, "user0") == -30
+    assert homomorphic.decrypt_many(private_key, [codec.decode(adjustments("user0")[0]["amount"])]) == [130]
+
+
+def test_checkpoints_fold_adjustments_into_period_totals(wallet):
+    _, private_key = wallet
+    engine = bulk.BulkEngine()
+    wait(engine, engine.submit("credit", amount=5))
+    wait(engine, engine.submit("debit", amount=3))
+    policy = checkpoints.CheckpointPolicy(max_age_days=None, max_entries=0)
+    assert checkpoints.checkpoint_user("user0", policy) == 2
+    [checkpoint] = history_log.get_log().read("user0")[0]
+    assert (checkpoint["received_count"], checkpoint["sent_count"]) == (1, 1)
+    assert homomorphic.decrypt_many(private_key, [codec.decode(checkpoint["received"]),
+                                                  codec.decode(checkpoint["sent"])]) == [5, 3]
+
+
+def test_per_account_ciphertexts_only_touch_listed_accounts(wallet):
+    public_key, private_key = wallet
+    engine = bulk.BulkEngine()
+    job_id = engine.submit("credit", amounts={"user1": int(public_key.encrypt(7)), "ghost": 1})
+    assert wait(engine, job_id)["adjusted"] == 1
+    assert balance(private_key, "user1") == 107
+    assert balance(private_key, "user2") == 100
+
+
+def test_invalid_jobs_are_refused(wallet):
+    engine = bulk.BulkEngine()
+    with pytest.raises(ValueError):
+        engine.submit("multiply", amount=2)
+    with pytest.raises(ValueError):
+        engine.submit("credit", amount=-1)
+    wait(engine, engine.submit("credit", amount=1, job_id="abc"))
+    with pytest.raises(ValueError):
+        engine.submit("credit", amount=1, job_id="abc")
+    with pytest.raises(ValueError):
+        engine.submit("credit", amount=1, job_id="../x")
+    with pytest.raises(ValueError):
+        engine.status("../credentials")
+    assert engine.status("fff") is None
+
+
+def test_router_runs_one_job_on_every_shard(monkeypatch):
+    sent = []
+
+    def submit(shard, request):
+        sent.append((shard, request))
+        future = Future()
+        if request["request"] == "bulk_adjust":
+            future.set_result({"status": "success", "job": request["job"]})
+        elif shard == 0:
+            future.set_result({"status": "success", "job": {"op": "credit", "total": 3, "done": 3,
+                                                            "adjusted": 3, "finished": True}})
+        else:
+            future.set_result({"status": "error", "message": "Unknown job"})
+        return future
+
+    router = shards.Router([1, 2], "secret")
+    router._submit = submit
+    amounts = {u: 1 for u in ("alice", "bob", "carol", "dave")}
+    response = router.handle({"request": "bulk_adjust", "op": "credit", "amounts": amounts})
+    assert response["status"] == "success"
+    for shard, request in sent:
+        assert request["job"] == response["job"]
+        assert all(shards.shard_of(u, 2) == shard for u in request["amounts"])
+    assert sorted(u for _, r in sent for u in r["amounts"]) == sorted(amounts)
+    status = router.handle({"request": "bulk_status", "job": response["job"]})["job"]
+    assert (status["total"], status["finished"]) == (3, True)
@@ -0,0 +1,77 @@
+import csv
+import json
+from concurrent.futures import Future
+
+import pytest
+
+import client
+import codec
+import homomorphic
+
+
+class FakeServer:
+    """Serves a fixed history in pages, optionally failing after a number of requests."""
+
+    def __init__(self, entries, fail_after=None):
+        self.entries = entries
+        self.fail_after = fail_after
+
+    def submit(self, request):
+        if self.fail_after is not None:
+            if self.fail_after == 0:
+                raise ConnectionError("link dropped")
+            self.fail_after -= 1
+        start = request["cursor"] or 0
+        end = start + request["limit"]
+        future = Future()
+        future.set_result({"status": "success", "transactions": [dict(e) for e in self.entries[start:end]],
+                           "next_cursor": end if end < len(self.entries) else None})
+        return future
+
+
+@pytest.fixture
+def history(monkeypatch):
+    public_key, private_key = homomorphic.generate_keypair()
+
+    class Ring:
+        def private_key(self, username):
+            return private_key
+
+    monkeypatch.setattr(client, "get_key_ring", Ring)
+    return [{"time": "12:00:00", "type": "send money", "receiver": "bob",
+             "amount": codec.encode(public_key.encrypt(i), public_key)} for i in range(23)]
+
+
+def read(path, fmt):
+    with open(path) as f:
+        if fmt == "json":
+            return json.load(f)
+        if fmt == "jsonl":
+            return [json.loads(line) for line in f]
+        return [dict(row, amount=int(row["amount"])) for row in csv.DictReader(f)]
+
+
+@pytest.mark.parametrize("fmt", client.EXPORT_FORMATS)
+def test_interrupted_export_resumes_without_duplicates(history, fmt):
+    with pytest.raises(ConnectionError):
+        client.export_history(FakeServer(history, fail_after=2), "alice", "part." + fmt, fmt=fmt, page=5)
+    assert client.export_history(FakeServer(history), "alice", "part." + fmt, fmt=fmt, page=5) == 23
+    assert client.export_history(FakeServer(history), "alice", "full." + fmt, fmt=fmt, page=5) == 23
+    with open("part." + fmt) as part, open("full." + fmt) as full:
+        assert part.read() == full.read()
+    assert [e["amount"] for e in read("full." + fmt, fmt)] == list(range(23))
+
+
+@pytest.mark.parametrize("fmt", ["json", "jsonl"])
+def test_export_stopped_before_finish_is_only_closed(history, fmt, monkeypatch):
+    def crash(self):
+        self.close()
+        raise KeyboardInterrupt
+
+    with monkeypatch.context() as patch:
+        patch.setattr(client.HistoryFile, "finish", crash)
+        with pytest.raises(KeyboardInterrupt):
+            client.export_history(FakeServer(history), "alice", "out." + fmt, fmt=fmt, page=5)
+    server = FakeServer(history, fail_after=0)   # any history request would fail
+    assert client.export_history(server, "alice", "out." + fmt, fmt=fmt, page=5) == 23
+    assert [e["amount"] for e in read("out." + fmt, fmt)] == list(range(23))
@@ -0,0 +1,79 @@
+import os
+
+import history_log
+
+
+def fill(log, username, count):
+    for i in range(count):
+        log.append(username, {"type": "send money", "n": i})
+
+
+def read_pages(log, username, limit):
+    entries, cursor = log.read(username, limit=limit)
+    pages = [entries]
+    while cursor is not None:
+        entries, cursor = log.read(username, cursor=cursor, limit=limit)
+        pages.append(entries)
+    return pages
+
+
+def test_cursor_pages_cover_every_entry_once_across_segments(monkeypatch):
+    monkeypatch.setattr(history_log, "SEGMENT_BYTES", 200)
+    log = history_log.HistoryLog()
+    fill(log, "alice", 25)
+    assert len(log._user("alice").segments) > 1
+    pages = read_pages(log, "alice", 7)
+    assert [len(page) for page in pages] == [7, 7, 7, 4]
+    assert [e["n"] for page in pages for e in page] == list(range(25))
+
+
+def test_rotation_merges_sealed_segments(monkeypatch):
+    monkeypatch.setattr(history_log, "SEGMENT_BYTES", 200)
+    monkeypatch.setattr(history_log, "COMPACT_MIN_SEGMENTS", 3)
+    log = history_log.HistoryLog()
+    fill(log, "alice", 60)
+    assert len(log._user("alice").segments) <= 3
+    assert len(os.listdir(log._user("alice").directory)) <= 2 * 3
+    assert [e["n"] for e in log.read("alice")[0]] == list(range(60))
+    assert [e["n"] for e in history_log.HistoryLog().read("alice")[0]] == list(range(60))
+
+
+def test_reopened_log_drops_torn_record_and_keeps_appending():
+    log = history_log.HistoryLog()
+    fill(log, "alice", 3)
+    segment = log._user("alice").segments[-1]
+    with open(segment.log_path, "ab") as f:
+        f.write(b'{"seq": 3, "ts": 1.0, "entry": {"ty')
+    reopened = history_log.HistoryLog()
+    assert [e["n"] for e in reopened.read("alice")[0]] == [0, 1, 2]
+    reopened.append("alice", {"type": "send money", "n": 3})
+    assert [e["n"] for e in history_log.HistoryLog().read("alice")[0]] == [0, 1, 2, 3]
+
+
+def test_rebuilds_missing_index():
+    log = history_log.HistoryLog()
+    fill(log, "alice", 5)
+    os.remove(log._user("alice").segments[-1].idx_path)
+    entries, cursor = history_log.HistoryLog().read("alice", cursor=2, limit=2)
+    assert [e["n"] for e in entries] == [2, 3]
+    assert cursor == 4
+
+
+def test_fold_replaces_old_entries_and_keeps_cursors_valid(monkeypatch):
+    monkeypatch.setattr(history_log, "SEGMENT_BYTES", 200)
+    log = history_log.HistoryLog()
+    fill(log, "alice", 20)
+
+    def folder(records, total):
+        records = list(records)
+        return records[9][0], [(records[9][0], records[9][1], {"type": "checkpoint", "count": 10})]
+
+    log.fold("alice", folder)
+    entries = history_log.HistoryLog().read("alice")[0]
+    assert entries[0] == {"type": "checkpoint", "count": 10}
+    assert [e["n"] for e in entries[1:]] == list(range(10, 20))
+    assert [e["n"] for e in log.read("alice", cursor=15)[0]] == list(range(15, 20))
+
+
+def test_unknown_user_has_no_history():
+    assert history_log.HistoryLog().read("nobody") == ([], None)
@@ -0,0 +1,49 @@
+import pytest
+
+import codec
+import homomorphic
+import key_ring
+import key_vault
+import third_party
+import utils
+
+
+@pytest.fixture(scope="module")
+def keypair():
+    return homomorphic.generate_keypair()
+
+
+def test_crt_decrypt_matches_classic_decrypt(keypair):
+    public_key, private_key = keypair
+    assert len(private_key) == 10
+    classic = homomorphic.PaillierPrivateKey(private_key[:3])
+    for m in (0, 1, 12345, int(public_key.n) // 2, -7):
+        c = public_key.encrypt(m)
+        assert homomorphic.decrypt_crt(c, private_key) == m % int(public_key.n)
+        assert private_key.decrypt(c) == classic.decrypt(c) == m
+
+
+@pytest.mark.parametrize("version", [codec.LEGACY, codec.VERSION])
+def test_expanded_key_round_trips_through_the_vault(monkeypatch, keypair, version):
+    public_key, private_key = keypair
+    monkeypatch.setattr(key_vault, "_vault", key_vault.KeyVault())
+    wire_key = codec.encode_key if version >= codec.VERSION else utils.serialize_key
+    stored = third_party.handle_request({"type": "store_keys", "username": "alice", "codec": version,
+                                         "private_key": wire_key(private_key), "public_key": wire_key(public_key)})
+    assert stored["status"] == "success"
+
+    fetched = third_party.handle_request({"type": "acquire_keys", "username": "alice", "codec": version})
+    fetched_key = homomorphic.as_private_key(codec.decode_key(fetched["private_key"]))
+    assert tuple(fetched_key) == tuple(private_key)
+    assert fetched_key.decrypt(public_key.encrypt(42)) == 42
+
+
+def test_expanded_key_round_trips_through_the_key_ring(keypair):
+    public_key, private_key = keypair
+    ring = key_ring.KeyRing("keys.json")
+    ring.save("alice", private_key, public_key)
+    ring.close()
+    reopened = key_ring.KeyRing("keys.json")
+    assert tuple(reopened.private_key("alice")) == tuple(private_key)
+    assert reopened.public_key("alice") == public_key
+    assert reopened.private_key("alice").decrypt(public_key.encrypt(-3)) == -3
@@ -0,0 +1,83 @@
+import replication
+import storage
+
+
+def make_primary():
+    feed = replication.ChangeFeed()
+    store = replication.ReplicatedStore(storage.MemoryAccountStore(), feed)
+    history = replication.ReplicatedHistoryLog(feed, "history")
+    return feed, store, history
+
+
+def drain(subscriber):
+    changes = []
+    while not subscriber.empty():
+        changes.append(subscriber.get_nowait())
+    return changes
+
+
+def test_snapshot_in_small_frames_rebuilds_the_replica(monkeypatch):
+    monkeypatch.setattr(replication, "SNAPSHOT_BATCH", 2)
+    feed, store, history = make_primary()
+    for i in range(5):
+        store.create(f"user{i}", {"pwd": "x", "balance": f"b{i}"})
+        for n in range(3):
+            history.append(f"user{i}", {"type": "send money", "n": n})
+
+    state = replication.ReplicaState()
+    frames = list(replication.snapshot(store, history, feed.lsn))
+    assert len(frames) > 3 and all(len(f.get("balances", f.get("records", []))) <= 2 for f in frames)
+    for frame in frames[:-1]:
+        state.apply(frame)
+        assert state.lsn == 0 and state.lag() > replication.MAX_LAG
+    state.apply(frames[-1])
+    assert state.lsn == feed.lsn
+    assert state.balance("user3") == ("b3", feed.lsn)
+    assert [e["n"] for e in state.read_history("user4")[0]] == [0, 1, 2]
+
+
+def test_snapshot_start_discards_stale_state():
+    feed, store, history = make_primary()
+    state = replication.ReplicaState()
+    state.apply({"op": "balances", "balances": {"gone": "x"}, "lsn": 5, "time": 0})
+    for frame in replication.snapshot(store, history, feed.lsn):
+        state.apply(frame)
+    assert state.balance("gone")[0] is None
+
+
+def test_reconnecting_replica_gets_only_the_missed_changes():
+    feed, store, history = make_primary()
+    state = replication.ReplicaState()
+    subscriber, start, missed = feed.subscribe(None)
+    assert missed is None
+    for frame in replication.snapshot(store, history, start):
+        state.apply(frame)
+    store.create("alice", {"pwd": "x", "balance": "1"})
+    for change in drain(subscriber):
+        state.apply(change)
+    feed.unsubscribe(subscriber)
+
+    store.update("alice", balance="2")
+    history.append("alice", {"type": "receive money"})
+    subscriber, _, missed = feed.subscribe(state.lsn)
+    assert [c["op"] for c in missed] == ["balances", "history"]
+    for change in missed:
+        state.apply(change)
+    assert state.balance("alice") == ("2", feed.lsn)
+    assert feed.subscribe(feed.lsn - 10 ** 9)[2] is None
+
+
+def test_fold_reset_in_frames_matches_the_primary(monkeypatch):
+    monkeypatch.setattr(replication, "SNAPSHOT_BATCH", 3)
+    feed, store, history = make_primary()
+    state = replication.ReplicaState()
+    subscriber, start, _ = feed.subscribe(None)
+    for frame in replication.snapshot(store, history, start):
+        state.apply(frame)
+    for n in range(12):
+        history.append("alice", {"type": "send money", "n": n})
+    history.fold("alice", lambda records, total: (list(records)[4][0], []))
+    for change in drain(subscriber):
+        state.apply(change)
+    assert [e["n"] for e in state.read_history("alice")[0]] == list(range(5, 12))
+    assert state.read_history("alice") == history.read("alice")
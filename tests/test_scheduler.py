@@ -0,0 +1,92 @@
+import threading
+import time
+
+import scheduler
+
+
+class BlockingHandler:
+    """Request handler that holds every request until released."""
+
+    def __init__(self):
+        self.release = threading.Event()
+        self.started = threading.Semaphore(0)
+
+    def __call__(self, request):
+        self.started.release()
+        self.release.wait(5)
+        return {"status": "success", "request": request["request"]}
+
+
+def make_scheduler(handler, max_in_flight=64, **lanes):
+    return scheduler.Scheduler(handler, dict(scheduler.LANES, **lanes), max_in_flight).start()
+
+
+def test_full_lane_answers_busy_at_once():
+    handler = BlockingHandler()
+    sched = make_scheduler(handler, balance=(1, 1, 10.0))
+    running = sched.submit({"request": "balance"})
+    assert handler.started.acquire(timeout=5)
+    queued = sched.submit({"request": "balance"})
+    shed = sched.submit({"request": "balance"})
+    assert shed.done() and shed.result()["status"] == "busy"
+    handler.release.set()
+    assert running.result(5)["status"] == "success"
+    assert queued.result(5)["status"] == "success"
+
+
+def test_client_over_its_in_flight_limit_is_shed():
+    handler = BlockingHandler()
+    sched = make_scheduler(handler, max_in_flight=2)
+    client = object()
+    first = [sched.submit({"request": "balance"}, client) for _ in range(2)]
+    assert sched.submit({"request": "balance"}, client).result(0)["status"] == "busy"
+    assert not sched.submit({"request": "balance"}, object()).done()
+    handler.release.set()
+    assert all(f.result(5)["status"] == "success" for f in first)
+    assert sched.submit({"request": "balance"}, client).result(5)["status"] == "success"
+
+
+def test_request_still_queued_at_its_deadline_is_dropped():
+    handler = BlockingHandler()
+    sched = make_scheduler(handler, history=(1, 10, 10.0))
+    sched.submit({"request": "history"})
+    assert handler.started.acquire(timeout=5)
+    late = sched.submit({"request": "history", "max_wait": 0.05})
+    time.sleep(0.1)
+    handler.release.set()
+    assert late.result(5)["status"] == "busy"
+
+
+def test_busy_lane_does_not_delay_other_lanes():
+    handler = BlockingHandler()
+    sched = make_scheduler(handler, transfer=(1, 4, 10.0))
+    blocked = sched.submit({"request": "transfer"})
+    assert handler.started.acquire(timeout=5)
+
+    def balance(request):
+        return {"status": "success"} if request["request"] == "balance" else handler(request)
+
+    sched.handle = balance
+    assert sched.submit({"request": "balance"}).result(5)["status"] == "success"
+    assert not blocked.done()
+    handler.release.set()
+    assert blocked.result(5)["status"] == "success"
+
+
+def test_bulk_jobs_do_not_queue_behind_balance_checks():
+    handler = BlockingHandler()
+    sched = make_scheduler(handler, balance=(1, 1, 10.0))
+    sched.submit({"request": "balance"})
+    assert handler.started.acquire(timeout=5)
+    sched.submit({"request": "balance"})
+    status = sched.submit({"request": "bulk_status"})
+    assert not status.done()
+    handler.release.set()
+    assert status.result(5)["status"] == "success"
+
+
+def test_lane_config_overrides():
+    lanes = scheduler.lane_config("auth=4:512:5, history=1:64:10")
+    assert lanes["auth"] == (4, 512, 5.0)
+    assert lanes["history"] == (1, 64, 10.0)
+    assert lanes["balance"] == scheduler.LANES["balance"]
@@ -0,0 +1,72 @@
+import time
+
+import pytest
+
+import server
+import sessions
+
+
+@pytest.fixture
+def manager(monkeypatch):
+    manager = sessions.SessionManager(secret=b"s" * 32)
+    monkeypatch.setattr(sessions, "_sessions", manager)
+    return manager
+
+
+def test_token_is_valid_only_for_its_user(manager):
+    token = manager.issue("alice")
+    assert manager.validate(token, "alice")
+    assert not manager.validate(token, "bob")
+    assert not manager.validate("made.up.token.x", "alice")
+    assert not manager.validate(None, "alice")
+
+
+def test_expired_token_is_refused():
+    manager = sessions.SessionManager(ttl=-1)
+    token = manager.issue("alice")
+    assert not manager.validate(token, "alice")
+    assert manager.verify_signature(token) is None
+
+
+def test_signature_check_rejects_tampered_tokens(manager):
+    token = manager.issue("alice")
+    assert manager.verify_signature(token) == "alice"
+    body, signature = token.rsplit(".", 1)
+    user_field, expiry, nonce = body.split(".")
+    forged_user = sessions._b64(b"bob")
+    assert manager.verify_signature(f"{forged_user}.{expiry}.{nonce}.{signature}") is None
+    assert manager.verify_signature(f"{user_field}.{int(expiry) + 60}.{nonce}.{signature}") is None
+    assert manager.verify_signature(token[:-2]) is None
+    assert sessions.SessionManager(secret=b"t" * 32).verify_signature(token) is None
+    assert manager.verify_signature("garbage") is None
+
+
+def test_rate_limiter_allows_a_burst_then_refills():
+    limiter = sessions.LoginRateLimiter(burst=2, refill_seconds=0.05)
+    assert limiter.allow("alice") and limiter.allow("alice")
+    assert not limiter.allow("alice")
+    assert limiter.allow("bob")
+    time.sleep(0.06)
+    assert limiter.allow("alice")
+    assert not limiter.allow("alice")
+
+
+@pytest.mark.parametrize("request_", [
+    {"request": "balance", "username": "alice"},
+    {"request": "history", "username": "alice"},
+    {"request": "transfer", "sender": "alice", "receiver": "bob",
+     "sender_encrypted_amount": 1, "receiver_encrypted_amount": 1},
+])
+def test_account_requests_need_the_owner_session(manager, request_):
+    assert server.handle_request(request_)["message"] == "Not logged in or session expired"
+    other = dict(request_, token=manager.issue("bob"))
+    assert server.handle_request(other)["message"] == "Not logged in or session expired"
+
+
+def test_logout_revokes_the_session(manager):
+    token = manager.issue("alice")
+    assert server.handle_request({"request": "logout", "username": "bob", "token": token})["status"] == "error"
+    assert manager.validate(token, "alice")
+    assert server.handle_request({"request": "logout", "username": "alice", "token": token})["status"] == "success"
+    assert not manager.validate(token, "alice")
+    assert server.handle_request({"request": "balance", "username": "alice", "token": token})["status"] == "error"
@@ -0,0 +1,137 @@
+import time
+from concurrent.futures import Future
+
+import pytest
+
+import codec
+import homomorphic
+import server
+import shards
+import storage
+import utils
+
+
+class FakeShards:
+    """Stands in for the shard servers: records requests and answers them from a table."""
+
+    def __init__(self):
+        self.requests = []
+        self.down = set()
+        self.refuse = set()
+
+    def submit(self, shard, request):
+        future = Future()
+        if shard in self.down:
+            future.set_exception(ConnectionError("shard down"))
+            return future
+        self.requests.append((shard, request["request"], request.get("txid")))
+        status = "error" if request["request"] in self.refuse else "success"
+        future.set_result({"status": status, "message": request["request"], "version": "v1"})
+        return future
+
+
+def make_router(fake, log_path="router.txlog"):
+    router = shards.Router([1, 2], "secret", log_path=log_path)
+    router._submit = fake.submit
+    return router
+
+
+def decisions(fake, txid):
+    return sorted((shard, kind) for shard, kind, t in fake.requests if t == txid)
+
+
+def test_transfer_cut_off_before_decision_is_aborted_on_restart():
+    log = storage.WriteAheadLog("router.txlog")
+    log.append({"txid": "t1", "sender": "a", "receiver": "b", "shards": [0, 1], "state": "begin"})
+    log.close()
+    fake = FakeShards()
+    router = make_router(fake)
+    assert router._unfinished["t1"]["state"] == "abort"
+    router.recover()
+    assert decisions(fake, "t1") == [(0, "abort_transfer"), (1, "abort_transfer")]
+    assert router._unfinished == {}
+    router._log.sync()
+    assert make_router(FakeShards())._unfinished == {}
+
+
+def test_logged_commit_is_resent_until_both_shards_apply_it():
+    log = storage.WriteAheadLog("router.txlog")
+    log.append({"txid": "t2", "sender": "a", "receiver": "b", "shards": [0, 1], "state": "begin"})
+    log.append({"txid": "t2", "state": "commit"})
+    log.close()
+    fake = FakeShards()
+    fake.down.add(1)
+    router = make_router(fake)
+    router.recover()
+    assert "t2" in router._unfinished
+    fake.down.clear()
+    router.recover()
+    assert (1, "commit_transfer") in decisions(fake, "t2")
+    assert router._unfinished == {}
+
+
+def test_failed_prepare_aborts_on_both_shards():
+    fake = FakeShards()
+    fake.refuse.add("prepare_credit")
+    router = make_router(fake)
+    response = router.cross_shard_transfer({"sender": "a", "receiver": "b", "sender_encrypted_amount": 1,
+                                            "receiver_encrypted_amount": 1}, 0)
+    assert response["status"] == "error"
+    txid = fake.requests[0][2]
+    assert (0, "abort_transfer") in decisions(fake, txid) and (1, "abort_transfer") in decisions(fake, txid)
+    assert router._unfinished == {}
+
+
+def test_successful_transfer_commits_on_both_shards():
+    fake = FakeShards()
+    router = make_router(fake)
+    response = router.cross_shard_transfer({"sender": "a", "receiver": "b", "sender_encrypted_amount": 1,
+                                            "receiver_encrypted_amount": 1}, 0)
+    assert response["status"] == "success"
+    txid = fake.requests[0][2]
+    assert decisions(fake, txid) == [(0, "commit_transfer"), (0, "prepare_debit"),
+                                     (1, "commit_transfer"), (1, "prepare_credit")]
+
+
+@pytest.fixture
+def shard_account(monkeypatch):
+    """One account holding 100 on a fresh shard store; returns its private key."""
+    monkeypatch.setattr(storage, "_store", storage.MemoryAccountStore("credentials.json"))
+    public_key, private_key = homomorphic.generate_keypair()
+    wire_key = utils.serialize_key(public_key)
+    storage.get_store().create("alice", {"pwd": "x", "public_key": wire_key,
+                                         "balance": codec.encode(public_key.encrypt(100), wire_key)})
+    return public_key, private_key
+
+
+def shard_balance(private_key):
+    return private_key.decrypt(codec.decode(storage.get_store().get("alice")["balance"]))
+
+
+def prepare_debit(public_key, txid, amount):
+    return server.handle_prepare({"request": "prepare_debit", "txid": txid, "sender": "alice", "receiver": "bob",
+                                  "sender_encrypted_amount": int(public_key.encrypt(amount))})
+
+
+def test_prepare_arriving_after_its_abort_is_refused(shard_account):
+    public_key, private_key = shard_account
+    finish = {"request": "abort_transfer", "txid": "t5", "username": "alice"}
+    assert server.handle_finish(finish, "12:00:00")["status"] == "success"
+    assert prepare_debit(public_key, "t5", 30)["status"] == "error"
+    assert shard_balance(private_key) == 100
+    assert storage.get_store().get("alice").get("pending", {}) == {}
+
+
+def test_expired_debit_is_refunded_and_a_late_commit_refused(shard_account):
+    public_key, private_key = shard_account
+    assert prepare_debit(public_key, "t6", 30)["status"] == "success"
+    assert prepare_debit(public_key, "t7", 5)["status"] == "success"
+    pending = storage.get_store().get("alice")["pending"]
+    pending["t6"] = dict(pending["t6"], time=time.time() - server.PENDING_TIMEOUT - 1)
+    storage.get_store().update("alice", pending=pending)
+
+    assert server.expire_pending() == 1
+    assert shard_balance(private_key) == 95
+    assert list(storage.get_store().get("alice")["pending"]) == ["t7"]
+    finish = {"request": "commit_transfer", "txid": "t6", "username": "alice"}
+    assert server.handle_finish(finish, "12:00:00")["message"] == "Transfer expired"
@@ -0,0 +1,49 @@
+import json
+
+import pytest
+
+import storage
+
+
+def make_store(**kwargs):
+    return storage.MemoryAccountStore("credentials.json", **kwargs)
+
+
+def test_replay_restores_acknowledged_changes():
+    store = make_store()
+    store.create("alice", {"pwd": "x", "balance": "1"})
+    store.create("bob", {"pwd": "y", "balance": "2"})
+    store.update_many({"alice": {"balance": "3"}, "bob": {"balance": "4"}})
+    # No close(): a crash leaves only the WAL behind.
+    reopened = make_store()
+    assert reopened.get("alice")["balance"] == "3"
+    assert reopened.get("bob")["balance"] == "4"
+    assert sorted(reopened.usernames()) == ["alice", "bob"]
+
+
+def test_replay_ignores_torn_last_record():
+    store = make_store()
+    store.create("alice", {"pwd": "x", "balance": "1"})
+    with open("credentials.json" + storage.WAL_SUFFIX, "a") as f:
+        f.write('{"op": "update", "changes": {"alice": {"bal')
+    reopened = make_store()
+    assert reopened.get("alice")["balance"] == "1"
+
+
+def test_checkpoint_truncates_wal_without_losing_records():
+    store = make_store(checkpoint_every=2)
+    for i in range(3):
+        store.create(f"user{i}", {"pwd": "x", "balance": str(i)})
+    with open("credentials.json") as f:
+        assert sorted(json.load(f)) == ["user0", "user1"]
+    assert len(storage.WriteAheadLog("credentials.json" + storage.WAL_SUFFIX).replay()) == 1
+    reopened = make_store()
+    assert [reopened.get(f"user{i}")["balance"] for i in range(3)] == ["0", "1", "2"]
+
+
+def test_update_of_missing_account_changes_nothing():
+    store = make_store()
+    store.create("alice", {"pwd": "x", "balance": "1"})
+    with pytest.raises(KeyError):
+        store.update_many({"alice": {"balance": "2"}, "ghost": {"balance": "3"}})
+    assert make_store().get("alice")["balance"] == "1"
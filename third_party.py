@@ -1,68 +1,102 @@
+import sys
 import socket
 import threading
 import json
-import utils
-
-file_path = "key_vault.json"
+import protocol
+import key_vault
+import async_server
+import metrics
+import codec
 
 def client_handler(conn, addr):
     """Handles a new client connection."""
     with conn:
         print(f"Connected by {addr}")
-        while True:
-            try:
-                data = conn.recv(1024 * 10)
+        try:
+            channel = protocol.accept_channel(conn)
+            while True:
+                data = channel.recv()
                 if not data:
                     break  
-                request = json.loads(data.decode())  
-                response = {}
-
-                if request["type"] == "store_keys":
-                    private_key = request["private_key"]
-                    public_key = request["public_key"]
-                    username = request["username"]
-                    print(type(public_key))
-                    with open(file_path, "r") as f:
-                        data = json.load(f)
-
-                    if username not in data:
-                        data[username] = {
-                            "private_key": private_key,
-                            "public_key": public_key
-                        }
-                        with open(file_path, "w") as f:
-                            json.dump(data, f, indent=4)
-                        response = {"status": "success", "message": "Stored keys successfully."}
-                    else:
-                        response = {"status": "error", "message": "Username already exists."}
-
-                elif request["type"] == "acquire_keys":
-                    username = request["username"]
-
-                    with open(file_path, "r") as f:
-                        data = json.load(f)
-
-                    if username in data:
-                        response = {
-                            "status": "success",
-                            "private_key": data[username]["private_key"],
-                            "public_key": data[username]["public_key"],
-                            "message": "Fetched private key successfully."
-                        }
-                    else:
-                        response = {"status": "error", "message": "Username not found."}
-
-                else:
-                    response = {"status": "error", "message": "Request type not supported."}
-
-            except json.JSONDecodeError:
-                response = {"status": "error", "message": "Invalid request format"}
-
-            conn.sendall(json.dumps(response).encode())
+                try:
+                    request = json.loads(data.decode())  
+                except (json.JSONDecodeError, UnicodeDecodeError):
+                    channel.send({"status": "error", "message": "Invalid request format"})
+                    continue
+
+                protocol.reply(channel, request, dispatch(request))
+        except (OSError, ValueError) as exc:
+            print(f"Connection error from {addr}: {exc}")
+
+def dispatch(request):
+    """Handles one decoded key-vault request and returns its response."""
+    started = metrics.start_request("vault")
+    try:
+        response = handle_request(request)
+    except (KeyError, TypeError, ValueError):
+        response = {"status": "error", "message": "Invalid request format"}
+    metrics.finish_request("vault", request.get("type") if isinstance(request, dict) else None,
+                           started, response)
+    return response
+
+def handle_request(request):
+    """Stores or fetches keys.
+
+    acquire_keys with "username" returns that user's key pair; with a
+    "usernames" list it returns only the public keys of all of them.
+    """
+    response = {}
+    vault = key_vault.get_vault()
+    # Codec 2 clients get keys as base64 big-endian bytes; either form is accepted.
+    wire_key = codec.encode_key if codec.negotiate(request) >= codec.VERSION else list
+
+    if request["type"] == "stats":
+        response = {"status": "success", "stats": metrics.snapshot()}
+
+    elif request["type"] == "store_keys":
+        private_key = codec.decode_key(request["private_key"])
+        public_key = codec.decode_key(request["public_key"])
+        username = request["username"]
+
+        # Classic (λ, μ, n) keys and expanded CRT keys are both accepted.
+        if len(private_key) not in (3, 10):
+            response = {"status": "error", "message": "Malformed private key."}
+        elif vault.store(username, private_key, public_key):
+            response = {"status": "success", "message": "Stored keys successfully."}
+        else:
+            response = {"status": "error", "message": "Username already exists."}
+
+    elif request["type"] == "acquire_keys" and "usernames" in request:
+        public_keys, missing = vault.public_keys(request["usernames"])
+        response = {
+            "status": "success",
+            "public_keys": {u: wire_key(key) for u, key in public_keys.items()},
+            "missing": missing,
+            "message": f"Fetched {len(public_keys)} public keys."
+        }
+
+    elif request["type"] == "acquire_keys":
+        username = request["username"]
+        keys = vault.get(username)
+
+        if keys is not None:
+            response = {
+                "status": "success",
+                "private_key": wire_key(keys["private_key"]),
+                "public_key": wire_key(keys["public_key"]),
+                "message": "Fetched private key successfully."
+            }
+        else:
+            response = {"status": "error", "message": "Username not found."}
+
+    else:
+        response = {"status": "error", "message": "Request type not supported."}
+
+    return response
 
 def start_server(host="127.0.0.1", port=65431):
     """Starts the third-party server."""
-    utils.initialize_json(file_path)
+    key_vault.get_vault()
 
     with socket.socket(socket.AF_INET, socket.SOCK_STREAM) as sfd:
         sfd.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
@@ -74,5 +108,14 @@ def start_server(host="127.0.0.1", port=65431):
             conn, addr = sfd.accept()
             threading.Thread(target=client_handler, args=(conn, addr), daemon=True).start()
 
+def start_async_server(host="127.0.0.1", port=65431, cpu_workers=0):
+    """Starts the third-party server on an asyncio event loop."""
+    key_vault.get_vault()
+    print(f"Third-party server listening on {host}:{port} (asyncio)")
+    async_server.run(dispatch, host, port, cpu_workers=cpu_workers)
+
 if __name__ == "__main__":
-    start_server()
+    if "--async" in sys.argv:
+        start_async_server()
+    else:
+        start_server()
@@ -1,42 +1,27 @@
 import json
-import gmpy2 
+import hashlib
 import os
-
-FILE_PATH = "credentials.json"
-KEYS_FILE = "keys.json"
-HISTORY_PATH = "history.json"
-
-def load_credentials():
-    """Loads user credentials from the JSON file."""
-    try:
-        with open(FILE_PATH, "r") as file:
-            users = json.load(file)
-            for user in users:
-                users[user]["balance"] = users[user]["balance"]
-            return users
-    except (FileNotFoundError, json.JSONDecodeError):
-        return {}
-
-def save_credentials(users):
-    """Saves updated user credentials to the JSON file."""
-    with open(FILE_PATH, "w") as file:
-        json.dump(users, file, indent=4)
-
-def update_user_history(username, transaction):
-    """Appends a transaction to the user's history in history.json."""
-    try:
-        with open(HISTORY_PATH, "r") as history_file:
-            history_data = json.load(history_file)
-    except (FileNotFoundError, json.JSONDecodeError):
-        history_data = {}
-
-    if username not in history_data:
-        history_data[username] = []
-    history_data[username].append(transaction)
-
-    with open(HISTORY_PATH, "w") as history_file:
-        json.dump(history_data, history_file, indent=4)
-
+import metrics
+import codec
+
+FILE_PATH = "credentials.json"    # legacy account file, imported by the account store
+KEYS_FILE = "keys.json"           # client key file, kept by key_ring
+HISTORY_PATH = "history.json"     # legacy history file, imported by the history log
+
+def atomic_write_json(path, data):
+    """Writes JSON to path so that readers see either the old or the new file, never a torn one."""
+    with metrics.timed("json_rewrite"):
+        tmp_path = f"{path}.tmp"
+        with open(tmp_path, "w") as file:
+            json.dump(data, file)
+            file.flush()
+            os.fsync(file.fileno())
+        os.replace(tmp_path, path)
+        dir_fd = os.open(os.path.dirname(os.path.abspath(path)), os.O_RDONLY)
+        try:
+            os.fsync(dir_fd)
+        finally:
+            os.close(dir_fd)
 
 def initialize_json(file):
     """Ensures credentials.json exists and is a valid JSON object."""
@@ -55,38 +40,10 @@ def initialize_json(file):
             with open(file, "w") as f:
                 json.dump({}, f, indent=4)
             
-def save_keys(username, private_key, public_key):
-    """Stores private key securely in a local file."""
-    keys = {}
-    if os.path.exists(KEYS_FILE):
-        with open(KEYS_FILE, "r") as f:
-            keys = json.load(f)
-            
-    keys[username] = {} 
-    keys[username]["private_key"] = private_key
-    keys[username]["public_key"] = public_key
-    with open(KEYS_FILE, "w") as f:
-        json.dump(keys, f, indent=4)
-
-def load_private_key(username):
-    """Retrieves stored private key and converts it back to mpz format."""
-    if not os.path.exists(KEYS_FILE):
-        return None  
-    
-    with open(KEYS_FILE, "r") as f:
-        keys = json.load(f)  
-    
-    private_key = keys.get(username, {}).get("private_key", [0, 0, 0])  
-    return tuple(gmpy2.mpz(x) for x in private_key)
-
+def serialize_key(key):
+    """Converts a key tuple (classic or expanded form) into a JSON-friendly list."""
+    return [int(x) for x in key]
 
-def load_public_key(username):
-    """Retrieves stored public key and converts it back to mpz format."""
-    if not os.path.exists(KEYS_FILE):
-        return None  
-    
-    with open(KEYS_FILE, "r") as f:
-        keys = json.load(f)  
-    
-    public_key = keys.get(username, {}).get("public_key", [0, 0])  
-    return tuple(gmpy2.mpz(x) for x in public_key)
+def balance_version(encrypted_balance):
+    """Short fingerprint of an encrypted balance; it changes whenever the balance is rewritten."""
+    return hashlib.blake2b(str(codec.decode(encrypted_balance)).encode(), digest_size=8).hexdigest()
@@ -0,0 +1,61 @@
+import multiprocessing
+import os
+import threading
+from concurrent.futures import Future, ProcessPoolExecutor
+
+PROCESSES = int(os.environ.get("WALLET_CPU_WORKERS", "0"))   # 0 runs CPU work inline
+
+_pool = None
+_processes = 0
+_pool_lock = threading.Lock()
+
+
+def configure(processes=PROCESSES):
+    """(Re)creates the process pool used for CPU-bound work; 0 disables it."""
+    global _pool, _processes
+    with _pool_lock:
+        if _pool is not None:
+            _pool.shutdown(wait=False, cancel_futures=True)
+        _pool = None
+        _processes = processes
+        if processes:
+            _pool = ProcessPoolExecutor(processes, mp_context=multiprocessing.get_context("spawn"))
+
+
+def size():
+    """Returns the number of worker processes, 0 when CPU work runs inline."""
+    return _processes
+
+
+def submit(fn, *args):
+    """Schedules fn(*args) on the pool, or runs it inline when there is no pool."""
+    pool = _pool
+    if pool is not None:
+        return pool.submit(fn, *args)
+    future = Future()
+    try:
+        future.set_result(fn(*args))
+    except Exception as exc:
+        future.set_exception(exc)
+    return future
+
+
+def run(fn, *args):
+    """Runs fn(*args) on the pool and waits for the result.
+
+    PBKDF2 and modular exponentiation hold the GIL, so sending them to other
+    processes is what lets them use more than one core.
+    """
+    return submit(fn, *args).result()
+
+
+def map(fn, *iterables, chunksize=1):
+    """Like the builtin map(), spread over the pool when there is one."""
+    pool = _pool
+    if pool is not None:
+        return list(pool.map(fn, *iterables, chunksize=chunksize))
+    return [fn(*args) for args in zip(*iterables)]
+
+
+def shutdown():
+    configure(0)